@@ -0,0 +1,275 @@
+import time
+import collections
+
+import torch
+from app.code.core.KvCache import PagedKvCache
+
+
+class NgramBlocker:
+    """
+    Incremental no_repeat_ngram_size for one sequence.
+
+    Gives the same banned tokens as the NoRepeatNGramLogitsProcessor used by model.generate,
+    but keeps the n-gram table between steps instead of rebuilding it from the whole
+    sequence every step.
+    """
+
+    def __init__(self, ngramSize, tokenList):
+        self.ngramSize = ngramSize
+        self.tokenList = []
+        self.ngramDict = {}
+        for token in tokenList:
+            self.append(token)
+
+    def append(self, token):
+        self.tokenList.append(token)
+        if self.ngramSize > 0 and len(self.tokenList) >= self.ngramSize:
+            key = tuple(self.tokenList[-self.ngramSize:-1])
+            self.ngramDict.setdefault(key, set()).add(token)
+
+    def getBanned(self):
+        """
+        Tokens that would repeat an n-gram if they came next.
+        """
+        if self.ngramSize <= 0 or len(self.tokenList) + 1 < self.ngramSize:
+            return []
+        key = tuple(self.tokenList[len(self.tokenList) + 1 - self.ngramSize:])
+        return list(self.ngramDict.get(key, ()))
+
+
+class DecodeRequest:
+    """One OCR request in the scheduler: its input, the generated ids and its state."""
+
+    def __init__(self, ocrInput, maxNewTokens):
+        self.ocrInput = ocrInput
+        self.maxNewTokens = maxNewTokens
+        self.outputIds = []
+        self.seqId = None
+        self.blocker = None
+        self.done = False
+        self.text = None
+        self.addTime = time.perf_counter()
+        self.finishTime = None
+
+
+class DecodeScheduler:
+    """
+    Iteration-level (continuous) batching of greedy OCR decoding.
+
+    model.generate runs a static batch until its longest row is done, so short outputs wait
+    for long ones while their rows keep going through the model. Here the decode loop is run
+    by the scheduler: every step first admits waiting requests while the cache has room (prefill with
+    their image features, which also gives their first token), then runs one decode step for
+    all running rows together, then evicts the rows that hit the stop token or maxNewTokens.
+    A finished row frees its KV cache blocks at once and the next request takes them in the next step.
+
+    The KV cache is a PagedKvCache with a fixed memory budget (kvCacheMb). A request is
+    admitted only when the free blocks hold its prompt plus one growth block per running row;
+    if the pool still runs out during decoding, the most recently admitted row is preempted:
+    its blocks are freed and it goes back to the front of the queue to be decoded again later.
+
+    Decoding is the same as in OcrService._generateBatch: greedy, no_repeat_ngram_size 20,
+    stop at the stop string token.
+    """
+
+    def __init__(self, ocrService, maxBatchSize=8, maxNewTokens=4096, noRepeatNgramSize=20, kvCacheMb=2048, blockSize=16):
+        self.ocrService = ocrService
+        self.model = ocrService.model
+        self.device = ocrService.device
+        self.maxBatchSize = max(1, maxBatchSize)
+        self.maxNewTokens = maxNewTokens
+        self.noRepeatNgramSize = noRepeatNgramSize
+        self.stopStr = ocrService.promptCompiler.stopStr
+        self.stopTokenId = ocrService.tokenizer.convert_tokens_to_ids(self.stopStr)
+
+        config = self.model.config
+        layerCount = config.num_hidden_layers
+        headCount = config.num_key_value_heads
+        headDim = config.hidden_size // config.num_attention_heads
+        blockCount = PagedKvCache.getBlockCount(kvCacheMb, layerCount, headCount, headDim, self.model.dtype, blockSize)
+        self.cache = PagedKvCache(layerCount, headCount, headDim, self.device, self.model.dtype, blockCount, blockSize)
+        self.blockManager = self.cache.blockManager
+        self.waitingQueue = collections.deque()
+        self.runningList = []
+        self.nextSeqId = 0
+        self.stepCount = 0
+        self.preemptCount = 0
+        self.peakBlockCount = 0
+
+    def add(self, ocrInput, maxNewTokens=None):
+        """
+        Queues an OcrInput (see OcrService.prepareInput). It is admitted in a later step.
+        """
+        request = DecodeRequest(ocrInput, maxNewTokens or self.maxNewTokens)
+        self.waitingQueue.append(request)
+        return request
+
+    def hasWork(self):
+        return bool(self.waitingQueue or self.runningList)
+
+    def reset(self):
+        """
+        Drops all queued and running requests and gives their KV cache blocks back, so one
+        scheduler (and its preallocated cache) can be reused for the next run.
+        """
+        self.waitingQueue.clear()
+        self.runningList = []
+        self.cache.reset()
+
+    def step(self):
+        """
+        One scheduler iteration. Returns the requests that finished in it.
+        """
+        finishedList = []
+        with torch.inference_mode(), self.ocrService._getContextManager():
+            while self.waitingQueue and len(self.runningList) < self.maxBatchSize and self._canAdmit(self.waitingQueue[0]):
+                request = self.waitingQueue.popleft()
+                self._prefill(request)
+                self.runningList.append(request)
+            decodeList = self._reserveBlocks([request for request in self.runningList if not request.done])
+            if decodeList:
+                self._decode(decodeList)
+        self.stepCount += 1
+        self.peakBlockCount = max(self.peakBlockCount, self.blockManager.blockCount - self.blockManager.getFreeCount())
+
+        keepList = []
+        for request in self.runningList:
+            if request.done:
+                self.cache.free(request.seqId)
+                request.seqId = None
+                request.blocker = None
+                request.text = self.ocrService._cleanOutput(self.ocrService.tokenizer.decode(request.outputIds), self.stopStr)
+                finishedList.append(request)
+            else:
+                keepList.append(request)
+        self.runningList = keepList
+        return finishedList
+
+    def run(self, ocrInputList):
+        """
+        Decodes all inputs and returns their OCR texts in input order. Starts from an empty
+        scheduler, so requests left over by an earlier run that failed are dropped.
+        """
+        self.reset()
+        requestList = [self.add(ocrInput) for ocrInput in ocrInputList]
+        while self.hasWork():
+            self.step()
+        return [request.text for request in requestList]
+
+    def _canAdmit(self, request):
+        """
+        True when the free blocks hold the prompt and leave one growth block per running row.
+        """
+        promptBlocks = self.blockManager.blocksNeeded(len(request.ocrInput.template.inputIds) + 1)
+        if promptBlocks > self.blockManager.blockCount:
+            raise MemoryError(f"Prompt needs {promptBlocks} KV cache blocks, the pool only has {self.blockManager.blockCount}")
+        return promptBlocks + len(self.runningList) <= self.blockManager.getFreeCount()
+
+    def _reserveBlocks(self, decodeList):
+        """
+        Makes sure every row of the next decode step gets its block, preempting the newest rows if needed.
+        Returns the rows that stay in the step.
+        """
+        while decodeList:
+            needed = sum(self.blockManager.getExtraBlocks(request.seqId, self.cache.getLength(request.seqId) + 1) for request in decodeList)
+            if needed <= self.blockManager.getFreeCount():
+                break
+            if len(decodeList) == 1:
+                raise MemoryError(f"KV cache of {self.blockManager.blockCount} blocks is too small for one sequence, raise kvCacheMb")
+            request = decodeList.pop()
+            self.runningList.remove(request)
+            self.cache.free(request.seqId)
+            # Greedy decoding is deterministic, decoding again from the start gives the same output
+            request.seqId = None
+            request.blocker = None
+            request.outputIds = []
+            self.waitingQueue.appendleft(request)
+            self.preemptCount += 1
+        return decodeList
+
+    def _prefill(self, request):
+        template = request.ocrInput.template
+        request.seqId = self.nextSeqId
+        self.nextSeqId += 1
+        inputIds = template.inputIds.unsqueeze(0).to(self.device)
+        self.cache.bind([request.seqId], inputIds.shape[1])
+        outputs = self.model.model(
+            input_ids=inputIds,
+            attention_mask=self.cache.getAttentionMask(),
+            position_ids=self.cache.getPositionIds(),
+            past_key_values=self.cache,
+            use_cache=True,
+            images=[(None, request.ocrInput.imageTensor.to(self.device))],
+            image_start_positions=torch.as_tensor([template.imageStart], device=self.device),
+            return_dict=True
+        )
+        self.cache.commit()
+        request.blocker = NgramBlocker(self.noRepeatNgramSize, template.inputIds.tolist())
+        self._pickTokens([request], outputs.last_hidden_state[:, -1])
+
+    def _decode(self, requestList):
+        inputIds = torch.as_tensor([[request.outputIds[-1]] for request in requestList], device=self.device)
+        self.cache.bind([request.seqId for request in requestList], 1)
+        outputs = self.model.model(
+            input_ids=inputIds,
+            attention_mask=self.cache.getAttentionMask(),
+            position_ids=self.cache.getPositionIds(),
+            past_key_values=self.cache,
+            use_cache=True,
+            return_dict=True
+        )
+        self.cache.commit()
+        self._pickTokens(requestList, outputs.last_hidden_state[:, -1])
+
+    def _pickTokens(self, requestList, hiddenStates):
+        # Only the last position of each row is projected to the vocabulary (full or restricted, see VocabHead)
+        outputHead = self.ocrService.outputHead
+        logits = outputHead.getLogits(hiddenStates)
+        for row, request in enumerate(requestList):
+            bannedList = outputHead.toIndexList(request.blocker.getBanned())
+            if bannedList:
+                logits[row, bannedList] = float("-inf")
+        # The only host sync of the step
+        tokenList = outputHead.toTokenIds(logits.argmax(dim=-1)).tolist()
+        for request, token in zip(requestList, tokenList):
+            request.outputIds.append(token)
+            request.blocker.append(token)
+            if token == self.stopTokenId or len(request.outputIds) >= request.maxNewTokens:
+                request.done = True
+                request.finishTime = time.perf_counter()
+
+
+if __name__ == "__main__":
+    # Benchmark: continuous batching against the one-at-a-time generate loop on a mixed workload.
+    # Run from the project root: python -m app.code.core.DecodeScheduler [modelDir]
+    import sys
+    from app.code.core.OcrService import OcrService
+    from app.code.utils.BenchTool import BenchTool
+
+    modelDirPath = sys.argv[1] if len(sys.argv) > 1 else "app/code/data/"
+    ocrService = OcrService(modelDirPath)
+    # Short receipts mixed with dense pages
+    pageList = [BenchTool.makeTextPage(lineCount, seed=index) for index, lineCount in enumerate((1, 40, 3, 2, 25, 1, 60, 5))]
+    ocrInputList = [ocrService.prepareInput(page) for page in pageList]
+
+    startTime = time.perf_counter()
+    singleTextList = [ocrService.generateBatch([ocrInput])[0] for ocrInput in ocrInputList]
+    singleTime = time.perf_counter() - startTime
+
+    scheduler = DecodeScheduler(ocrService, maxBatchSize=4)
+    requestList = [scheduler.add(ocrInput) for ocrInput in ocrInputList]
+    startTime = time.perf_counter()
+    while scheduler.hasWork():
+        scheduler.step()
+    continuousTime = time.perf_counter() - startTime
+
+    tokenCount = sum(len(request.outputIds) for request in requestList)
+    sameCount = sum(request.text == text for request, text in zip(requestList, singleTextList))
+    BenchTool.printTable(f"Mixed workload, {len(pageList)} pages, {tokenCount} tokens", ("mode", "seconds", "tokens/s"), [
+        ("one at a time", singleTime, tokenCount / singleTime),
+        ("continuous x4", continuousTime, tokenCount / continuousTime),
+    ])
+    print(f"Same text as one at a time: {sameCount}/{len(pageList)}, scheduler steps: {scheduler.stepCount}")
+    blockMb = scheduler.cache.keyList[0].numel() * scheduler.cache.keyList[0].element_size() * 2 * len(scheduler.cache.keyList) / 1024 / 1024 / scheduler.blockManager.blockCount
+    print(f"KV cache blocks: {scheduler.blockManager.blockCount} in pool, peak used {scheduler.peakBlockCount} "
+          f"({scheduler.peakBlockCount * blockMb:.0f} MB), preempted {scheduler.preemptCount}")
@@ -0,0 +1,148 @@
+import torch
+from app.code.core.KvCache import StaticKvCache
+from app.code.core.DecodeScheduler import NgramBlocker
+
+
+class GreedyDecoder:
+    """
+    Greedy decoding of one OCR request without model.generate.
+
+    OCR always decodes greedily, but model.generate runs its general machinery every step:
+    logits processors over the full sequence, prepare_inputs_for_generation, DynamicCache
+    concatenation and logits of the whole vocabulary for every position at prefill.
+    This loop calls GOTQwenModel directly with a StaticKvCache allocated once, projects only
+    the last hidden state (with ocrService.outputHead, see VocabHead), keeps the step input,
+    position and output ids in preallocated tensors and applies no_repeat_ngram_size
+    incrementally. The only host sync per step is reading the new token for the stop check.
+
+    The tokens are the same as performOcr's generate call: greedy, no_repeat_ngram_size 20,
+    stop at the stop string token or at the model eos token.
+    """
+
+    def __init__(self, ocrService, maxNewTokens=4096, noRepeatNgramSize=20, maxPromptLen=512):
+        self.ocrService = ocrService
+        self.model = ocrService.model
+        self.device = ocrService.device
+        self.maxNewTokens = maxNewTokens
+        self.maxPromptLen = maxPromptLen
+        self.noRepeatNgramSize = noRepeatNgramSize
+        self.stopStr = ocrService.promptCompiler.stopStr
+        self.stopIdSet = {ocrService.tokenizer.convert_tokens_to_ids(self.stopStr), self.model.config.eos_token_id}
+
+        config = self.model.config
+        self.cache = StaticKvCache(
+            config.num_hidden_layers, 1, config.num_key_value_heads, config.hidden_size // config.num_attention_heads,
+            maxPromptLen + maxNewTokens, self.device, self.model.dtype
+        )
+        self.outputBuffer = torch.zeros(maxNewTokens, dtype=torch.long, device=self.device)
+        self.stepInput = torch.zeros((1, 1), dtype=torch.long, device=self.device)
+        self.stepPosition = torch.zeros((1, 1), dtype=torch.long, device=self.device)
+
+    def generate(self, ocrInput):
+        """
+        Returns the generated token ids of one OcrInput, including the stop token.
+        """
+        template = ocrInput.template
+        promptLen = len(template.inputIds)
+        if promptLen > self.maxPromptLen:
+            raise ValueError(f"Prompt of {promptLen} tokens is longer than maxPromptLen {self.maxPromptLen}")
+
+        with torch.inference_mode(), self.ocrService._getContextManager():
+            self.cache.reset()
+            outputs = self.model.model(
+                input_ids=template.inputIds.unsqueeze(0).to(self.device),
+                position_ids=torch.arange(promptLen, device=self.device).unsqueeze(0),
+                past_key_values=self.cache,
+                use_cache=True,
+                images=[(None, ocrInput.imageTensor.to(self.device))],
+                image_start_positions=torch.as_tensor([template.imageStart], device=self.device),
+                return_dict=True
+            )
+            self.cache.advance(promptLen)
+            blocker = NgramBlocker(self.noRepeatNgramSize, template.inputIds.tolist())
+
+            outputHead = self.ocrService.outputHead
+            tokenCount = self.maxNewTokens
+            for step in range(self.maxNewTokens):
+                logits = outputHead.getLogits(outputs.last_hidden_state[:, -1])
+                bannedList = outputHead.toIndexList(blocker.getBanned())
+                if bannedList:
+                    logits[0, bannedList] = float("-inf")
+                token = outputHead.toTokenIds(logits.argmax(dim=-1))
+                self.outputBuffer[step] = token[0]
+                # Stop check, the only host sync of the step
+                tokenId = int(token[0])
+                blocker.append(tokenId)
+                if tokenId in self.stopIdSet:
+                    tokenCount = step + 1
+                    break
+                if step + 1 == self.maxNewTokens:
+                    break
+
+                self.stepInput.copy_(token.view(1, 1))
+                self.stepPosition.fill_(self.cache.length)
+                outputs = self.model.model(
+                    input_ids=self.stepInput,
+                    position_ids=self.stepPosition,
+                    past_key_values=self.cache,
+                    use_cache=True,
+                    return_dict=True
+                )
+                self.cache.advance(1)
+            return self.outputBuffer[:tokenCount].tolist()
+
+    def decode(self, ocrInput):
+        """
+        OCR text of one OcrInput.
+        """
+        outputs = self.ocrService.tokenizer.decode(self.generate(ocrInput))
+        return self.ocrService._cleanOutput(outputs, self.stopStr)
+
+
+if __name__ == "__main__":
+    # Parity and speed: GreedyDecoder against the model.generate call of performOcr.
+    # Run from the project root: python -m app.code.core.GreedyDecoder [modelDir]
+    import sys
+    import time
+    from app.code.core.OcrService import OcrService
+    from app.code.utils.BenchTool import BenchTool
+
+    modelDirPath = sys.argv[1] if len(sys.argv) > 1 else "app/code/data/"
+    ocrService = OcrService(modelDirPath)
+    decoder = GreedyDecoder(ocrService)
+
+    def generateIds(ocrInput):
+        # Same arguments as performOcr, without the streamer
+        template = ocrInput.template
+        inputIds = template.inputIds.unsqueeze(0).to(ocrService.device)
+        with torch.inference_mode(), ocrService._getContextManager():
+            outputIds = ocrService.model.generate(
+                inputIds,
+                images=[(None, ocrInput.imageTensor.to(ocrService.device))],
+                image_start_positions=torch.as_tensor([template.imageStart], device=ocrService.device),
+                do_sample=False,
+                num_beams=1,
+                no_repeat_ngram_size=20,
+                max_new_tokens=4096,
+                eos_token_id=list(decoder.stopIdSet),
+                pad_token_id=ocrService.PAD_TOKEN_ID
+            )
+        return outputIds[0, inputIds.shape[1]:].tolist()
+
+    rowList = []
+    sameCount = 0
+    pageList = [BenchTool.makeTextPage(lineCount, seed=index) for index, lineCount in enumerate((2, 10, 30))]
+    for index, page in enumerate(pageList):
+        ocrInput = ocrService.prepareInput(page)
+        startTime = time.perf_counter()
+        referenceIds = generateIds(ocrInput)
+        generateTime = time.perf_counter() - startTime
+        startTime = time.perf_counter()
+        greedyIds = decoder.generate(ocrInput)
+        greedyTime = time.perf_counter() - startTime
+        same = referenceIds == greedyIds
+        sameCount += same
+        rowList.append((index, len(referenceIds), len(referenceIds) / generateTime, len(greedyIds) / greedyTime, "yes" if same else "NO"))
+
+    BenchTool.printTable("GreedyDecoder vs generate", ("page", "tokens", "generate tok/s", "greedy tok/s", "same ids"), rowList)
+    print(f"Token parity: {sameCount}/{len(pageList)}")
@@ -0,0 +1,269 @@
+import torch
+from transformers.cache_utils import Cache
+
+
+class BlockManager:
+    """
+    Fixed pool of KV cache blocks of blockSize tokens and the block table of every sequence.
+
+    Sequences get blocks when they grow past a block boundary and give all of them back when
+    they finish, so memory use is the number of tokens actually in the cache rounded up to
+    blocks, not maxNewTokens per sequence.
+    """
+
+    def __init__(self, blockCount, blockSize):
+        self.blockCount = blockCount
+        self.blockSize = blockSize
+        self.freeList = list(range(blockCount - 1, -1, -1))
+        self.tableDict = {}   # seqId -> list of block ids
+
+    def reset(self):
+        """
+        Gives every block back to the pool and forgets all sequences.
+        """
+        self.freeList = list(range(self.blockCount - 1, -1, -1))
+        self.tableDict = {}
+
+    def getFreeCount(self):
+        return len(self.freeList)
+
+    def blocksNeeded(self, tokenCount):
+        return (tokenCount + self.blockSize - 1) // self.blockSize
+
+    def getExtraBlocks(self, seqId, tokenCount):
+        """
+        Blocks seqId still needs to hold tokenCount tokens.
+        """
+        return max(0, self.blocksNeeded(tokenCount) - len(self.tableDict.get(seqId, ())))
+
+    def allocate(self, seqId, tokenCount):
+        """
+        Grows the block table of seqId to hold tokenCount tokens.
+        """
+        extra = self.getExtraBlocks(seqId, tokenCount)
+        if extra > len(self.freeList):
+            raise MemoryError(f"KV cache out of blocks: need {extra}, free {len(self.freeList)}")
+        table = self.tableDict.setdefault(seqId, [])
+        for _ in range(extra):
+            table.append(self.freeList.pop())
+        return table
+
+    def free(self, seqId):
+        self.freeList.extend(reversed(self.tableDict.pop(seqId, [])))
+
+
+class PagedKvCache(Cache):
+    """
+    Paged KV cache for the Qwen2 decoder of GOTQwenModel, shared by all running sequences.
+
+    Keys and values of every layer live in one preallocated pool of shape
+    (blockCount * blockSize, heads, headDim); a sequence only owns the blocks in its block
+    table. Every sequence has its own length, so sequences that started at different steps
+    can share one forward call. Before each forward the caller binds the sequences of the
+    batch rows and the number of new tokens (bind), and after it makes the new tokens part of
+    the sequences (commit). During the forward every layer writes the new keys/values of each
+    row into its blocks and returns (B, heads, T, headDim) where T is the longest bound row;
+    shorter rows are masked with getAttentionMask.
+
+    The returned keys/values are a view of a preallocated batch buffer per layer, not a gather
+    of the blocks: as long as the same sequences are bound in the same order (every decode step
+    between two admissions or evictions), only the new tokens are written into it. It is filled
+    from the blocks again when the batch changes, and grows in steps when it gets too small.
+    It holds the keys/values of the running batch a second time.
+    """
+
+    def __init__(self, layerCount, headCount, headDim, device, dtype, blockCount, blockSize=16):
+        super().__init__()
+        self.layerCount = layerCount
+        self.headCount = headCount
+        self.headDim = headDim
+        self.device = device
+        self.dtype = dtype
+        self.blockManager = BlockManager(blockCount, blockSize)
+        poolSize = blockCount * blockSize
+        self.keyList = [torch.zeros(poolSize, headCount, headDim, device=device, dtype=dtype) for _ in range(layerCount)]
+        self.valueList = [torch.zeros(poolSize, headCount, headDim, device=device, dtype=dtype) for _ in range(layerCount)]
+        self.lengthDict = {}  # seqId -> tokens in the cache
+        # Batch buffers (rows, heads, length, headDim) per layer and the sequences they hold, in row order
+        self.viewKeyList = []
+        self.viewValueList = []
+        self.viewSeqs = None
+
+        self.boundSeqs = None
+        self.boundLen = 0
+        self.pastLen = 0
+
+    @staticmethod
+    def getBlockCount(memoryMb, layerCount, headCount, headDim, dtype, blockSize=16):
+        """
+        Number of blocks that fit in a memory budget (keys and values of all layers).
+        """
+        elementSize = torch.tensor([], dtype=dtype).element_size()
+        blockBytes = layerCount * 2 * blockSize * headCount * headDim * elementSize
+        return max(1, int(memoryMb * 1024 * 1024 // blockBytes))
+
+    def getLength(self, seqId):
+        return self.lengthDict.get(seqId, 0)
+
+    def bind(self, seqList, newLen):
+        """
+        Sets the sequences (one per batch row, in row order) and the number of new tokens of the
+        next forward, and allocates the blocks the new tokens need (MemoryError if the pool is full).
+        More than one new token (prefill) is only supported for rows of the same length.
+        """
+        blockSize = self.blockManager.blockSize
+        lengthList = [self.getLength(seqId) for seqId in seqList]
+        self.boundSeqs = list(seqList)
+        self.boundLen = newLen
+        self.pastLen = max(lengthList)
+        total = self.pastLen + newLen
+
+        maxBlocks = self.blockManager.blocksNeeded(total)
+        writeRows = []
+        tableRows = []
+        for seqId, length in zip(seqList, lengthList):
+            table = self.blockManager.allocate(seqId, length + newLen)
+            writeRows.append([table[pos // blockSize] * blockSize + pos % blockSize for pos in range(length, length + newLen)])
+            # Blocks past the row's end point to block 0, those positions are masked anyway
+            tableRows.append(table + [0] * (maxBlocks - len(table)))
+        self._writeIndex = torch.as_tensor(writeRows, device=self.device).flatten()
+        self._posIndex = torch.as_tensor(lengthList, device=self.device)
+        # Batch buffer coordinates of the new tokens, in the row order of _writeIndex
+        self._rowIndex = torch.arange(len(seqList), device=self.device).repeat_interleave(newLen)
+        self._colIndex = (self._posIndex.unsqueeze(1) + torch.arange(newLen, device=self.device)).flatten()
+
+        self._refillView = self.boundSeqs != self.viewSeqs
+        if not self.viewKeyList or len(seqList) > self.viewKeyList[0].shape[0] or total > self.viewKeyList[0].shape[2]:
+            self._allocateView(len(seqList), total)
+            self._refillView = True
+        if self._refillView:
+            # Only needed to fill the batch buffer from the blocks
+            positions = torch.arange(total, device=self.device)
+            tableTensor = torch.as_tensor(tableRows, device=self.device)
+            self._readIndex = (tableTensor[:, positions // blockSize] * blockSize + positions % blockSize).flatten()
+        # Set here, so a forward that fails after bind leaves the buffer to be filled again
+        self.viewSeqs = None
+
+    def _allocateView(self, rowCount, length):
+        """
+        (Re)allocates the batch buffers for at least rowCount rows of length tokens. The length
+        grows by doubling (in whole blocks, at most the pool size), so this happens a few times per run.
+        """
+        blockSize = self.blockManager.blockSize
+        poolSize = self.blockManager.blockCount * blockSize
+        if self.viewKeyList:
+            rowCount = max(rowCount, self.viewKeyList[0].shape[0])
+            length = max(length, min(poolSize, 2 * self.viewKeyList[0].shape[2]))
+        length = self.blockManager.blocksNeeded(length) * blockSize
+        shape = (rowCount, self.headCount, length, self.headDim)
+        self.viewKeyList = [torch.zeros(shape, device=self.device, dtype=self.dtype) for _ in range(self.layerCount)]
+        self.viewValueList = [torch.zeros(shape, device=self.device, dtype=self.dtype) for _ in range(self.layerCount)]
+
+    def commit(self):
+        for seqId in self.boundSeqs:
+            self.lengthDict[seqId] = self.getLength(seqId) + self.boundLen
+        # Every layer wrote the new tokens into the batch buffers, they hold the bound sequences
+        self.viewSeqs = self.boundSeqs
+
+    def getAttentionMask(self):
+        """
+        (B, pastLen + newLen) mask of the bound rows: 1 for filled and new positions of each row.
+        """
+        total = self.pastLen + self.boundLen
+        limit = self._posIndex + self.boundLen
+        return (torch.arange(total, device=self.device).unsqueeze(0) < limit.unsqueeze(1)).long()
+
+    def getPositionIds(self):
+        """
+        (B, newLen) positions of the new tokens of each bound row.
+        """
+        return self._posIndex.unsqueeze(1) + torch.arange(self.boundLen, device=self.device).unsqueeze(0)
+
+    def free(self, seqId):
+        self.blockManager.free(seqId)
+        self.lengthDict.pop(seqId, None)
+
+    def reset(self):
+        """
+        Empties the cache for reuse; the pool tensors are kept and never cleared, only filled
+        positions are read.
+        """
+        self.blockManager.reset()
+        self.lengthDict = {}
+        self.viewSeqs = None
+        self.boundSeqs = None
+        self.boundLen = 0
+        self.pastLen = 0
+
+    def update(self, key_states, value_states, layer_idx, cache_kwargs=None):
+        keyPool = self.keyList[layer_idx]
+        valuePool = self.valueList[layer_idx]
+        viewKey = self.viewKeyList[layer_idx]
+        viewValue = self.viewValueList[layer_idx]
+        rowCount = len(self.boundSeqs)
+        total = self.pastLen + self.boundLen
+        # (B, heads, newLen, headDim) -> (B * newLen, heads, headDim), the row order of _writeIndex
+        newKeys = key_states.transpose(1, 2).reshape(-1, self.headCount, self.headDim).to(self.dtype)
+        newValues = value_states.transpose(1, 2).reshape(-1, self.headCount, self.headDim).to(self.dtype)
+        keyPool.index_copy_(0, self._writeIndex, newKeys)
+        valuePool.index_copy_(0, self._writeIndex, newValues)
+        if self._refillView:
+            # Other sequences than in the last forward: fill the batch buffer from the blocks once
+            viewKey[:rowCount, :, :total] = keyPool[self._readIndex].view(rowCount, total, self.headCount, self.headDim).transpose(1, 2)
+            viewValue[:rowCount, :, :total] = valuePool[self._readIndex].view(rowCount, total, self.headCount, self.headDim).transpose(1, 2)
+        else:
+            # Same sequences: only the new tokens are written, the earlier ones are already there
+            viewKey.transpose(1, 2).index_put_((self._rowIndex, self._colIndex), newKeys)
+            viewValue.transpose(1, 2).index_put_((self._rowIndex, self._colIndex), newValues)
+        return viewKey[:rowCount, :, :total], viewValue[:rowCount, :, :total]
+
+    def get_seq_length(self, layer_idx=0):
+        # Same for every layer during one forward, the new tokens are only counted after commit
+        return self.pastLen
+
+    def get_max_length(self):
+        return None
+
+    def get_max_cache_shape(self):
+        return None
+
+
+class StaticKvCache(Cache):
+    """
+    Preallocated KV cache of maxLen tokens for a batch whose rows all have the same length.
+
+    update writes the new keys/values after the current length and returns a view of the
+    filled part, so nothing is allocated or concatenated per step. The caller moves the
+    length forward after each forward (advance) and resets it for the next request (reset);
+    old contents are never read, so the buffers are not cleared.
+    """
+
+    def __init__(self, layerCount, batchSize, headCount, headDim, maxLen, device, dtype):
+        super().__init__()
+        self.maxLen = maxLen
+        self.keyList = [torch.zeros(batchSize, headCount, maxLen, headDim, device=device, dtype=dtype) for _ in range(layerCount)]
+        self.valueList = [torch.zeros(batchSize, headCount, maxLen, headDim, device=device, dtype=dtype) for _ in range(layerCount)]
+        self.length = 0
+
+    def reset(self):
+        self.length = 0
+
+    def advance(self, count):
+        self.length += count
+
+    def update(self, key_states, value_states, layer_idx, cache_kwargs=None):
+        end = self.length + key_states.shape[2]
+        if end > self.maxLen:
+            raise ValueError(f"Static KV cache is full: {end} > {self.maxLen} tokens")
+        self.keyList[layer_idx][:, :, self.length:end] = key_states
+        self.valueList[layer_idx][:, :, self.length:end] = value_states
+        return self.keyList[layer_idx][:, :, :end], self.valueList[layer_idx][:, :, :end]
+
+    def get_seq_length(self, layer_idx=0):
+        return self.length
+
+    def get_max_length(self):
+        return None
+
+    def get_max_cache_shape(self):
+        return None
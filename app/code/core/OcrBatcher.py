@@ -0,0 +1,86 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from app.code.utils.LogTool import LogTool
+
+
+class OcrBatcher:
+    """
+    Collects concurrent OCR requests into micro-batches for one OcrService.
+
+    Requests are preprocessed in a thread pool (prepareInput), then wait in a queue. The batch
+    loop takes the first waiting request and keeps collecting until maxBatchSize requests are
+    there or maxWaitMs has passed since the first one, then runs generateBatch on a single
+    model thread. A lone request waits at most maxWaitMs; under load the batches fill up.
+    """
+
+    def __init__(self, ocrService, maxBatchSize=4, maxWaitMs=20, preprocessWorkers=2):
+        self.ocrService = ocrService
+        self.maxBatchSize = max(1, maxBatchSize)
+        self.maxWaitMs = max(0, maxWaitMs)
+        self.preprocessExecutor = ThreadPoolExecutor(max_workers=max(1, preprocessWorkers), thread_name_prefix="ocr-preprocess")
+        # One thread, so generate calls never overlap
+        self.modelExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ocr-model")
+        self.requestQueue = None
+        self.batchTask = None
+        self.batchCount = 0
+        self.itemCount = 0
+
+    async def start(self):
+        self.requestQueue = asyncio.Queue()
+        self.batchTask = asyncio.create_task(self._batchLoop())
+
+    async def stop(self):
+        if self.batchTask is not None:
+            self.batchTask.cancel()
+            try:
+                await self.batchTask
+            except asyncio.CancelledError:
+                pass
+        self.preprocessExecutor.shutdown(wait=False)
+        self.modelExecutor.shutdown(wait=True)
+
+    async def submit(self, image, ocrType="plain", box=None, color=None):
+        """
+        OCR of one image (PIL image, path or encoded image bytes). Returns the result text once its batch is done.
+        """
+        loop = asyncio.get_running_loop()
+        ocrInput = await loop.run_in_executor(self.preprocessExecutor, self.ocrService.prepareInput, image, ocrType, box, color)
+        future = loop.create_future()
+        await self.requestQueue.put((ocrInput, future))
+        return await future
+
+    async def _batchLoop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.requestQueue.get()]
+            deadline = time.perf_counter() + self.maxWaitMs / 1000
+            while len(batch) < self.maxBatchSize:
+                timeLeft = deadline - time.perf_counter()
+                if timeLeft <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.requestQueue.get(), timeLeft))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                resultList = await loop.run_in_executor(self.modelExecutor, self.ocrService.generateBatch, [ocrInput for ocrInput, _ in batch])
+                for (_, future), result in zip(batch, resultList):
+                    if not future.done():
+                        future.set_result(result)
+            except Exception as e:
+                LogTool.error(f"OCR batch of {len(batch)} failed: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            self.batchCount += 1
+            self.itemCount += len(batch)
+
+    def getStats(self):
+        return {
+            "batchCount": self.batchCount,
+            "itemCount": self.itemCount,
+            "avgBatchSize": self.itemCount / self.batchCount if self.batchCount else 0.0,
+        }
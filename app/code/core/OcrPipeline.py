@@ -0,0 +1,299 @@
+import queue
+import threading
+import time
+
+from app.code.utils.LogTool import LogTool
+from app.code.utils.FileTool import FileTool
+
+
+class StageStats:
+    """Counters of one pipeline stage, shared by all threads of the stage."""
+
+    def __init__(self, name):
+        self.name = name
+        self.itemCount = 0
+        self.busyTime = 0.0   # time spent doing work
+        self.waitTime = 0.0   # time waiting for input
+        self.blockTime = 0.0  # time waiting for room in the next queue
+        self.threadCount = 0
+        self._lock = threading.Lock()
+
+    def add(self, itemCount=0, busyTime=0.0, waitTime=0.0, blockTime=0.0):
+        with self._lock:
+            self.itemCount += itemCount
+            self.busyTime += busyTime
+            self.waitTime += waitTime
+            self.blockTime += blockTime
+
+
+class PipelineItem:
+    """One page of work moving through the pipeline."""
+
+    def __init__(self, docPath, docType, pageNumber, image):
+        self.docPath = docPath
+        self.docType = docType
+        self.pageNumber = pageNumber
+        self.image = image
+        self.ocrInput = None
+        self.result = None
+        self.error = None
+
+
+class OcrPipeline:
+    """
+    Runs OCR over a file list as a chain of stages joined by bounded queues, so the model
+    does not sit idle while files are decoded, PDF pages are rendered or results are written:
+
+        load (N threads) -> preprocess (M threads) -> model (1 thread, batches) -> writer (1 thread)
+
+    Every stage records item count, busy time, input wait time and output block time.
+    The stage with the highest busy share is the bottleneck; when the model stage is busy
+    close to 100% of the wall time, throughput is at pure model throughput.
+    """
+
+    _STOP = object()
+
+    def __init__(self, ocrService, writeResult, ocrType="plain", batchSize=1, loadWorkers=2,
+                 preprocessWorkers=2, queueSize=8, pageRange=None, renderWorkers=0):
+        """
+        Args:
+            ocrService (OcrService): Loaded OCR service.
+            writeResult (callable): Called with one output dict per finished file.
+            ocrType (str): OCR type for all files.
+            batchSize (int): Max pages per model call.
+            loadWorkers (int): Threads decoding images and rendering PDFs.
+            preprocessWorkers (int): Threads turning pages into model inputs.
+            queueSize (int): Capacity of each queue between stages.
+            pageRange (str): 1-based PDF page range, e.g. '1-3,7'; None for all pages.
+            renderWorkers (int): Render processes per PDF (0 renders in the load thread).
+        """
+        self.ocrService = ocrService
+        self.writeResult = writeResult
+        self.ocrType = ocrType
+        self.batchSize = max(1, batchSize)
+        self.loadWorkers = max(1, loadWorkers)
+        self.preprocessWorkers = max(1, preprocessWorkers)
+        self.queueSize = max(1, queueSize)
+        self.pageRange = pageRange
+        self.renderWorkers = renderWorkers
+        self.imageExtensions = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp')
+
+        self.statsList = [StageStats("load"), StageStats("preprocess"), StageStats("model"), StageStats("writer")]
+        self.loadStats, self.preprocessStats, self.modelStats, self.writerStats = self.statsList
+
+    def run(self, fileList):
+        """
+        Processes every file and returns once all results are written.
+        """
+        fileQueue = queue.Queue()
+        pageQueue = queue.Queue(maxsize=self.queueSize)
+        inputQueue = queue.Queue(maxsize=self.queueSize)
+        resultQueue = queue.Queue(maxsize=self.queueSize)
+
+        for filePath in fileList:
+            fileQueue.put(filePath)
+        for _ in range(self.loadWorkers):
+            fileQueue.put(self._STOP)
+
+        startTime = time.perf_counter()
+        loadThreads = self._startThreads(self.loadWorkers, self._loadLoop, (fileQueue, pageQueue, resultQueue), self.loadStats)
+        preprocessThreads = self._startThreads(self.preprocessWorkers, self._preprocessLoop, (pageQueue, inputQueue, resultQueue), self.preprocessStats)
+        modelThreads = self._startThreads(1, self._modelLoop, (inputQueue, resultQueue), self.modelStats)
+        writerThreads = self._startThreads(1, self._writerLoop, (resultQueue,), self.writerStats)
+
+        # Close the stages one after another, each stage gets one stop marker per thread
+        self._joinThreads(loadThreads, pageQueue, len(preprocessThreads))
+        self._joinThreads(preprocessThreads, inputQueue, 1)
+        self._joinThreads(modelThreads, resultQueue, 1)
+        self._joinThreads(writerThreads, None, 0)
+
+        self._logStats(time.perf_counter() - startTime)
+
+    def _startThreads(self, count, target, args, stats):
+        threadList = []
+        stats.threadCount = count
+        for index in range(count):
+            thread = threading.Thread(target=target, args=args, name=f"ocr-{stats.name}-{index}", daemon=True)
+            thread.start()
+            threadList.append(thread)
+        return threadList
+
+    def _joinThreads(self, threadList, nextQueue, stopCount):
+        for thread in threadList:
+            thread.join()
+        for _ in range(stopCount):
+            nextQueue.put(self._STOP)
+
+    def _timedGet(self, inputQueue, stats):
+        waitStart = time.perf_counter()
+        item = inputQueue.get()
+        stats.add(waitTime=time.perf_counter() - waitStart)
+        return item
+
+    def _timedPut(self, outputQueue, item, stats):
+        blockStart = time.perf_counter()
+        outputQueue.put(item)
+        stats.add(blockTime=time.perf_counter() - blockStart)
+
+    def _loadLoop(self, fileQueue, pageQueue, resultQueue):
+        stats = self.loadStats
+        while True:
+            filePath = self._timedGet(fileQueue, stats)
+            if filePath is self._STOP:
+                return
+            try:
+                if filePath.lower().endswith(self.imageExtensions):
+                    LogTool.info(f"Performing OCR on image: {filePath} with ocrtype: {self.ocrType}")
+                    # Tell the writer how many pages to expect before the pages arrive
+                    self._timedPut(resultQueue, ("total", filePath, "image", 1), stats)
+                    busyStart = time.perf_counter()
+                    image, _ = self.ocrService._loadImage(filePath)
+                    stats.add(itemCount=1, busyTime=time.perf_counter() - busyStart)
+                    self._timedPut(pageQueue, PipelineItem(filePath, "image", 0, image), stats)
+                else:
+                    LogTool.info(f"Performing OCR on PDF: {filePath}")
+                    self._loadPdf(filePath, pageQueue, resultQueue)
+            except Exception as e:
+                LogTool.error(f"Error processing {filePath}: {e}")
+                self._timedPut(resultQueue, ("failed", filePath, None, 0), stats)
+
+    def _loadPdf(self, filePath, pageQueue, resultQueue):
+        stats = self.loadStats
+        pageCount = FileTool.getPdfPageCount(filePath)
+        if pageCount == 0:
+            raise ValueError(f"Could not convert PDF {filePath} to images.")
+        pageNumbers = FileTool.parsePageRange(self.pageRange, pageCount)
+        LogTool.info(f"--- OCR Result (PDF: {len(pageNumbers)} of {pageCount} pages) ---")
+
+        if self.renderWorkers > 0:
+            pageIter = FileTool.iterPdfImagesParallel(filePath, pageNumbers, targetSize=self.ocrService.IMAGE_SIZE, workerCount=self.renderWorkers)
+        else:
+            pageIter = FileTool.iterPdfImages(filePath, pageNumbers, targetSize=self.ocrService.IMAGE_SIZE)
+
+        renderedCount = 0
+        busyStart = time.perf_counter()
+        for pageNumber, image in pageIter:
+            stats.add(itemCount=1, busyTime=time.perf_counter() - busyStart)
+            self._timedPut(pageQueue, PipelineItem(filePath, "pdf", pageNumber, image), stats)
+            renderedCount += 1
+            busyStart = time.perf_counter()
+        # The render iterators skip pages that fail; like OcrWorkerPool, a PDF with a missing page fails as a whole
+        # instead of being written without it. _loadLoop turns the error into a "failed" message.
+        if renderedCount != len(pageNumbers):
+            raise ValueError(f"Only {renderedCount} of {len(pageNumbers)} pages could be rendered")
+        self._timedPut(resultQueue, ("total", filePath, "pdf", renderedCount), stats)
+
+    def _preprocessLoop(self, pageQueue, inputQueue, resultQueue):
+        stats = self.preprocessStats
+        while True:
+            item = self._timedGet(pageQueue, stats)
+            if item is self._STOP:
+                return
+            busyStart = time.perf_counter()
+            try:
+                item.ocrInput = self.ocrService.prepareInput(item.image, ocrType=self.ocrType)
+                item.image = None
+                nextQueue = inputQueue
+            except Exception as e:
+                item.error = e
+                nextQueue = resultQueue
+            stats.add(itemCount=1, busyTime=time.perf_counter() - busyStart)
+            self._timedPut(nextQueue, item, stats)
+
+    def _modelLoop(self, inputQueue, resultQueue):
+        stats = self.modelStats
+        stopped = False
+        while not stopped:
+            item = self._timedGet(inputQueue, stats)
+            if item is self._STOP:
+                return
+            # Take whatever else is already waiting, up to the batch size
+            batch = [item]
+            while len(batch) < self.batchSize:
+                try:
+                    item = inputQueue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stopped = True
+                    break
+                batch.append(item)
+
+            busyStart = time.perf_counter()
+            try:
+                resultList = self.ocrService.generateBatch([item.ocrInput for item in batch])
+                for item, result in zip(batch, resultList):
+                    item.result = result
+            except Exception as e:
+                for item in batch:
+                    item.error = e
+            stats.add(itemCount=len(batch), busyTime=time.perf_counter() - busyStart)
+            for item in batch:
+                item.ocrInput = None
+                self._timedPut(resultQueue, item, stats)
+
+    def _writerLoop(self, resultQueue):
+        stats = self.writerStats
+        docDict = {}  # docPath -> {"type", "total", "pages"}
+        failedSet = set()
+        while True:
+            message = self._timedGet(resultQueue, stats)
+            if message is self._STOP:
+                break
+            busyStart = time.perf_counter()
+            if isinstance(message, tuple):
+                kind, docPath, docType, total = message
+            else:
+                kind, docPath, docType, total = "page", message.docPath, message.docType, None
+                if message.error is not None:
+                    LogTool.error(f"Error processing {docPath}: {message.error}")
+                    kind = "failed"
+
+            if docPath in failedSet:
+                pass
+            elif kind == "failed":
+                # Same as the sequential CLI: a file with a failed page is not written
+                failedSet.add(docPath)
+                docDict.pop(docPath, None)
+            else:
+                doc = docDict.setdefault(docPath, {"type": docType, "total": None, "pages": []})
+                if kind == "total":
+                    doc["total"] = total
+                else:
+                    doc["pages"].append((message.pageNumber, message.result))
+                if doc["total"] is not None and len(doc["pages"]) >= doc["total"]:
+                    del docDict[docPath]
+                    self._writeDoc(docPath, doc)
+                    stats.add(itemCount=1)
+            stats.add(busyTime=time.perf_counter() - busyStart)
+
+        for docPath in docDict:
+            LogTool.error(f"OCR did not finish for {docPath}")
+
+    def _writeDoc(self, docPath, doc):
+        if doc["type"] == "image":
+            outputData = {"input_path": docPath, "type": "image", "ocr_result": doc["pages"][0][1]}
+        else:
+            pageList = sorted(doc["pages"], key=lambda page: page[0])
+            outputData = {"input_path": docPath, "type": "pdf",
+                          "pages": [{"page": pageNumber + 1, "ocr_result": result} for pageNumber, result in pageList]}
+        try:
+            self.writeResult(outputData)
+        except Exception as e:
+            LogTool.error(f"Failed to write result of {docPath}: {e}")
+
+    def _logStats(self, wallTime):
+        LogTool.info(f"=== Pipeline stats (wall {wallTime:.2f}s) ===")
+        bottleneck = None
+        bottleneckShare = -1.0
+        for stats in self.statsList:
+            # Busy share of the stage: busy time over the time all its threads were available
+            share = stats.busyTime / (wallTime * stats.threadCount) if wallTime > 0 and stats.threadCount else 0.0
+            LogTool.info(f"{stats.name:<10} threads={stats.threadCount} items={stats.itemCount} busy={stats.busyTime:.2f}s "
+                         f"wait={stats.waitTime:.2f}s block={stats.blockTime:.2f}s busyShare={share:.0%}")
+            if share > bottleneckShare:
+                bottleneck, bottleneckShare = stats.name, share
+        if self.modelStats.itemCount:
+            LogTool.info(f"Model throughput: {self.modelStats.itemCount / max(self.modelStats.busyTime, 1e-9):.3f} pages/s (model only), "
+                         f"{self.modelStats.itemCount / max(wallTime, 1e-9):.3f} pages/s (end to end)")
+        LogTool.info(f"Bottleneck stage: {bottleneck}")
@@ -1,17 +1,44 @@
 import os
 import requests
 from PIL import Image
+from PIL.JpegImagePlugin import JpegImageFile
 from io import BytesIO
 import torch
 from transformers import AutoTokenizer, TextStreamer
-from app.code.utils.ocr_internal.conversation import conv_templates, SeparatorStyle
 from app.code.utils.ocr_internal.utils import disable_torch_init, KeywordsStoppingCriteria
 from app.code.core.ocr_model import GOTQwenForCausalLM
-from app.code.core.plug.blip_process import BlipImageEvalProcessor
+from app.code.core.plug.blip_process import BlipImageEvalProcessor, BlipImageFastEvalProcessor
+from app.code.core.PromptCompiler import PromptCompiler, PromptTemplate
+from app.code.core.DecodeScheduler import DecodeScheduler
+from app.code.core.GreedyDecoder import GreedyDecoder
+from app.code.core.VocabHead import VocabHead
+from app.code.core.VisionCompiler import VisionCompiler
+from app.code.core.OnnxVisionEncoder import OnnxVisionEncoder
+from app.code.core.QuantLinear import DecoderQuantizer
+from app.code.utils.WeightTool import WeightTool
 from contextlib import nullcontext
+import dataclasses
+
+
+@dataclasses.dataclass
+class OcrInput:
+    """A preprocessed OCR request: prompt template and the (1, 3, S, S) image tensor on CPU."""
+    template: PromptTemplate
+    imageTensor: torch.Tensor
+
 
 class OcrService:
-    def __init__(self, modelName):
+    def __init__(self, modelName, weightsFile=None, quantMode=None, quantLmHead=False):
+        """
+        Args:
+            modelName (str): Model directory with config, tokenizer and checkpoint.
+            weightsFile (str): Optional dtype-final safetensors file (see WeightTool). It is
+                memory-mapped instead of loaded, so processes using the same file share the weights.
+            quantMode (str): Optional weight-only quantization of the decoder Linear layers,
+                "int8" or "int4" (see DecoderQuantizer). The quantized weights are created once
+                in the model directory and memory-mapped at later starts; weightsFile is ignored.
+            quantLmHead (bool): With quantMode, quantize lm_head too.
+        """
         disable_torch_init()
         self.modelName = os.path.expanduser(modelName)
 
@@ -25,17 +52,27 @@ class OcrService:
             self.device = 'cpu'
             self.dtype = torch.float32 # Use float32 for CPU
 
-        self.model = GOTQwenForCausalLM.from_pretrained(
-            self.modelName,
-            low_cpu_mem_usage=True,
-            device_map=self.device, 
-            use_safetensors=True,
-            pad_token_id=151643
-        ).eval()
-        self.model.to(device=self.device, dtype=self.dtype)
-
-        self.imageProcessor = BlipImageEvalProcessor(image_size=1024)
-        self.imageProcessorHigh = BlipImageEvalProcessor(image_size=1024)
+        if quantMode:
+            quantPath = DecoderQuantizer.ensureQuantized(GOTQwenForCausalLM, self.modelName, quantMode,
+                                                         quantLmHead=quantLmHead, pad_token_id=151643)
+            self.model = DecoderQuantizer.loadQuantized(GOTQwenForCausalLM, self.modelName, quantPath, quantMode,
+                                                        quantLmHead=quantLmHead, pad_token_id=151643)
+            self.model.to(device=self.device, dtype=self.dtype)
+        elif weightsFile:
+            # Already in self.dtype; on CPU .to() is a no-op and the weights stay mapped
+            self.model = WeightTool.loadMmapModel(GOTQwenForCausalLM, self.modelName, weightsFile, pad_token_id=151643)
+            self.model.to(device=self.device, dtype=self.dtype)
+        else:
+            self.model = GOTQwenForCausalLM.from_pretrained(
+                self.modelName,
+                low_cpu_mem_usage=True,
+                device_map=self.device, 
+                use_safetensors=True,
+                pad_token_id=151643
+            ).eval()
+            self.model.to(device=self.device, dtype=self.dtype)
+        # Rel-pos tables and the fused channels-last neck of the vision tower, once the weights are in place
+        self.model.model.vision_tower_high.optimize_for_inference()
 
         # Constants from run_ocr_2.0.py
         self.DEFAULT_IMAGE_TOKEN = "<image>"
@@ -43,27 +80,68 @@ class OcrService:
         self.DEFAULT_IM_START_TOKEN = '<img>'
         self.DEFAULT_IM_END_TOKEN = '</img>'
         self.IMAGE_TOKEN_LEN = 256 # Hardcoded from run_ocr_2.0.py
+        self.IMAGE_SIZE = 1024 # Input size of the vision tower
+        self.PAD_TOKEN_ID = 151643 # <|endoftext|>, same as pad_token_id of the model
+
+        # Only the high res tensor is read by GOTQwenModel.forward, so one processor is enough
+        self.imageProcessorHigh = BlipImageFastEvalProcessor(image_size=self.IMAGE_SIZE)
+
+        # Prompt token ids are built once per query text instead of tokenizing 256 <imgpad> every call
+        self.promptCompiler = PromptCompiler(self.tokenizer, imageTokenLen=self.IMAGE_TOKEN_LEN)
+
+        # Single-page decoder with a static KV cache, created on first use and reused
+        self._greedyDecoder = None
+        # Continuous batching scheduler with its paged KV cache pool, same
+        self._decodeScheduler = None
+        # Batches of several inputs are decoded by the scheduler (generateContinuous); False runs
+        # them as one static model.generate batch instead (_generateBatch), e.g. to compare the two
+        self.continuousBatching = True
+        # Output projection of the decode loops, full vocabulary unless setVocabScripts is called
+        self.outputHead = VocabHead(self.model.lm_head)
 
     def _loadImage(self, imageInput):
         """
-        Loads an image from a file path or returns it if it's already a PIL Image.
+        Loads an image from a file path or encoded bytes, or returns it if it's already a PIL Image.
+        Returns the image and its original (w, h); box coordinates refer to the original size.
         """
         if isinstance(imageInput, Image.Image):
-            return imageInput
+            return imageInput, imageInput.size
+        elif isinstance(imageInput, (bytes, bytearray)):
+            image = Image.open(BytesIO(imageInput))
         elif isinstance(imageInput, str):
             if imageInput.startswith('http') or imageInput.startswith('https'):
                 response = requests.get(imageInput)
-                image = Image.open(BytesIO(response.content)).convert('RGB')
+                image = Image.open(BytesIO(response.content))
             else:
-                image = Image.open(imageInput).convert('RGB')
-            return image
+                image = Image.open(imageInput)
         else:
-            raise ValueError("imageInput must be a file path (str) or a PIL Image object.")
+            raise ValueError("imageInput must be a file path (str), encoded image bytes or a PIL Image object.")
+        originalSize = image.size
+        return self._decodeReduced(image, self.IMAGE_SIZE), originalSize
 
-    def performOcr(self, imageInput, ocrType="plain", box=None, color=None):
-        image = self._loadImage(imageInput)
-        w, h = image.size
+    @staticmethod
+    def _decodeReduced(image, targetSize):
+        """
+        Decodes an opened image at the smallest scale that still keeps both sides >= targetSize.
+        The final bicubic resize to the model input size is done later by the image processor.
+        """
+        # Phone photos are often MPO (JPEG with extra frames), a JpegImageFile subclass with the same draft
+        if isinstance(image, JpegImageFile):
+            # JPEG can decode at 1/2, 1/4 or 1/8 scale directly; draft picks the smallest scale
+            # that stays >= the requested size, so the full resolution is never decoded
+            image.draft('RGB', (targetSize, targetSize))
+            return image.convert('RGB')
 
+        factor = min(image.size[0] // targetSize, image.size[1] // targetSize)
+        if factor >= 2 and image.mode in ('RGB', 'RGBA', 'L', 'LA'):
+            # Other formats are fully decoded, but shrinking before convert keeps later copies small
+            image = image.reduce(factor)
+        return image.convert('RGB')
+
+    def _buildQuery(self, ocrType, box, color, w, h):
+        """
+        Builds the user query text for one image, including the optional box and color hints.
+        """
         if ocrType == 'format':
             qs = 'OCR with format: '
         else:
@@ -84,49 +162,279 @@ class OcrService:
         if color:
             qs = '[' + color + ']' + ' ' + qs
 
-        # Use_im_start_end is set to True in ocr_model.py
-        qs = self.DEFAULT_IM_START_TOKEN + self.DEFAULT_IMAGE_PATCH_TOKEN * self.IMAGE_TOKEN_LEN + self.DEFAULT_IM_END_TOKEN + '\n' + qs
+        return qs
+
+    def _prepareImage(self, image):
+        """
+        Turns a PIL image into the (low res, high res) pair expected by the model.
+        GOTQwenModel.forward only reads the high res slot, so the low res slot is left as None
+        instead of building a second 1024x1024 tensor for nothing.
+        """
+        image_tensor_1 = self.imageProcessorHigh(image) # High res image processor
+        return (None, image_tensor_1.unsqueeze(0).to(self.device))
+
+    def _cleanOutput(self, outputs, stop_str):
+        outputs = outputs.strip()
+        if outputs.endswith(stop_str):
+            outputs = outputs[:-len(stop_str)]
+        return outputs.strip()
+
+    def _getContextManager(self):
+        # Use torch.autocast only for CUDA, otherwise run without it
+        if self.device == 'cuda':
+            return torch.autocast(self.device, dtype=self.dtype)
+        # For CPU, just use a dummy context manager
+        return nullcontext()
+
+    def performOcr(self, imageInput, ocrType="plain", box=None, color=None):
+        if self.outputHead.restricted:
+            # generate always projects the full vocabulary, the decode loops of generateBatch use the restricted head
+            return self.generateBatch([self.prepareInput(imageInput, ocrType, box, color)])[0]
+        image, (w, h) = self._loadImage(imageInput)
 
-        conv_mode = "mpt"
-        conv = conv_templates[conv_mode].copy()
-        conv.append_message(conv.roles[0], qs)
-        conv.append_message(conv.roles[1], None)
-        prompt = conv.get_prompt()
+        qs = self._buildQuery(ocrType, box, color, w, h)
+        template = self.promptCompiler.compile(qs)
+        stop_str = template.stopStr
 
-        inputs = self.tokenizer([prompt])
-        image_1 = image.copy() # Seems redundant, but keeping consistent with original
-        image_tensor = self.imageProcessor(image)
-        image_tensor_1 = self.imageProcessorHigh(image_1) # High res image processor
+        imageTuple = self._prepareImage(image)
 
-        input_ids = torch.as_tensor(inputs.input_ids).to(self.device)
+        input_ids = template.inputIds.unsqueeze(0).to(self.device)
+        image_start_positions = torch.as_tensor([template.imageStart], device=self.device)
 
-        stop_str = conv.sep if conv.sep_style != SeparatorStyle.TWO else conv.sep2
         keywords = [stop_str]
         stopping_criteria = KeywordsStoppingCriteria(keywords, self.tokenizer, input_ids)
         streamer = TextStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
 
-        # Use torch.autocast only for CUDA, otherwise run without it
-        if self.device == 'cuda':
-            context_manager = torch.autocast(self.device, dtype=self.dtype)
-        else:
-            # For CPU, just use a dummy context manager
-            context_manager = nullcontext()
-
-        with context_manager:
+        with self._getContextManager():
             output_ids = self.model.generate(
                 input_ids,
-                images=[(image_tensor.unsqueeze(0).to(self.device), image_tensor_1.unsqueeze(0).to(self.device))],
+                images=[imageTuple],
+                image_start_positions=image_start_positions,
                 do_sample=False,
                 num_beams = 1, # Using 1 for simplicity, original was 1
                 no_repeat_ngram_size = 20,
+                num_logits_to_keep=1,
                 streamer=streamer, # Streamer might output to console, for programmatic use, this needs adjustment
                 max_new_tokens=4096,
                 stopping_criteria=[stopping_criteria]
             )
         
-        outputs = self.tokenizer.decode(output_ids[0, input_ids.shape[1]:]).strip()
-        if outputs.endswith(stop_str):
-            outputs = outputs[:-len(stop_str)]
-        outputs = outputs.strip()
+        outputs = self.tokenizer.decode(output_ids[0, input_ids.shape[1]:])
+        return self._cleanOutput(outputs, stop_str)
+
+    def prepareInput(self, imageInput, ocrType="plain", box=None, color=None):
+        """
+        Load and preprocess step of OCR, without the model. Safe to call from several threads.
+        Returns an OcrInput that can be passed to generateBatch later.
+        """
+        image, (w, h) = self._loadImage(imageInput)
+        qs = self._buildQuery(ocrType, box, color, w, h)
+        template = self.promptCompiler.compile(qs)
+        # __call__ writes into its own tensor, unlike process_batch which reuses a shared buffer
+        imageTensor = self.imageProcessorHigh(image).unsqueeze(0)
+        return OcrInput(template=template, imageTensor=imageTensor)
+
+    def generateBatch(self, ocrInputList):
+        """
+        Model step of OCR for inputs made by prepareInput.
+        Returns one OCR result string per input, in input order.
+        One input runs through the GreedyDecoder, several through the DecodeScheduler
+        (or one model.generate batch when continuousBatching is False).
+        """
+        if not ocrInputList:
+            return []
+        if len(ocrInputList) == 1:
+            # One page: the lean greedy loop gives the same tokens as generate with less overhead per step
+            return [self.getGreedyDecoder().decode(ocrInputList[0])]
+        if self.continuousBatching or self.outputHead.restricted:
+            # Finished rows leave the batch at once instead of decoding pad tokens until the longest
+            # row is done; generate also always projects the full vocabulary
+            return self.generateContinuous(ocrInputList, maxBatchSize=len(ocrInputList))
+        imageBatch = torch.cat([ocrInput.imageTensor for ocrInput in ocrInputList], dim=0)
+        return self._generateBatch([ocrInput.template for ocrInput in ocrInputList], imageBatch)
+
+    def setVocabScripts(self, scriptList):
+        """
+        Restricts decoding to tokens of the given scripts, e.g. ['latin'] or ['latin', 'cjk']
+        (see VocabHead.SCRIPT_RANGES); None or [] for the full vocabulary.
+        """
+        tokenIds = VocabHead.buildWhitelist(self.tokenizer, scriptList) if scriptList else None
+        self.outputHead = VocabHead(self.model.lm_head, tokenIds)
+
+    def setVisionBackend(self, backend="eager", batchSizeList=(1, 2, 4, 8), cacheDir=None, onnxPath=None, onnxThreads=0):
+        """
+        Selects how the vision tower runs (ocr.visionBackend in models.yaml):
+            eager: the torch module.
+            compiled: AOT compiled per batch size (VisionCompiler), packages cached in cacheDir
+                (default: <model dir>/vision_cache). Compiles or loads them now, as the warm-up.
+            onnx: tower and projector in ONNX Runtime on the CPU (OnnxVisionEncoder) with
+                onnxThreads intra-op threads, from onnxPath (default: <model dir>/vision_encoder.onnx),
+                exported first if the file does not exist or was made from other weights.
+        """
+        gotModel = self.model.model
+        gotModel.vision_runner = None
+        gotModel.feature_runner = None
+        if backend == "eager":
+            return
+        if backend == "compiled":
+            cacheDir = cacheDir or os.path.join(self.modelName, "vision_cache")
+            compiler = VisionCompiler(gotModel.vision_tower_high, cacheDir, batchSizeList, imageSize=self.IMAGE_SIZE)
+            compiler.warmUp()
+            gotModel.vision_runner = compiler
+        elif backend == "onnx":
+            onnxPath = onnxPath or os.path.join(self.modelName, "vision_encoder.onnx")
+            gotModel.feature_runner = OnnxVisionEncoder.fromModel(gotModel, onnxPath, onnxThreads, imageSize=self.IMAGE_SIZE)
+        else:
+            raise ValueError(f"Unknown vision backend {backend}, known: eager, compiled, onnx")
+
+    def getGreedyDecoder(self):
+        if self._greedyDecoder is None:
+            self._greedyDecoder = GreedyDecoder(self)
+        return self._greedyDecoder
+
+    def getDecodeScheduler(self):
+        if self._decodeScheduler is None:
+            self._decodeScheduler = DecodeScheduler(self)
+        return self._decodeScheduler
+
+    def generateContinuous(self, ocrInputList, maxBatchSize=8):
+        """
+        Same results as generateBatch, but decoded with continuous batching (DecodeScheduler):
+        a finished row leaves the batch at once and the next input takes its place.
+        The scheduler and its KV cache pool are created once and reused by every call.
+        """
+        scheduler = self.getDecodeScheduler()
+        scheduler.maxBatchSize = max(1, maxBatchSize)
+        return scheduler.run(ocrInputList)
+
+    def performOcrBatch(self, images, ocrType="plain", boxes=None, colors=None):
+        """
+        Runs OCR on several images in one batch, through generateBatch (continuous batching).
+        With continuousBatching False and the full vocabulary it is a single model.generate call:
+        prompts are padded on the left so every row ends at the same position, and each row
+        stops on its own once it emits the stop token; generation ends when all rows are done.
+        Args:
+            images (list): File paths or PIL Image objects.
+            ocrType (str): OCR type shared by all images.
+            boxes (list): Optional box string per image (None entries are allowed).
+            colors (list): Optional color string per image (None entries are allowed).
+        Returns:
+            list: One OCR result string per input image, in input order.
+        """
+        if not images:
+            return []
+        count = len(images)
+        boxes = boxes if boxes is not None else [None] * count
+        colors = colors if colors is not None else [None] * count
+        if len(boxes) != count or len(colors) != count:
+            raise ValueError("boxes and colors must have one entry per image.")
+
+        templateList = []
+        imageList = []
+        for imageInput, box, color in zip(images, boxes, colors):
+            image, (w, h) = self._loadImage(imageInput)
+            qs = self._buildQuery(ocrType, box, color, w, h)
+            templateList.append(self.promptCompiler.compile(qs))
+            imageList.append(image)
+
+        # One (N, 3, 1024, 1024) tensor for the whole batch
+        imageBatch = self.imageProcessorHigh.process_batch(imageList)
+        if self.continuousBatching or self.outputHead.restricted:
+            # Row views of the shared buffer, it is not written again before generateBatch returns
+            return self.generateBatch([OcrInput(template=template, imageTensor=imageBatch[row:row + 1])
+                                       for row, template in enumerate(templateList)])
+        return self._generateBatch(templateList, imageBatch)
+
+    def _generateBatch(self, templateList, imageBatch):
+        """
+        Runs model.generate for prompt templates and their (N, 3, S, S) image batch.
+        """
+        count = len(templateList)
+        stop_str = templateList[0].stopStr
+        imageBatch = imageBatch.to(self.device)
+        # Each row gets a view of the batch tensor
+        imageTupleList = [(None, imageBatch[row:row + 1]) for row in range(count)]
+
+        # Left padding keeps the last prompt token of every row at the same position
+        maxLen = max(len(template.inputIds) for template in templateList)
+        input_ids = torch.full((count, maxLen), self.PAD_TOKEN_ID, dtype=torch.long)
+        attention_mask = torch.zeros((count, maxLen), dtype=torch.long)
+        image_start_positions = torch.zeros(count, dtype=torch.long)
+        for row, template in enumerate(templateList):
+            padLen = maxLen - len(template.inputIds)
+            input_ids[row, padLen:] = template.inputIds
+            attention_mask[row, padLen:] = 1
+            image_start_positions[row] = padLen + template.imageStart
+        input_ids = input_ids.to(self.device)
+        attention_mask = attention_mask.to(self.device)
+        image_start_positions = image_start_positions.to(self.device)
+
+        # The stop string is a single special token, so generate can finish each row on its own
+        stopTokenId = self.tokenizer.convert_tokens_to_ids(stop_str)
+        stopping_criteria = KeywordsStoppingCriteria([stop_str], self.tokenizer, input_ids)
+
+        with self._getContextManager():
+            output_ids = self.model.generate(
+                input_ids,
+                attention_mask=attention_mask,
+                images=imageTupleList,
+                image_start_positions=image_start_positions,
+                do_sample=False,
+                num_beams = 1,
+                no_repeat_ngram_size = 20,
+                max_new_tokens=4096,
+                eos_token_id=stopTokenId,
+                pad_token_id=self.PAD_TOKEN_ID,
+                num_logits_to_keep=1,
+                stopping_criteria=[stopping_criteria]
+            )
+
+        results = []
+        for row in range(count):
+            rowIds = output_ids[row, maxLen:].tolist()
+            # Finished rows are filled with pad tokens after the stop token, cut them off
+            if stopTokenId in rowIds:
+                rowIds = rowIds[:rowIds.index(stopTokenId) + 1]
+            outputs = self.tokenizer.decode(rowIds)
+            results.append(self._cleanOutput(outputs, stop_str))
+        return results
+
+
+if __name__ == "__main__":
+    # Benchmark: old two-pass preprocessing against the single pass, per page.
+    # Run from the project root: python -m app.code.core.OcrService
+    from app.code.utils.BenchTool import BenchTool
+
+    processorLow = BlipImageEvalProcessor(image_size=1024)
+    processorHigh = BlipImageEvalProcessor(image_size=1024)
+    rowList = []
+    for width, height in ((1240, 1754), (2480, 3508)):
+        page = Image.new('RGB', (width, height), (255, 255, 255))
+
+        def twoPass():
+            pageCopy = page.copy()
+            return (processorLow(page).unsqueeze(0), processorHigh(pageCopy).unsqueeze(0))
+
+        def onePass():
+            return (None, processorHigh(page).unsqueeze(0))
+
+        oldCost = BenchTool.timeIt(twoPass, repeat=10)["meanMs"]
+        newCost = BenchTool.timeIt(onePass, repeat=10)["meanMs"]
+        # Saved memory: the extra float tensor plus the PIL copy of the page
+        savedMb = (3 * 1024 * 1024 * 4 + width * height * 3) / 1024 / 1024
+        rowList.append((f"{width}x{height}", oldCost, newCost, oldCost - newCost, savedMb))
+
+    BenchTool.printTable("Preprocessing per page", ("page", "two pass ms", "one pass ms", "saved ms", "saved MB"), rowList)
+
+    # Benchmark: full decode against reduced-scale decode of a large phone photo
+    import tempfile
+    photoPath = os.path.join(tempfile.mkdtemp(), 'photo.jpg')
+    Image.new('RGB', (6000, 8000), (200, 180, 160)).save(photoPath, quality=90)
 
-        return outputs
\ No newline at end of file
+    fullCost = BenchTool.timeIt(lambda: Image.open(photoPath).convert('RGB'), repeat=3)["meanMs"]
+    reducedCost = BenchTool.timeIt(lambda: OcrService._decodeReduced(Image.open(photoPath), 1024), repeat=3)["meanMs"]
+    reducedSize = OcrService._decodeReduced(Image.open(photoPath), 1024).size
+    BenchTool.printTable("Decode 6000x8000 JPEG", ("mode", "ms", "decoded size", "decoded MB"), [
+        ("full", fullCost, "6000x8000", 6000 * 8000 * 3 / 1024 / 1024),
+        ("reduced", reducedCost, f"{reducedSize[0]}x{reducedSize[1]}", reducedSize[0] * reducedSize[1] * 3 / 1024 / 1024),
+    ])
@@ -0,0 +1,309 @@
+import os
+import queue
+import time
+import multiprocessing
+
+from app.code.utils.LogTool import LogTool
+from app.code.utils.FileTool import FileTool
+
+
+class OcrWorkerPool:
+    """
+    Runs several OcrService replicas in separate processes on a CPU box.
+
+    One OcrService with default torch threading stops scaling after a few cores, so the
+    cores are split into disjoint groups instead: each worker process is pinned to its own
+    group (CPU affinity), uses torch.set_num_threads(threadsPerWorker) and loads the model once.
+    The parent process turns the job list into tasks (one image, or a chunk of PDF pages),
+    feeds them to the workers and writes each file when all of its pages are back.
+    Torch is only imported inside the workers, after the thread limits are set. Spawned workers
+    re-import the main module, so it must not import torch at module level (main.py imports
+    OcrService inside main() for this reason).
+
+    With sharedWeights the workers do not load the checkpoint themselves: the parent writes a
+    dtype-final weights file once and every worker memory-maps it (see WeightTool), so the
+    weights are in RAM once and each extra worker only adds activations and KV cache.
+
+    vocabScripts restricts the decoding of every worker (OcrService.setVocabScripts) and
+    visionOptions (keyword arguments of OcrService.setVisionBackend) selects their vision
+    backend. A non-eager backend writes shared files on first use (compiled packages, ONNX
+    model), so the first worker starts alone and the others only once it is ready.
+
+    With quantMode the workers run the weight-only quantized decoder (OcrService quantMode,
+    quantLmHead). The parent creates the quantized weights file once, like the dtype-final
+    file, and every worker memory-maps it; sharedWeights is then implied.
+    """
+
+    def __init__(self, modelDirPath, workerCount, threadsPerWorker, ocrType="plain", batchSize=1, pageRange=None, sharedWeights=False,
+                 vocabScripts=None, visionOptions=None, quantMode=None, quantLmHead=False):
+        self.modelDirPath = modelDirPath
+        self.workerCount = max(1, workerCount)
+        self.threadsPerWorker = max(1, threadsPerWorker)
+        self.ocrType = ocrType
+        self.batchSize = max(1, batchSize)
+        self.pageRange = pageRange
+        self.sharedWeights = sharedWeights
+        self.vocabScripts = vocabScripts
+        self.visionOptions = visionOptions
+        self.quantMode = quantMode
+        self.quantLmHead = quantLmHead
+        self.imageExtensions = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp')
+
+    @staticmethod
+    def getCoreList():
+        """
+        Cores this process may run on.
+        """
+        if hasattr(os, "sched_getaffinity"):
+            return sorted(os.sched_getaffinity(0))
+        return list(range(os.cpu_count() or 1))
+
+    def getCoreGroups(self):
+        """
+        Splits the available cores into one disjoint group per worker.
+        """
+        coreList = self.getCoreList()
+        needed = self.workerCount * self.threadsPerWorker
+        if needed > len(coreList):
+            LogTool.info(f"{self.workerCount} workers x {self.threadsPerWorker} threads needs {needed} cores, "
+                         f"only {len(coreList)} available; cores will be shared")
+        return [[coreList[(index * self.threadsPerWorker + offset) % len(coreList)] for offset in range(self.threadsPerWorker)]
+                for index in range(self.workerCount)]
+
+    def _makeTasks(self, fileList):
+        """
+        Returns (taskList, expectedDict): tasks for the workers and the page count expected per file.
+        """
+        taskList = []
+        expectedDict = {}
+        for filePath in fileList:
+            if filePath.lower().endswith(self.imageExtensions):
+                taskList.append(("image", filePath, [0]))
+                expectedDict[filePath] = ("image", 1)
+            else:
+                pageCount = FileTool.getPdfPageCount(filePath)
+                if pageCount == 0:
+                    LogTool.error(f"Could not convert PDF {filePath} to images.")
+                    continue
+                pageNumbers = FileTool.parsePageRange(self.pageRange, pageCount)
+                # Chunks of batchSize pages, so a worker opens the PDF once per chunk
+                for start in range(0, len(pageNumbers), self.batchSize):
+                    taskList.append(("pdf", filePath, pageNumbers[start:start + self.batchSize]))
+                expectedDict[filePath] = ("pdf", len(pageNumbers))
+        return taskList, expectedDict
+
+    def run(self, fileList, writeResult):
+        """
+        Processes every file with the worker processes.
+        Args:
+            fileList (list): Image and PDF paths.
+            writeResult (callable): Called with one output dict per finished file.
+        Returns:
+            tuple: (pages done, seconds spent after all workers were started)
+        """
+        taskList, expectedDict = self._makeTasks(fileList)
+        if not taskList:
+            return 0, 0.0
+
+        weightsFile = None
+        if self.quantMode:
+            self._prepareQuantized()
+        elif self.sharedWeights:
+            weightsFile = self._prepareWeights()
+
+        context = multiprocessing.get_context("spawn")
+        taskQueue = context.Queue()
+        resultQueue = context.Queue()
+        for task in taskList:
+            taskQueue.put(task)
+        for _ in range(self.workerCount):
+            taskQueue.put(None)
+
+        coreGroups = self.getCoreGroups()
+        workerList = []
+
+        def startWorker(workerIndex):
+            worker = context.Process(
+                target=OcrWorkerPool._workerMain,
+                args=(workerIndex, self.modelDirPath, coreGroups[workerIndex], self.ocrType, taskQueue, resultQueue),
+                kwargs={"weightsFile": weightsFile, "vocabScripts": self.vocabScripts, "visionOptions": self.visionOptions,
+                        "quantMode": self.quantMode, "quantLmHead": self.quantLmHead},
+                daemon=True
+            )
+            worker.start()
+            workerList.append(worker)
+
+        # The first worker builds the shared files alone, the others are started when it is ready
+        firstAlone = self._buildsSharedFiles() and self.workerCount > 1
+        for workerIndex in range(1 if firstAlone else self.workerCount):
+            startWorker(workerIndex)
+        LogTool.info(f"Started {len(workerList)} of {self.workerCount} OCR workers with {self.threadsPerWorker} threads each for {len(taskList)} tasks")
+
+        pageDict = {filePath: [] for filePath in expectedDict}
+        failedSet = set()
+        pageCount = 0
+        readyCount = 0
+        startTime = None
+        pendingTasks = len(taskList)
+        try:
+            while pendingTasks > 0:
+                try:
+                    message = resultQueue.get(timeout=1)
+                except queue.Empty:
+                    if not any(worker.is_alive() for worker in workerList):
+                        LogTool.error(f"All OCR workers exited with {pendingTasks} tasks left")
+                        break
+                    continue
+
+                kind = message[0]
+                if kind == "ready":
+                    readyCount += 1
+                    LogTool.info(f"OCR worker {message[1]} ready, RSS {message[2]:.0f} MB")
+                    if len(workerList) < self.workerCount:
+                        for workerIndex in range(len(workerList), self.workerCount):
+                            startWorker(workerIndex)
+                        LogTool.info(f"Started the other {self.workerCount - 1} OCR workers")
+                    if readyCount == self.workerCount:
+                        # Throughput is measured once all models are loaded
+                        startTime = time.perf_counter()
+                    continue
+
+                pendingTasks -= 1
+                _, filePath, resultList, errorText = message
+                if kind == "error":
+                    LogTool.error(f"Error processing {filePath}: {errorText}")
+                    failedSet.add(filePath)
+                    continue
+                pageDict[filePath].extend(resultList)
+                pageCount += len(resultList)
+                docType, expected = expectedDict[filePath]
+                if filePath not in failedSet and len(pageDict[filePath]) >= expected:
+                    self._writeDoc(filePath, docType, pageDict.pop(filePath), writeResult)
+        finally:
+            for worker in workerList:
+                worker.join(timeout=5)
+                if worker.is_alive():
+                    worker.terminate()
+
+        elapsed = time.perf_counter() - startTime if startTime is not None else 0.0
+        return pageCount, elapsed
+
+    def _buildsSharedFiles(self):
+        """
+        True when the workers create files on first use that all of them then load.
+        """
+        return bool(self.visionOptions) and self.visionOptions.get("backend", "eager") != "eager"
+
+    def _prepareWeights(self):
+        """
+        Creates the dtype-final weights file the workers will map, once, in the parent process.
+        """
+        import torch
+        from app.code.core.ocr_model import GOTQwenForCausalLM
+        from app.code.utils.WeightTool import WeightTool
+
+        dtype = torch.bfloat16 if torch.cuda.is_available() else torch.float32
+        return WeightTool.ensureDtypeFinal(GOTQwenForCausalLM, self.modelDirPath, dtype, pad_token_id=151643)
+
+    def _prepareQuantized(self):
+        """
+        Creates the quantized weights file the workers will map, once, in the parent process.
+        """
+        from app.code.core.ocr_model import GOTQwenForCausalLM
+        from app.code.core.QuantLinear import DecoderQuantizer
+
+        return DecoderQuantizer.ensureQuantized(GOTQwenForCausalLM, self.modelDirPath, self.quantMode,
+                                                quantLmHead=self.quantLmHead, pad_token_id=151643)
+
+    def _writeDoc(self, filePath, docType, pageList, writeResult):
+        if docType == "image":
+            outputData = {"input_path": filePath, "type": "image", "ocr_result": pageList[0][1]}
+        else:
+            pageList = sorted(pageList, key=lambda page: page[0])
+            outputData = {"input_path": filePath, "type": "pdf",
+                          "pages": [{"page": pageNumber + 1, "ocr_result": result} for pageNumber, result in pageList]}
+        try:
+            writeResult(outputData)
+        except Exception as e:
+            LogTool.error(f"Failed to write result of {filePath}: {e}")
+
+    @staticmethod
+    def _workerMain(workerIndex, modelDirPath, coreGroup, ocrType, taskQueue, resultQueue, weightsFile=None, vocabScripts=None,
+                    visionOptions=None, quantMode=None, quantLmHead=False):
+        """
+        Worker process entry: pin to the core group, limit torch threads, load the model once
+        and process tasks until a None task arrives.
+        """
+        threadCount = str(len(coreGroup))
+        for name in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+            os.environ[name] = threadCount
+        try:
+            if hasattr(os, "sched_setaffinity"):
+                os.sched_setaffinity(0, coreGroup)
+            else:
+                import psutil
+                psutil.Process().cpu_affinity(coreGroup)
+        except Exception as e:
+            LogTool.error(f"Worker {workerIndex} could not set CPU affinity {coreGroup}: {e}")
+
+        import torch
+        torch.set_num_threads(len(coreGroup))
+        from app.code.core.OcrService import OcrService
+        from app.code.utils.BenchTool import BenchTool
+
+        ocrService = OcrService(modelDirPath, weightsFile=weightsFile, quantMode=quantMode, quantLmHead=quantLmHead)
+        if visionOptions:
+            ocrService.setVisionBackend(**visionOptions)
+        if vocabScripts:
+            ocrService.setVocabScripts(vocabScripts)
+        resultQueue.put(("ready", workerIndex, BenchTool.getRssMb(), None))
+
+        while True:
+            task = taskQueue.get()
+            if task is None:
+                return
+            docType, filePath, pageNumbers = task
+            try:
+                if docType == "image":
+                    resultList = [(0, ocrService.performOcrBatch([filePath], ocrType=ocrType)[0])]
+                else:
+                    pageList = list(FileTool.iterPdfImages(filePath, pageNumbers, targetSize=ocrService.IMAGE_SIZE))
+                    if len(pageList) != len(pageNumbers):
+                        raise ValueError(f"Only {len(pageList)} of {len(pageNumbers)} pages could be rendered")
+                    textList = ocrService.performOcrBatch([image for _, image in pageList], ocrType=ocrType)
+                    resultList = [(pageNumber, text) for (pageNumber, _), text in zip(pageList, textList)]
+                resultQueue.put(("result", filePath, resultList, None))
+            except Exception as e:
+                resultQueue.put(("error", filePath, None, str(e)))
+
+    @staticmethod
+    def sweep(modelDirPath, fileList, ocrType="plain", batchSize=1, pageRange=None, sharedWeights=False, vocabScripts=None,
+              visionOptions=None, quantMode=None, quantLmHead=False):
+        """
+        Benchmark: runs the same files with every workers x threads split that fills the
+        available cores (worker counts are powers of two) and returns the fastest split.
+        Model loading is not counted, only the time after all workers are ready.
+        Returns:
+            tuple: (workerCount, threadsPerWorker)
+        """
+        coreCount = len(OcrWorkerPool.getCoreList())
+        splitList = []
+        workerCount = 1
+        while workerCount <= coreCount:
+            splitList.append((workerCount, coreCount // workerCount))
+            workerCount *= 2
+
+        best = None
+        bestRate = -1.0
+        for workerCount, threadsPerWorker in splitList:
+            pool = OcrWorkerPool(modelDirPath, workerCount, threadsPerWorker, ocrType=ocrType, batchSize=batchSize,
+                                 pageRange=pageRange, sharedWeights=sharedWeights, vocabScripts=vocabScripts,
+                                 visionOptions=visionOptions, quantMode=quantMode, quantLmHead=quantLmHead)
+            pageCount, elapsed = pool.run(fileList, lambda outputData: None)
+            rate = pageCount / elapsed if elapsed > 0 else 0.0
+            LogTool.info(f"Sweep: workers={workerCount} threadsPerWorker={threadsPerWorker} pages={pageCount} "
+                         f"time={elapsed:.2f}s throughput={rate:.3f} pages/s")
+            if rate > bestRate:
+                best, bestRate = (workerCount, threadsPerWorker), rate
+        LogTool.info(f"Sweep best split on {coreCount} cores: workers={best[0]} threadsPerWorker={best[1]} ({bestRate:.3f} pages/s)")
+        return best
@@ -0,0 +1,181 @@
+import copy
+import os
+
+import torch
+import torch.nn as nn
+from app.code.utils.LogTool import LogTool
+from app.code.core.VisionCompiler import VisionCompiler
+
+
+class VisionFeatureModule(nn.Module):
+    """vision_tower_high + mm_projector_vary as one module: (B, 3, S, S) -> (B, 256, 1024)."""
+
+    def __init__(self, visionTower, projector):
+        super().__init__()
+        self.visionTower = visionTower
+        self.projector = projector
+
+    def forward(self, images):
+        return self.projector(self.visionTower(images).permute(0, 2, 3, 1).flatten(1, 2))
+
+
+class OnnxVisionEncoder:
+    """
+    ONNX Runtime CPU backend of the vision tower and the projector.
+
+    The two modules of GOTQwenModel are exported together to one ONNX graph (export, dynamic
+    batch size, float32) and run in an InferenceSession on the CPU execution provider, with
+    all graph optimizations and intra-op threads set to the torch thread count by default.
+    Set it as GOTQwenModel.feature_runner (see OcrService.setVisionBackend): it returns the
+    (B, 256, 1024) projected features that go into the embedding splice.
+
+    The export stores the model key (getModelKey: hash of the tower and projector weights,
+    torch version, opset) in the ONNX metadata; fromModel exports again when the file was
+    made from other weights or by another torch, instead of running a stale graph.
+    """
+
+    INPUT_NAME = "images"
+    OUTPUT_NAME = "features"
+
+    def __init__(self, onnxPath, intraOpThreads=0):
+        """
+        Args:
+            onnxPath (str): Exported model (see export).
+            intraOpThreads (int): Threads of one ONNX Runtime op; 0 uses torch.get_num_threads().
+        """
+        try:
+            import onnxruntime
+        except ImportError as e:
+            raise RuntimeError("The onnx vision backend needs the onnxruntime package") from e
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.intra_op_num_threads = intraOpThreads or torch.get_num_threads()
+        # Ops run one after another, so a second pool would only compete for the same cores
+        options.inter_op_num_threads = 1
+        self.onnxPath = onnxPath
+        self.session = onnxruntime.InferenceSession(onnxPath, options, providers=["CPUExecutionProvider"])
+
+    def getStoredKey(self):
+        """
+        Model key written by export, {} for files without one.
+        """
+        return dict(self.session.get_modelmeta().custom_metadata_map)
+
+    @staticmethod
+    def getModelKey(gotModel, opsetVersion=17):
+        """
+        Identifies an export of gotModel: weights hash of vision_tower_high + mm_projector_vary
+        (VisionCompiler.getModelHash), torch version and opset.
+        """
+        featureModule = VisionFeatureModule(gotModel.vision_tower_high, gotModel.mm_projector_vary)
+        return {"modelHash": VisionCompiler.getModelHash(featureModule), "torchVersion": torch.__version__,
+                "opsetVersion": str(opsetVersion)}
+
+    @staticmethod
+    def fromModel(gotModel, onnxPath, intraOpThreads=0, imageSize=1024, opsetVersion=17):
+        """
+        Encoder for gotModel from onnxPath, exported first if the file is missing or its stored
+        key does not match the model.
+        """
+        modelKey = OnnxVisionEncoder.getModelKey(gotModel, opsetVersion)
+        if os.path.exists(onnxPath):
+            encoder = OnnxVisionEncoder(onnxPath, intraOpThreads)
+            if encoder.getStoredKey() == modelKey:
+                return encoder
+            LogTool.info(f"{onnxPath} was exported from other weights or another torch/opset, exporting again")
+            del encoder
+        OnnxVisionEncoder.export(gotModel, onnxPath, imageSize=imageSize, opsetVersion=opsetVersion, modelKey=modelKey)
+        return OnnxVisionEncoder(onnxPath, intraOpThreads)
+
+    def __call__(self, images):
+        """
+        (B, 3, S, S) -> (B, 256, 1024) float32 tensor on the CPU.
+        """
+        inputArray = images.detach().to(device="cpu", dtype=torch.float32).contiguous().numpy()
+        outputArray = self.session.run([self.OUTPUT_NAME], {self.INPUT_NAME: inputArray})[0]
+        return torch.from_numpy(outputArray)
+
+    @staticmethod
+    def export(gotModel, onnxPath, imageSize=1024, opsetVersion=17, modelKey=None):
+        """
+        Exports vision_tower_high + mm_projector_vary of a GOTQwenModel to onnxPath, with the
+        model key (getModelKey, computed if not given) in the metadata.
+        The modules are copied to float32 on the CPU first, the loaded model is not changed.
+        """
+        try:
+            import onnx
+        except ImportError as e:
+            raise RuntimeError("Exporting the onnx vision backend needs the onnx package") from e
+
+        modelKey = modelKey or OnnxVisionEncoder.getModelKey(gotModel, opsetVersion)
+        featureModule = VisionFeatureModule(
+            copy.deepcopy(gotModel.vision_tower_high), copy.deepcopy(gotModel.mm_projector_vary)
+        ).to(device="cpu", dtype=torch.float32).eval()
+        example = torch.zeros(1, 3, imageSize, imageSize)
+        directory = os.path.dirname(os.path.abspath(onnxPath))
+        os.makedirs(directory, exist_ok=True)
+        # Written under a temporary name first, so a crash never leaves a half-written model
+        tmpPath = f"{onnxPath}.{os.getpid()}.tmp"
+        with torch.no_grad():
+            torch.onnx.export(
+                featureModule,
+                (example,),
+                tmpPath,
+                input_names=[OnnxVisionEncoder.INPUT_NAME],
+                output_names=[OnnxVisionEncoder.OUTPUT_NAME],
+                dynamic_axes={OnnxVisionEncoder.INPUT_NAME: {0: "batch"}, OnnxVisionEncoder.OUTPUT_NAME: {0: "batch"}},
+                opset_version=opsetVersion,
+                do_constant_folding=True,
+            )
+        onnxModel = onnx.load(tmpPath)
+        onnx.helper.set_model_props(onnxModel, modelKey)
+        onnx.save(onnxModel, tmpPath)
+        os.replace(tmpPath, onnxPath)
+        LogTool.info(f"Exported vision encoder to {onnxPath}")
+        return onnxPath
+
+
+if __name__ == "__main__":
+    # Export, parity and throughput of the ONNX Runtime vision encoder against eager torch.
+    # Run from the project root:
+    #   python -m app.code.core.OnnxVisionEncoder [--model_dir DIR] [--onnx_path FILE] [--export_only] [--threads N]
+    import argparse
+    import time
+    from app.code.core.OcrService import OcrService
+    from app.code.utils.BenchTool import BenchTool
+
+    parser = argparse.ArgumentParser(description="Export the vision encoder to ONNX and compare it with eager torch")
+    parser.add_argument("--model_dir", default="app/code/data/", help="Model directory (default: app/code/data/).")
+    parser.add_argument("--onnx_path", default=None, help="ONNX file (default: <model_dir>/vision_encoder.onnx).")
+    parser.add_argument("--export_only", action="store_true", help="Export (again) and exit.")
+    parser.add_argument("--threads", type=int, default=0, help="ONNX Runtime intra-op threads (default: torch threads).")
+    args = parser.parse_args()
+
+    ocrService = OcrService(args.model_dir)
+    gotModel = ocrService.model.model
+    onnxPath = args.onnx_path or os.path.join(args.model_dir, "vision_encoder.onnx")
+    if args.export_only:
+        OnnxVisionEncoder.export(gotModel, onnxPath)
+        raise SystemExit(0)
+
+    encoder = OnnxVisionEncoder.fromModel(gotModel, onnxPath, args.threads)
+    torchModule = VisionFeatureModule(gotModel.vision_tower_high, gotModel.mm_projector_vary)
+    rowList = []
+    for batchSize in (1, 2, 4):
+        images = torch.randn(batchSize, 3, 1024, 1024)
+        with torch.inference_mode():
+            torchFeatures = torchModule(images.to(device=ocrService.device, dtype=ocrService.dtype)).float().cpu()
+            onnxFeatures = encoder(images)
+            maxDiff = (torchFeatures - onnxFeatures).abs().max().item()
+            torchMs = BenchTool.timeIt(lambda: torchModule(images.to(device=ocrService.device, dtype=ocrService.dtype)), repeat=3)["p50Ms"]
+        onnxMs = BenchTool.timeIt(lambda: encoder(images), repeat=3)["p50Ms"]
+        assert tuple(onnxFeatures.shape) == (batchSize, 256, 1024), f"Unexpected ONNX output shape {tuple(onnxFeatures.shape)}"
+        rowList.append((batchSize, batchSize * 1000 / torchMs, batchSize * 1000 / onnxMs, torchMs / onnxMs, f"{maxDiff:.1e}"))
+    BenchTool.printTable(f"Vision encoder + projector, {encoder.session.get_session_options().intra_op_num_threads} ORT threads",
+                         ("batch", "torch pages/s", "onnx pages/s", "speedup", "max abs diff"), rowList)
+    maxDiff = max(float(row[-1]) for row in rowList)
+    print(f"Parity: max abs diff {maxDiff:.1e} ({'ok' if maxDiff < 1e-2 else 'TOO LARGE'})")
+    if maxDiff >= 1e-2:
+        raise SystemExit(1)
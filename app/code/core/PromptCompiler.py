@@ -0,0 +1,66 @@
+import dataclasses
+from functools import lru_cache
+
+import torch
+from app.code.utils.ocr_internal.conversation import conv_templates, SeparatorStyle
+from app.code.utils.ocr_internal.constants import DEFAULT_IMAGE_PATCH_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN
+
+
+@dataclasses.dataclass
+class PromptTemplate:
+    """A ready prompt: token ids plus the position of the image block inside them."""
+    inputIds: torch.LongTensor
+    imageStart: int  # index of the <img> token
+    imageEnd: int    # index of the </img> token
+    stopStr: str
+
+
+class PromptCompiler:
+    """
+    Turns an OCR query into prompt token ids without running the tokenizer on the whole prompt.
+
+    The prompt is always: fixed prefix (system text, user role, <img>, 256 x <imgpad>, </img>),
+    then the query text ("\\n" + color/box/ocr type), then a fixed suffix (<|im_end|>, assistant role).
+    </img> and <|im_end|> are special tokens, so the tokenizer never merges across them and the three
+    parts can be tokenized on their own. The prefix and suffix are tokenized once; the short query
+    part and the full templates are kept in LRU caches.
+    """
+
+    QUERY_MARK = "\x00QUERY\x00"
+
+    def __init__(self, tokenizer, imageTokenLen=256, convMode="mpt", cacheSize=256):
+        self.tokenizer = tokenizer
+        self.imageTokenLen = imageTokenLen
+
+        conv = conv_templates[convMode].copy()
+        conv.append_message(conv.roles[0], DEFAULT_IM_START_TOKEN + DEFAULT_IMAGE_PATCH_TOKEN * imageTokenLen + DEFAULT_IM_END_TOKEN + self.QUERY_MARK)
+        conv.append_message(conv.roles[1], None)
+        prefixText, suffixText = conv.get_prompt().split(self.QUERY_MARK)
+        self.stopStr = conv.sep if conv.sep_style != SeparatorStyle.TWO else conv.sep2
+
+        self.prefixIds = torch.as_tensor(tokenizer([prefixText]).input_ids[0], dtype=torch.long)
+        self.suffixIds = torch.as_tensor(tokenizer([suffixText]).input_ids[0], dtype=torch.long)
+
+        imStartId = tokenizer.convert_tokens_to_ids(DEFAULT_IM_START_TOKEN)
+        startList = (self.prefixIds == imStartId).nonzero().flatten().tolist()
+        if len(startList) != 1:
+            raise ValueError("Prompt prefix must contain exactly one image start token.")
+        self.imageStart = startList[0]
+        self.imageEnd = self.imageStart + imageTokenLen + 1
+
+        self._encodeQuery = lru_cache(maxsize=cacheSize)(self._encodeQueryText)
+        self._compileCached = lru_cache(maxsize=cacheSize)(self._compileQuery)
+
+    def _encodeQueryText(self, queryText):
+        return torch.as_tensor(self.tokenizer([queryText]).input_ids[0], dtype=torch.long)
+
+    def _compileQuery(self, qs):
+        inputIds = torch.cat([self.prefixIds, self._encodeQuery("\n" + qs), self.suffixIds])
+        return PromptTemplate(inputIds=inputIds, imageStart=self.imageStart, imageEnd=self.imageEnd, stopStr=self.stopStr)
+
+    def compile(self, qs):
+        """
+        Returns the PromptTemplate for a query text such as 'OCR: ' or '[red] [10, 20] OCR: '.
+        The returned ids are shared by the cache and must not be changed in place.
+        """
+        return self._compileCached(qs)
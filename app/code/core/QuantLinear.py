@@ -0,0 +1,301 @@
+import os
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from app.code.utils.LogTool import LogTool
+from app.code.utils.WeightTool import WeightTool
+
+
+class QuantLinear(nn.Module):
+    """
+    Weight-only quantized replacement of nn.Linear; activations stay in the compute dtype.
+
+        int8: one int8 per weight, symmetric, one scale per output row.
+        int4: two weights per uint8, symmetric in [-8, 7], one scale per group of groupSize
+              inputs of a row.
+
+    On the CPU, int8 uses torch's weight-only int8 matmul kernel for a single input row (decoding
+    at batch size 1) when it is available, so the weights are streamed as int8; for more rows that
+    kernel is far slower than a float matmul (675 ms against 11 ms for a 263 token prefill of one
+    MLP projection). Otherwise (more rows, int4, other devices, older torch) the weight is
+    dequantized on the fly in row chunks of about CHUNK_ELEMENTS values, so the float copy of a
+    chunk stays in cache instead of materializing the whole matrix.
+
+    This saves memory, not time: on a 1 vCPU Xeon (AVX-512) with torch 2.14.1 the 24 layer
+    decoder decodes 4.9 tokens/s in fp32, 1.9 in int8 and 1.1 in int4 (python -m
+    app.code.core.QuantLinear --random_weights), with the decoder weights at 1770, 889 and 750 MB.
+    """
+
+    MODES = ("int8", "int4")
+    CHUNK_ELEMENTS = 1 << 20
+
+    def __init__(self, in_features, out_features, bias=True, mode="int8", groupSize=128, device=None, dtype=torch.float32):
+        super().__init__()
+        if mode not in QuantLinear.MODES:
+            raise ValueError(f"Unknown quantization mode {mode}, known: {QuantLinear.MODES}")
+        if mode == "int4" and (groupSize % 2 or in_features % groupSize):
+            raise ValueError(f"int4 needs an even groupSize dividing in_features, got groupSize {groupSize} for {in_features}")
+        # Same attribute names as nn.Linear
+        self.in_features = in_features
+        self.out_features = out_features
+        self.mode = mode
+        self.groupSize = groupSize
+        if mode == "int8":
+            self.register_buffer("qweight", torch.empty((out_features, in_features), dtype=torch.int8, device=device))
+            self.register_buffer("scale", torch.empty(out_features, dtype=dtype, device=device))
+        else:
+            self.register_buffer("qweight", torch.empty((out_features, in_features // 2), dtype=torch.uint8, device=device))
+            self.register_buffer("scale", torch.empty((out_features, in_features // groupSize), dtype=dtype, device=device))
+        if bias:
+            self.bias = nn.Parameter(torch.empty(out_features, dtype=dtype, device=device))
+        else:
+            self.register_parameter("bias", None)
+        self.chunkRows = max(1, QuantLinear.CHUNK_ELEMENTS // in_features)
+
+    @staticmethod
+    def fromLinear(linear, mode="int8", groupSize=128):
+        """
+        Quantizes a loaded nn.Linear.
+        """
+        weight = linear.weight.detach().float()
+        module = QuantLinear(linear.in_features, linear.out_features, linear.bias is not None, mode, groupSize,
+                             device=weight.device, dtype=linear.weight.dtype)
+        with torch.no_grad():
+            if mode == "int8":
+                scale = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+                qweight = torch.round(weight / scale[:, None]).clamp(-127, 127).to(torch.int8)
+            else:
+                grouped = weight.view(linear.out_features, -1, groupSize)
+                scale = grouped.abs().amax(dim=-1).clamp(min=1e-8) / 7
+                # [-8, 7] -> [0, 15], even inputs in the low nibble, odd inputs in the high nibble
+                values = (torch.round(grouped / scale[..., None]).clamp(-8, 7) + 8).to(torch.uint8).view(linear.out_features, -1)
+                qweight = values[:, 0::2] | (values[:, 1::2] << 4)
+            module.qweight.copy_(qweight)
+            module.scale.copy_(scale)
+            if linear.bias is not None:
+                module.bias.copy_(linear.bias.detach())
+        return module
+
+    def selectRows(self, rowIndex):
+        """
+        New QuantLinear with only the output rows in rowIndex (LongTensor), still quantized.
+        """
+        module = QuantLinear(self.in_features, len(rowIndex), self.bias is not None, self.mode, self.groupSize,
+                             device=self.qweight.device, dtype=self.scale.dtype)
+        with torch.no_grad():
+            module.qweight.copy_(self.qweight[rowIndex])
+            module.scale.copy_(self.scale[rowIndex])
+            if self.bias is not None:
+                module.bias.copy_(self.bias.detach()[rowIndex])
+        return module
+
+    def dequantize(self, start=0, end=None):
+        """
+        Float weight rows [start, end), (rows, in_features) in the scale dtype.
+        """
+        qweight = self.qweight[start:end]
+        scale = self.scale[start:end]
+        if self.mode == "int8":
+            return qweight.to(scale.dtype) * scale[:, None]
+        low = (qweight & 0x0F).to(torch.int8) - 8
+        high = (qweight >> 4).to(torch.int8) - 8
+        values = torch.stack((low, high), dim=-1).view(qweight.shape[0], -1, self.groupSize)
+        return (values.to(scale.dtype) * scale[..., None]).view(qweight.shape[0], self.in_features)
+
+    def forward(self, x):
+        if (self.mode == "int8" and x.device.type == "cpu" and x.dtype == self.scale.dtype and x.numel() == self.in_features
+                and hasattr(torch, "_weight_int8pack_mm")):
+            output = torch._weight_int8pack_mm(x.reshape(-1, self.in_features).contiguous(), self.qweight, self.scale)
+            output = output.view(*x.shape[:-1], self.out_features)
+        else:
+            outputList = [F.linear(x, self.dequantize(start, start + self.chunkRows).to(x.dtype))
+                          for start in range(0, self.out_features, self.chunkRows)]
+            output = outputList[0] if len(outputList) == 1 else torch.cat(outputList, dim=-1)
+        if self.bias is not None:
+            output = output + self.bias.to(output.dtype)
+        return output
+
+    def extra_repr(self):
+        group = f", groupSize={self.groupSize}" if self.mode == "int4" else ""
+        return f"in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}, mode={self.mode}{group}"
+
+
+class DecoderQuantizer:
+    """
+    Weight-only quantization of the Qwen2 decoder of GOTQwenForCausalLM (QuantLinear).
+
+    CPU decoding at batch size 1 is bound by reading the weights of every layer for every
+    token, so storing them in 8 or 4 bits cuts the bytes per token. Only the Linear layers of
+    model.layers (and optionally lm_head) are quantized; embeddings, norms, the vision tower
+    and the projector stay in float. The quantized state dict is saved once next to the
+    checkpoint and memory-mapped at later starts (see WeightTool), without quantizing again.
+    """
+
+    @staticmethod
+    def getQuantPath(modelDirPath, mode, groupSize=128, quantLmHead=False):
+        """
+        Path of the quantized weights file, e.g. model.int8-<fingerprint>.safetensors or
+        model.int4g128-lmhead-<fingerprint>.safetensors. The fingerprint is the one of the
+        checkpoint it is made from (WeightTool.getCheckpointFingerprint), so a new checkpoint
+        gets a new file instead of the old quantized weights.
+        """
+        return os.path.join(modelDirPath, f"{DecoderQuantizer._getQuantPrefix(mode, groupSize, quantLmHead)}"
+                                          f"{WeightTool.getCheckpointFingerprint(modelDirPath)}.safetensors")
+
+    @staticmethod
+    def _getQuantPrefix(mode, groupSize, quantLmHead):
+        name = mode if mode == "int8" else f"{mode}g{groupSize}"
+        if quantLmHead:
+            name += "-lmhead"
+        return f"model.{name}-"
+
+    @staticmethod
+    def quantizeModel(model, mode, groupSize=128, quantLmHead=False, empty=False):
+        """
+        Replaces the Linear layers of model.model.layers (and lm_head) by QuantLinear.
+        With empty, the replacements are uninitialized shells on the meta device, to be
+        filled by load_state_dict(assign=True).
+        """
+        def convert(linear):
+            if empty:
+                return QuantLinear(linear.in_features, linear.out_features, linear.bias is not None, mode, groupSize, device="meta")
+            return QuantLinear.fromLinear(linear, mode, groupSize)
+
+        for layer in model.model.layers:
+            DecoderQuantizer._replaceLinears(layer, convert)
+        if quantLmHead:
+            # lm_head gets its own quantized weight, the input embeddings stay in float
+            model.config.tie_word_embeddings = False
+            model.lm_head = convert(model.lm_head)
+        return model
+
+    @staticmethod
+    def _replaceLinears(module, convert):
+        for name, child in module.named_children():
+            if isinstance(child, nn.Linear):
+                setattr(module, name, convert(child))
+            else:
+                DecoderQuantizer._replaceLinears(child, convert)
+
+    @staticmethod
+    def loadQuantized(modelClass, modelDirPath, filePath, mode, groupSize=128, quantLmHead=False, **configKwargs):
+        """
+        Builds modelClass with QuantLinear shells and maps the saved quantized weights into it.
+        """
+        return WeightTool.loadMmapModel(
+            modelClass, modelDirPath, filePath,
+            prepareModel=lambda model: DecoderQuantizer.quantizeModel(model, mode, groupSize, quantLmHead, empty=True),
+            **configKwargs
+        )
+
+    @staticmethod
+    def ensureQuantized(modelClass, modelDirPath, mode, groupSize=128, quantLmHead=False, **loadKwargs):
+        """
+        Returns the quantized weights path, quantizing the float32 checkpoint and saving it if the file does not exist yet.
+        """
+        filePath = DecoderQuantizer.getQuantPath(modelDirPath, mode, groupSize, quantLmHead)
+        if os.path.exists(filePath):
+            return filePath
+        LogTool.info(f"Creating {mode} quantized weights {filePath}")
+        model = modelClass.from_pretrained(modelDirPath, low_cpu_mem_usage=True, use_safetensors=True, **loadKwargs)
+        model.to(dtype=torch.float32)
+        DecoderQuantizer.quantizeModel(model, mode, groupSize, quantLmHead)
+        WeightTool.saveDtypeFinal(model, filePath)
+        del model
+        # Files of the same mode made from earlier checkpoints are never read again
+        WeightTool.removeStaleFiles(modelDirPath, DecoderQuantizer._getQuantPrefix(mode, groupSize, quantLmHead), filePath)
+        return filePath
+
+
+if __name__ == "__main__":
+    # Benchmark: fp32 against int8 and int4 decoders, CER and decode tokens/s on synthetic pages.
+    # Run from the project root: python -m app.code.core.QuantLinear [modelDir] [--lm_head] [--random_weights]
+    # --random_weights needs only config.json: the real-size decoder with random weights and fixed image
+    # features, decode tokens/s only (the speed does not depend on the weight values, the CER does).
+    import gc
+    import sys
+    import time
+    from types import SimpleNamespace
+    from contextlib import nullcontext
+    from app.code.core.OcrService import OcrService, OcrInput
+    from app.code.core.ocr_model import GOTConfig, GOTQwenForCausalLM
+    from app.code.core.GreedyDecoder import GreedyDecoder
+    from app.code.core.PromptCompiler import PromptTemplate
+    from app.code.core.VocabHead import VocabHead
+    from app.code.utils.BenchTool import BenchTool
+
+    argList = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    modelDirPath = argList[0] if argList else "app/code/data/"
+    quantLmHead = "--lm_head" in sys.argv
+    modeList = (None, "int8", "int4")
+
+    def getDecoderMb(model):
+        decoderModules = list(model.model.layers) + [model.lm_head]
+        return sum(tensor.numel() * tensor.element_size() for module in decoderModules
+                   for tensor in list(module.parameters()) + list(module.buffers())) / 1024 / 1024
+
+    if "--random_weights" in sys.argv:
+        config = GOTConfig.from_pretrained(modelDirPath)
+        stopTokenId = 151645
+        promptIds = torch.as_tensor([151644, 8948, 198, config.im_start_token] + [config.im_patch_token] * 256
+                                    + [config.im_end_token, 198, 23904, 25, 220], dtype=torch.long)
+        ocrInput = OcrInput(template=PromptTemplate(inputIds=promptIds, imageStart=3, imageEnd=260, stopStr="<|im_end|>"),
+                            imageTensor=torch.zeros(1, 3, 16, 16))
+        stepCount = 64
+        rowList = []
+        for mode in modeList:
+            torch.manual_seed(0)
+            model = GOTQwenForCausalLM(config).eval()
+            # The vision tower is not part of decoding, fixed features stand in for it
+            features = torch.randn(1, 256, config.hidden_size) * 0.02
+            model.model.feature_runner = lambda patches: features.expand(patches.shape[0], -1, -1)
+            if mode:
+                DecoderQuantizer.quantizeModel(model, mode, quantLmHead=quantLmHead)
+            service = SimpleNamespace(model=model, device="cpu", promptCompiler=SimpleNamespace(stopStr="<|im_end|>"),
+                                      tokenizer=SimpleNamespace(convert_tokens_to_ids=lambda token: stopTokenId),
+                                      outputHead=VocabHead(model.lm_head), _getContextManager=nullcontext)
+            # Decode rate without the prefill: the difference of a 1 token and a stepCount + 1 token run
+            prefillDecoder = GreedyDecoder(service, maxNewTokens=1)
+            decoder = GreedyDecoder(service, maxNewTokens=stepCount + 1)
+            prefillStats, fullStats = BenchTool.timeInterleaved([lambda: prefillDecoder.generate(ocrInput),
+                                                                 lambda: decoder.generate(ocrInput)], repeat=3)
+            tokenCount = len(decoder.generate(ocrInput)) - 1
+            decodeSeconds = (fullStats["p50Ms"] - prefillStats["p50Ms"]) / 1000
+            rowList.append((mode or "fp32", tokenCount / decodeSeconds, prefillStats["p50Ms"], getDecoderMb(model)))
+            del model, service, prefillDecoder, decoder
+            gc.collect()
+        BenchTool.printTable(f"Random-weight decoder ({config.num_hidden_layers} layers, hidden {config.hidden_size}), CPU, "
+                             f"{torch.get_num_threads()} threads, lm_head {'quantized' if quantLmHead else 'fp32'}",
+                             ("weights", "decode tokens/s", "prefill ms", "layers + lm_head MB"), rowList)
+        sys.exit(0)
+
+    lineCounts = (3, 10, 25)
+    referenceList = ["\n".join(BenchTool.getTextPageLines(lineCount, seed=index)) for index, lineCount in enumerate(lineCounts)]
+    pageList = [BenchTool.makeTextPage(lineCount, seed=index) for index, lineCount in enumerate(lineCounts)]
+
+    rowList = []
+    fp32TextList = None
+    for mode in modeList:
+        ocrService = OcrService(modelDirPath, quantMode=mode, quantLmHead=quantLmHead)
+        decoder = ocrService.getGreedyDecoder()
+        ocrInputList = [ocrService.prepareInput(page) for page in pageList]
+        decoder.generate(ocrInputList[0])  # warm-up
+        tokenCount = 0
+        textList = []
+        startTime = time.perf_counter()
+        for ocrInput in ocrInputList:
+            outputIds = decoder.generate(ocrInput)
+            tokenCount += len(outputIds)
+            textList.append(ocrService._cleanOutput(ocrService.tokenizer.decode(outputIds), decoder.stopStr))
+        elapsed = time.perf_counter() - startTime
+        if fp32TextList is None:
+            fp32TextList = textList
+        truthCer = sum(BenchTool.getCer(text, reference) for text, reference in zip(textList, referenceList)) / len(pageList)
+        fp32Cer = sum(BenchTool.getCer(text, reference) for text, reference in zip(textList, fp32TextList)) / len(pageList)
+        rowList.append((mode or "fp32", tokenCount / elapsed, truthCer, fp32Cer, getDecoderMb(ocrService.model)))
+        del decoder, ocrService
+        gc.collect()
+
+    BenchTool.printTable(f"Decoder weights, {len(pageList)} synthetic pages, lm_head {'quantized' if quantLmHead else 'fp32'}",
+                         ("weights", "tokens/s", "CER vs truth", "CER vs fp32", "layers + lm_head MB"), rowList)
@@ -0,0 +1,135 @@
+import hashlib
+import os
+
+import torch
+from app.code.utils.LogTool import LogTool
+
+
+class VisionCompiler:
+    """
+    Ahead-of-time compiled vision tower (vary_b) for a fixed set of batch sizes.
+
+    The tower always sees (B, 3, 1024, 1024), so each batch size is exported once with
+    torch.export and compiled with AOTInductor into a .pt2 package. Packages are cached on
+    disk, keyed by a hash of the tower weights, the torch version, device, dtype and batch
+    size, so later process starts only load them. A call with a batch size that was not
+    compiled is padded up to the next compiled size, or split by the largest one.
+
+    Set it as GOTQwenModel.vision_runner (see OcrService.setVisionBackend); warmUp compiles
+    or loads every size and runs it once.
+    """
+
+    def __init__(self, visionTower, cacheDir, batchSizeList=(1, 2, 4, 8), imageSize=1024):
+        """
+        Args:
+            visionTower (ImageEncoderViT): Loaded tower, already on its device and dtype and
+                frozen with optimize_for_inference.
+            cacheDir (str): Directory of the compiled packages.
+            batchSizeList (list): Batch sizes to compile.
+            imageSize (int): Input size of the tower.
+        """
+        import torch._inductor
+        if not hasattr(torch, "export") or not hasattr(torch._inductor, "aoti_compile_and_package"):
+            raise RuntimeError(f"Compiled vision tower needs torch.export and AOTInductor packaging (torch >= 2.6), found torch {torch.__version__}")
+        self.visionTower = visionTower
+        self.cacheDir = cacheDir
+        self.batchSizeList = sorted(set(batchSizeList))
+        self.imageSize = imageSize
+        parameter = next(visionTower.parameters())
+        self.device = parameter.device
+        self.dtype = parameter.dtype
+        self.modelHash = VisionCompiler.getModelHash(visionTower)
+        self.runnerDict = {}
+
+    @staticmethod
+    def getModelHash(module):
+        """
+        Short sha256 of the module's state (names, shapes, dtypes and bytes) and of the
+        forward variant, so a changed checkpoint or forward path never loads a stale package.
+        """
+        hasher = hashlib.sha256()
+        hasher.update(f"fused_neck={getattr(module, 'fused_neck', False)}".encode())
+        for name, tensor in module.state_dict().items():
+            hasher.update(f"{name}:{tuple(tensor.shape)}:{tensor.dtype}".encode())
+            hasher.update(tensor.detach().cpu().contiguous().view(torch.uint8).numpy().tobytes())
+        return hasher.hexdigest()[:16]
+
+    def getArtifactPath(self, batchSize):
+        torchVersion = torch.__version__.replace("+", "_")
+        dtypeName = str(self.dtype).replace("torch.", "")
+        fileName = f"visionTower-{self.modelHash}-torch{torchVersion}-{self.device.type}-{dtypeName}-b{batchSize}.pt2"
+        return os.path.join(self.cacheDir, fileName)
+
+    def warmUp(self):
+        """
+        Loads the package of every batch size, compiling the missing ones, and runs each once.
+        """
+        os.makedirs(self.cacheDir, exist_ok=True)
+        for batchSize in self.batchSizeList:
+            artifactPath = self.getArtifactPath(batchSize)
+            if not os.path.exists(artifactPath):
+                LogTool.info(f"Compiling vision tower for batch size {batchSize}: {artifactPath}")
+                self._compile(batchSize, artifactPath)
+            self.runnerDict[batchSize] = torch._inductor.aoti_load_package(artifactPath)
+            with torch.inference_mode():
+                self.runnerDict[batchSize](self._makeExample(batchSize))
+        LogTool.info(f"Compiled vision tower ready for batch sizes {self.batchSizeList}")
+
+    def _makeExample(self, batchSize):
+        return torch.zeros(batchSize, 3, self.imageSize, self.imageSize, device=self.device, dtype=self.dtype)
+
+    def _compile(self, batchSize, artifactPath):
+        with torch.no_grad():
+            exported = torch.export.export(self.visionTower, (self._makeExample(batchSize),))
+        # Written under a temporary name first, so a crash never leaves a half-written package
+        tmpPath = f"{artifactPath}.{os.getpid()}.tmp.pt2"
+        torch._inductor.aoti_compile_and_package(exported, package_path=tmpPath)
+        os.replace(tmpPath, artifactPath)
+
+    def __call__(self, images):
+        """
+        (B, 3, S, S) -> tower output of the same batch size.
+        """
+        count = images.shape[0]
+        largest = self.batchSizeList[-1]
+        if count > largest:
+            return torch.cat([self(chunk) for chunk in images.split(largest)], dim=0)
+        batchSize = next(size for size in self.batchSizeList if size >= count)
+        if batchSize > count:
+            padding = images.new_zeros((batchSize - count,) + tuple(images.shape[1:]))
+            return self.runnerDict[batchSize](torch.cat([images, padding], dim=0))[:count]
+        return self.runnerDict[batchSize](images)
+
+
+if __name__ == "__main__":
+    # Cold compile, cached start and latency of the compiled tower against eager.
+    # Run from the project root: python -m app.code.core.VisionCompiler [modelDir] [cacheDir]
+    import sys
+    import time
+    from app.code.core.OcrService import OcrService
+    from app.code.utils.BenchTool import BenchTool
+
+    modelDirPath = sys.argv[1] if len(sys.argv) > 1 else "app/code/data/"
+    cacheDir = sys.argv[2] if len(sys.argv) > 2 else os.path.join(modelDirPath, "vision_cache")
+    ocrService = OcrService(modelDirPath)
+    visionTower = ocrService.model.model.vision_tower_high
+
+    compiler = VisionCompiler(visionTower, cacheDir, batchSizeList=(1, 2))
+    startTime = time.perf_counter()
+    compiler.warmUp()
+    firstTime = time.perf_counter() - startTime
+    compiler = VisionCompiler(visionTower, cacheDir, batchSizeList=(1, 2))
+    startTime = time.perf_counter()
+    compiler.warmUp()
+    cachedTime = time.perf_counter() - startTime
+    print(f"Warm-up: first {firstTime:.1f}s, from the disk cache {cachedTime:.1f}s")
+
+    rowList = []
+    for batchSize in (1, 2):
+        images = torch.randn(batchSize, 3, 1024, 1024, device=compiler.device, dtype=compiler.dtype)
+        with torch.inference_mode():
+            maxDiff = (visionTower(images) - compiler(images)).abs().max().item()
+            eagerMs = BenchTool.timeIt(lambda: visionTower(images), repeat=3)["p50Ms"]
+            compiledMs = BenchTool.timeIt(lambda: compiler(images), repeat=3)["p50Ms"]
+        rowList.append((batchSize, eagerMs, compiledMs, eagerMs / compiledMs, f"{maxDiff:.1e}"))
+    BenchTool.printTable("Vision tower, eager vs compiled", ("batch", "eager ms", "compiled ms", "speedup", "max abs diff"), rowList)
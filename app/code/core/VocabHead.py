@@ -0,0 +1,174 @@
+import torch
+
+
+class VocabHead:
+    """
+    Output projection of the decode loops (GreedyDecoder, DecodeScheduler), full or restricted.
+
+    The tied lm_head is 1024 x 151860, a large part of the per-token cost on CPU. Documents of a
+    known script set never need most of that vocabulary, so a restricted head keeps only the rows
+    of a token whitelist: logits are computed for those tokens only, argmax runs over them and the
+    winner is mapped back to its full id. The full head (tokenIds None) is plain lm_head.
+
+    Decoding is unchanged whenever the full argmax is in the whitelist, which is the case as long
+    as the page only uses the whitelisted scripts.
+    """
+
+    # Unicode ranges per script. "common" (whitespace, digits, ASCII punctuation, general
+    # punctuation, currency, arrows and math symbols) is always included.
+    SCRIPT_RANGES = {
+        "common": [(0x09, 0x0A), (0x0D, 0x0D), (0x20, 0x40), (0x5B, 0x60), (0x7B, 0x7E), (0xA0, 0xBF), (0xD7, 0xD7), (0xF7, 0xF7),
+                   (0x2000, 0x206F), (0x20A0, 0x20CF), (0x2100, 0x214F), (0x2190, 0x22FF), (0x2460, 0x24FF), (0x25A0, 0x25FF)],
+        "latin": [(0x41, 0x5A), (0x61, 0x7A), (0xC0, 0xD6), (0xD8, 0xF6), (0xF8, 0x24F), (0x1E00, 0x1EFF)],
+        "greek": [(0x370, 0x3FF)],
+        "cyrillic": [(0x400, 0x4FF)],
+        "cjk": [(0x2E80, 0x2FDF), (0x3000, 0x30FF), (0x3100, 0x31BF), (0x3400, 0x4DBF), (0x4E00, 0x9FFF),
+                (0xAC00, 0xD7AF), (0xF900, 0xFAFF), (0xFE30, 0xFE4F), (0xFF00, 0xFFEF)],
+    }
+
+    def __init__(self, lmHead, tokenIds=None):
+        """
+        Args:
+            lmHead (nn.Linear or QuantLinear): The model's lm_head.
+            tokenIds (list): Whitelisted full token ids; None for the full vocabulary.
+        """
+        self.lmHead = lmHead
+        self.restricted = tokenIds is not None
+        self.weight = None
+        self.quantHead = None
+        if self.restricted:
+            tokenIds = sorted(set(tokenIds))
+            if hasattr(lmHead, "selectRows"):
+                # Quantized lm_head (QuantLinear): the kept rows stay quantized in a smaller QuantLinear
+                self.tokenIds = torch.as_tensor(tokenIds, dtype=torch.long, device=lmHead.qweight.device)
+                self.quantHead = lmHead.selectRows(self.tokenIds)
+            else:
+                self.tokenIds = torch.as_tensor(tokenIds, dtype=torch.long, device=lmHead.weight.device)
+                # Contiguous copy of the kept rows, so the matmul streams only those
+                self.weight = lmHead.weight.detach()[self.tokenIds].contiguous()
+            self.indexDict = {tokenId: index for index, tokenId in enumerate(tokenIds)}
+
+    def getLogits(self, hiddenStates):
+        """
+        (B, hidden) -> (B, V) fp32 logits, V is the full or the whitelisted vocabulary.
+        """
+        if not self.restricted:
+            return self.lmHead(hiddenStates).float()
+        if self.quantHead is not None:
+            return self.quantHead(hiddenStates).float()
+        return torch.matmul(hiddenStates, self.weight.t()).float()
+
+    def toIndexList(self, tokenIdList):
+        """
+        Logit columns of full token ids; ids outside the whitelist are dropped.
+        """
+        if not self.restricted:
+            return tokenIdList
+        return [self.indexDict[tokenId] for tokenId in tokenIdList if tokenId in self.indexDict]
+
+    def toTokenIds(self, indexTensor):
+        """
+        Full token ids of argmax results.
+        """
+        if not self.restricted:
+            return indexTensor
+        return self.tokenIds[indexTensor]
+
+    @staticmethod
+    def buildWhitelist(tokenizer, scriptList):
+        """
+        Token ids whose bytes only spell characters of the given scripts (plus "common"),
+        and every special token (<|im_end|>, <|endoftext|>, image and box tags).
+
+        Qwen tokens are byte-level, so a token can hold part of a multi-byte character. Such a
+        token is kept when its cut-off start and end are pieces of an allowed character.
+        """
+        unknownList = [script for script in scriptList if script not in VocabHead.SCRIPT_RANGES]
+        if unknownList:
+            raise ValueError(f"Unknown scripts {unknownList}, known: {sorted(VocabHead.SCRIPT_RANGES)}")
+
+        charSet = set()
+        for script in ["common"] + list(scriptList):
+            for start, end in VocabHead.SCRIPT_RANGES[script]:
+                charSet.update(range(start, end + 1))
+
+        # Pieces of multi-byte characters: starts (lead byte...), ends (...last byte) and inner parts
+        headSet, tailSet, innerSet = set(), set(), set()
+        for codePoint in charSet:
+            data = chr(codePoint).encode("utf-8", "surrogatepass")
+            for cut in range(1, len(data)):
+                headSet.add(data[:cut])
+                tailSet.add(data[cut:])
+                for end in range(cut + 1, len(data)):
+                    innerSet.add(data[cut:end])
+
+        idList = [tokenId for tokenBytes, tokenId in tokenizer.mergeable_ranks.items()
+                  if VocabHead._isAllowed(tokenBytes, charSet, headSet, tailSet, innerSet)]
+        idList.extend(tokenizer.special_tokens.values())
+        return sorted(idList)
+
+    @staticmethod
+    def _isAllowed(tokenBytes, charSet, headSet, tailSet, innerSet):
+        # Leading continuation bytes: the end of a character cut at the token start
+        start = 0
+        while start < len(tokenBytes) and 0x80 <= tokenBytes[start] <= 0xBF:
+            start += 1
+        if start == len(tokenBytes):
+            return tokenBytes in tailSet or tokenBytes in innerSet
+        if start > 0 and tokenBytes[:start] not in tailSet:
+            return False
+
+        # Trailing incomplete character: the start of a character cut at the token end
+        end = len(tokenBytes)
+        lead = end - 1
+        while lead > start and 0x80 <= tokenBytes[lead] <= 0xBF:
+            lead -= 1
+        leadByte = tokenBytes[lead]
+        needed = 1 if leadByte < 0x80 else 2 if leadByte >= 0xC0 and leadByte < 0xE0 else 3 if leadByte < 0xF0 else 4
+        if leadByte >= 0xC0 and end - lead < needed:
+            if tokenBytes[lead:] not in headSet:
+                return False
+            end = lead
+
+        try:
+            text = tokenBytes[start:end].decode("utf-8")
+        except UnicodeDecodeError:
+            return False
+        return all(ord(char) in charSet for char in text)
+
+
+if __name__ == "__main__":
+    # Benchmark: restricted against full output head, decode tokens/s and output parity on synthetic pages.
+    # Run from the project root: python -m app.code.core.VocabHead [modelDir] [scripts, e.g. latin or latin,cjk]
+    import sys
+    import time
+    from app.code.core.OcrService import OcrService
+    from app.code.utils.BenchTool import BenchTool
+
+    modelDirPath = sys.argv[1] if len(sys.argv) > 1 else "app/code/data/"
+    scriptList = sys.argv[2].split(",") if len(sys.argv) > 2 else ["latin"]
+    ocrService = OcrService(modelDirPath)
+
+    rowList = []
+    for script in VocabHead.SCRIPT_RANGES:
+        if script != "common":
+            rowList.append((script, len(VocabHead.buildWhitelist(ocrService.tokenizer, [script]))))
+    BenchTool.printTable(f"Whitelist size per script (full vocabulary {ocrService.model.config.vocab_size})", ("script", "tokens"), rowList)
+
+    ocrInputList = [ocrService.prepareInput(BenchTool.makeTextPage(lineCount, seed=index)) for index, lineCount in enumerate((3, 12, 30))]
+    resultDict = {}
+    for mode in ("full", "restricted"):
+        ocrService.setVocabScripts(scriptList if mode == "restricted" else None)
+        decoder = ocrService.getGreedyDecoder()
+        startTime = time.perf_counter()
+        idsList = [decoder.generate(ocrInput) for ocrInput in ocrInputList]
+        resultDict[mode] = (idsList, time.perf_counter() - startTime)
+
+    fullIds, fullTime = resultDict["full"]
+    restrictedIds, restrictedTime = resultDict["restricted"]
+    tokenCount = sum(len(ids) for ids in fullIds)
+    BenchTool.printTable(f"Greedy decode, scripts {scriptList}", ("head", "tokens", "tokens/s"), [
+        ("full", tokenCount, tokenCount / fullTime),
+        ("restricted", sum(len(ids) for ids in restrictedIds), sum(len(ids) for ids in restrictedIds) / restrictedTime),
+    ])
+    print(f"Same tokens: {sum(a == b for a, b in zip(fullIds, restrictedIds))}/{len(ocrInputList)} pages")
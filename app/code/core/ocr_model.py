@@ -24,6 +24,13 @@ class GOTQwenModel(Qwen2Model):
 
         self.mm_projector_vary =  nn.Linear(1024, 1024)
 
+        # Max image patches per vision tower call, bounds the activation memory of big batches
+        self.vision_batch_size = getattr(config, "vision_batch_size", 8)
+        # Optional replacement of vision_tower_high with the same input and output, e.g. a VisionCompiler
+        self.vision_runner = None
+        # Optional replacement of vision_tower_high + mm_projector_vary returning (n, 256, 1024), e.g. an OnnxVisionEncoder
+        self.feature_runner = None
+
 
     def initialize_vision_modules(
         self,
@@ -80,6 +87,7 @@ class GOTQwenModel(Qwen2Model):
         output_hidden_states: Optional[bool] = None,
         images: Optional[torch.FloatTensor] = None,
         return_dict: Optional[bool] = None,
+        image_start_positions: Optional[torch.LongTensor] = None,
     ) -> Union[Tuple, BaseModelOutputWithPast]:
 
         # HACK: replace back original embeddings for LLaVA pretraining
@@ -88,6 +96,8 @@ class GOTQwenModel(Qwen2Model):
             with torch.no_grad():
                 self.get_input_embeddings().weight[:-self.num_new_tokens] = orig_embeds_params[:-self.num_new_tokens].data
 
+        # Embeddings made here can be changed in place, ones passed by the caller are not touched
+        inputs_embeds_owned = inputs_embeds is None
         if inputs_embeds is None:
             inputs_embeds = self.embed_tokens(input_ids)
 
@@ -99,100 +109,55 @@ class GOTQwenModel(Qwen2Model):
         # if True:
             # assert type(images) is list, ValueError("To fit both interleave and conversation, images must be list of batches of images")
             # print(im)
-            use_im_start_end = getattr(self.config, "use_im_start_end", -1)
-
-            vision_select_layer = getattr(self.config, "vision_select_layer", -1)
-            im_patch_token = getattr(self.config, "im_patch_token", -1)
-            im_start_token = getattr(self.config, "im_start_token", -1)
-            im_end_token = getattr(self.config, "im_end_token", -1)
-            freeze_vision_tower = getattr(self.config, "freeze_vision_tower", False)
-
-            im_patch_token = 151859
-
-            im_start_token = 151857
-
-            im_end_token = 151858
-            
-
-
-            image_features = []
-            
-
-            for image in images:
-                P, C, H, W = image[1].shape
-                # with torch.set_grad_enabled(True):
-                #     # print(image[1].shape)
-                #     #     cnn_feature = vision_tower_high(image[1])
-                #     #     cnn_feature = cnn_feature.flatten(2).permute(0, 2, 1) # 256  1024
-                #     #     # image_features.append(cnn_feature)
-                # # image_features_2.append(cnn_feature)
-                if P == 1:
-                    with torch.set_grad_enabled(False):
-                        # print(image[1].shape)
-                        cnn_feature = vision_tower_high(image[1])
-                        cnn_feature = cnn_feature.flatten(2).permute(0, 2, 1) # 256*1024
-                        # image_features.append(cnn_feature)
-                    # image_features_2.append(cnn_feature)
-                    image_feature = self.mm_projector_vary(cnn_feature)
-                    image_features.append(image_feature)
-
-                else:
-                    image_patches = torch.unbind(image[1])
-                    image_patches_features = []
-                    for image_patch in image_patches:
-                        image_p = torch.stack([image_patch])
-                        with torch.set_grad_enabled(False):
-                            cnn_feature_p = vision_tower_high(image_p)
-                            cnn_feature_p = cnn_feature_p.flatten(2).permute(0, 2, 1)
-                        image_feature_p = self.mm_projector_vary(cnn_feature_p)
-                        image_patches_features.append(image_feature_p)
-                    image_feature = torch.cat(image_patches_features, dim=1)
-                    # print(P)
-                    # print(image_feature.shape)
-                    # exit()
-                    image_features.append(image_feature)
-
-
-
-            dummy_image_features_2 = torch.zeros(256, 1024, device=inputs_embeds.device, dtype=inputs_embeds.dtype)
-            # dummy_image_features_2 = self.mm_projector_vary(dummy_image_features_2)
-            dummy_image_features = dummy_image_features_2
-            use_im_start_end = True
-            new_input_embeds = []
-            for cur_input_ids, cur_input_embeds, cur_image_features in zip(input_ids, inputs_embeds, image_features):
-                if (cur_input_ids == im_patch_token).sum() == 0:
-                    # multimodal LLM, but the current sample is not multimodal
-                    cur_input_embeds = cur_input_embeds + (0. * dummy_image_features).sum()
-                    new_input_embeds.append(cur_input_embeds)
-                    continue
-
-                if use_im_start_end:
-                    if (cur_input_ids == im_start_token).sum() != (cur_input_ids == im_end_token).sum():
-                        raise ValueError("The number of image start tokens and image end tokens should be the same.")
-                    
-                    image_start_tokens = torch.where(cur_input_ids == im_start_token)[0]
-                    for image_start_token_pos, per_cur_image_features in zip(image_start_tokens, cur_image_features):
-                        per_cur_image_features = per_cur_image_features.to(device=cur_input_embeds.device)
-                        num_patches = per_cur_image_features.shape[0]
-
-                        if cur_input_ids[image_start_token_pos + num_patches + 1] != im_end_token:
-                            raise ValueError("The image end token should follow the image start token.")
-                        
-                        cur_input_embeds = torch.cat(
-                            (
-                                cur_input_embeds[:image_start_token_pos+1], 
-                                per_cur_image_features, 
-                                cur_input_embeds[image_start_token_pos + num_patches + 1:]
-                            ), 
-                            dim=0
-                        )
-
-
-                    new_input_embeds.append(cur_input_embeds)
+            im_patch_token = getattr(self.config, "im_patch_token", 151859)
+
+            # All patches of all images go through the vision tower together, in sub-batches of
+            # vision_batch_size, and through the projector in one pass; then split back per image
+            patch_counts = [image[1].shape[0] for image in images]
+            all_patches = torch.cat([image[1] for image in images], dim=0) if len(images) > 1 else images[0][1]
+            patch_chunks = all_patches.split(max(1, self.vision_batch_size))
+            if self.feature_runner is not None:
+                # Tower and projector in one external call, already (n, 256, 1024)
+                feature_chunks = [self.feature_runner(patch_chunk) for patch_chunk in patch_chunks]
+                projected_features = feature_chunks[0] if len(feature_chunks) == 1 else torch.cat(feature_chunks, dim=0)
+                projected_features = projected_features.to(device=all_patches.device, dtype=self.mm_projector_vary.weight.dtype)
+            else:
+                vision_encoder = self.vision_runner if self.vision_runner is not None else vision_tower_high
+                with torch.set_grad_enabled(False):
+                    cnn_chunks = [
+                        # (n, 1024, 16, 16) -> (n, 256, 1024), a view when the tower returns channels-last
+                        vision_encoder(patch_chunk).permute(0, 2, 3, 1).flatten(1, 2)
+                        for patch_chunk in patch_chunks
+                    ]
+                    cnn_features = cnn_chunks[0] if len(cnn_chunks) == 1 else torch.cat(cnn_chunks, dim=0)
+                projected_features = self.mm_projector_vary(cnn_features)
+            image_features = [features.reshape(1, -1, features.shape[-1]) for features in projected_features.split(patch_counts)]
+
+            # One masked_scatter over the whole batch writes the projected features at the
+            # <imgpad> positions, in row order, instead of rebuilding every row with torch.cat
+            if image_start_positions is not None:
+                # Image block offsets are known from the prompt template, no need to search the ids;
+                # a negative start means the row has no image
+                startList = image_start_positions.tolist()
+                offsets = torch.arange(input_ids.shape[1], device=input_ids.device).unsqueeze(0)
+                featureCounts = torch.as_tensor([features.shape[0] * features.shape[1] if start >= 0 else 0
+                                                 for start, features in zip(startList, image_features)], device=input_ids.device)
+                image_mask = (offsets > image_start_positions.unsqueeze(1)) & (offsets <= image_start_positions.unsqueeze(1) + featureCounts.unsqueeze(1))
+                image_features = [features for start, features in zip(startList, image_features) if start >= 0]
+            else:
+                image_mask = input_ids == im_patch_token
+                # Rows without <imgpad> tokens are not multimodal, their image features are not used
+                image_features = [features for has_image, features in zip(image_mask.any(dim=1).tolist(), image_features) if has_image]
+                if image_mask.sum() != sum(features.shape[0] * features.shape[1] for features in image_features):
+                    raise ValueError("The number of image patch tokens does not match the number of image features.")
+
+            if image_features:
+                all_image_features = torch.cat([features.reshape(-1, features.shape[-1]) for features in image_features], dim=0)
+                all_image_features = all_image_features.to(device=inputs_embeds.device, dtype=inputs_embeds.dtype)
+                if inputs_embeds_owned:
+                    inputs_embeds.masked_scatter_(image_mask.unsqueeze(-1), all_image_features)
                 else:
-                    raise NotImplementedError
-
-            inputs_embeds = torch.stack(new_input_embeds, dim=0)
+                    inputs_embeds = inputs_embeds.masked_scatter(image_mask.unsqueeze(-1), all_image_features)
 
         return super(GOTQwenModel, self).forward(
             input_ids=None, attention_mask=attention_mask, past_key_values=past_key_values,
@@ -238,6 +203,8 @@ class GOTQwenForCausalLM(Qwen2ForCausalLM):
         output_hidden_states: Optional[bool] = None,
         images: Optional[torch.FloatTensor] = None,
         return_dict: Optional[bool] = None,
+        image_start_positions: Optional[torch.LongTensor] = None,
+        num_logits_to_keep: int = 0,
         
     ) -> Union[Tuple, CausalLMOutputWithPast]:
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
@@ -262,12 +229,17 @@ class GOTQwenForCausalLM(Qwen2ForCausalLM):
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             images=images,
-            return_dict=return_dict
+            return_dict=return_dict,
+            image_start_positions=image_start_positions
             
         )
 
 
         hidden_states = outputs[0]
+        if labels is None and num_logits_to_keep > 0:
+            # Generation only reads the last positions; projecting all of them to the 151k vocab
+            # at prefill would materialize hundreds of MB of fp32 logits for nothing
+            hidden_states = hidden_states[:, -num_logits_to_keep:, :]
         logits = self.lm_head(hidden_states)
         logits = logits.float()
 
@@ -357,6 +329,8 @@ class GOTQwenForCausalLM(Qwen2ForCausalLM):
                 "use_cache": kwargs.get("use_cache"),
                 "attention_mask": attention_mask,
                 "images": kwargs.get("images", None),
+                "image_start_positions": kwargs.get("image_start_positions", None),
+                "num_logits_to_keep": kwargs.get("num_logits_to_keep", 0),
             }
         )
         return model_inputs
@@ -390,3 +364,71 @@ class GOTQwenForCausalLM(Qwen2ForCausalLM):
 
 AutoConfig.register("GOT", GOTConfig)
 AutoModelForCausalLM.register(GOTConfig, GOTQwenForCausalLM)
+
+
+if __name__ == "__main__":
+    # Benchmark: prefill with logits for every position against logits for the last position only.
+    # Each mode runs in its own process, so one mode's peak memory does not hide the other's; on the CPU
+    # the peak is the resident size (reset after the warm-up) and is reported above the loaded model.
+    # Run from the project root: python -m app.code.core.ocr_model [modelDir] [--random_weights]
+    # --random_weights needs only config.json: random weights and fixed image features instead of the
+    # vision tower, so the peak is the decoder's.
+    import json
+    import subprocess
+    import sys
+    from transformers import AutoTokenizer
+    from app.code.core.PromptCompiler import PromptCompiler
+    from app.code.utils.BenchTool import BenchTool
+
+    argList = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    modelDirPath = argList[0] if argList else "app/code/data/"
+    randomWeights = "--random_weights" in sys.argv
+
+    if "--keep" not in sys.argv:
+        rowList = []
+        for keep in (0, 1):
+            command = [sys.executable, "-m", "app.code.core.ocr_model", modelDirPath, "--keep", str(keep)] + (["--random_weights"] if randomWeights else [])
+            output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+            rowList.append(json.loads(output.strip().splitlines()[-1]))
+        device = rowList[0].pop()
+        rowList[1].pop()
+        BenchTool.printTable(f"Prefill logits, {device}, {torch.get_num_threads()} threads{', random weights' if randomWeights else ''}",
+                             ("logits", "positions", "logits MB", "prefill ms", "peak MB over model", "peak MB"), rowList)
+        sys.exit(0)
+
+    keep = int(sys.argv[sys.argv.index("--keep") + 1])
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    dtype = torch.bfloat16 if device == "cuda" else torch.float32
+    tokenizer = AutoTokenizer.from_pretrained(modelDirPath, trust_remote_code=True)
+    if randomWeights:
+        torch.manual_seed(0)
+        model = GOTQwenForCausalLM(GOTConfig.from_pretrained(modelDirPath, pad_token_id=151643)).eval()
+        features = torch.randn(1, 256, model.config.hidden_size, device=device, dtype=dtype) * 0.02
+        model.model.feature_runner = lambda patches: features.expand(patches.shape[0], -1, -1)
+    else:
+        model = GOTQwenForCausalLM.from_pretrained(modelDirPath, low_cpu_mem_usage=True, use_safetensors=True, pad_token_id=151643).eval()
+    model.to(device=device, dtype=dtype)
+
+    template = PromptCompiler(tokenizer).compile("OCR: ")
+    inputIds = template.inputIds.unsqueeze(0).to(device)
+    images = [(None, torch.randn(1, 3, 1024, 1024, device=device, dtype=dtype))]
+    imageStart = torch.as_tensor([template.imageStart], device=device)
+
+    def prefill():
+        with torch.inference_mode():
+            return model(input_ids=inputIds, images=images, image_start_positions=imageStart, use_cache=True, num_logits_to_keep=keep)
+
+    logitsMb = prefill().logits.numel() * 4 / 1024 / 1024
+    if device == "cuda":
+        baseMb = torch.cuda.memory_allocated() / 1024 / 1024
+        torch.cuda.reset_peak_memory_stats()
+        prefill()
+        peakMb = torch.cuda.max_memory_allocated() / 1024 / 1024
+    else:
+        baseMb = BenchTool.getRssMb()
+        BenchTool.resetPeakRss()
+        prefill()
+        peakMb = BenchTool.getPeakRssMb()
+    cost = BenchTool.timeIt(prefill, repeat=3)
+    print(json.dumps(["all positions" if keep == 0 else "last only", inputIds.shape[1], logitsMb, cost["meanMs"],
+                      peakMb - baseMb, peakMb, device]))
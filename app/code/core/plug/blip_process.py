@@ -493,6 +493,63 @@ class BlipImageEvalProcessor(BlipImageBaseProcessor):
         return self.transform(item)
 
 
+class BlipImageFastEvalProcessor(BlipImageBaseProcessor):
+    """
+    Faster drop-in for BlipImageEvalProcessor on CPU.
+
+    The bicubic resize runs on the uint8 image (the same PIL resize torchvision uses), then the
+    uint8 -> float conversion, the /255 and the normalize are done in one pass straight into a
+    preallocated float buffer, instead of ToTensor and Normalize each making a full float copy.
+    process_batch writes N images into one reusable (N, 3, S, S) buffer; the returned tensor is
+    overwritten by the next process_batch call.
+    """
+    def __init__(self, image_size=384, mean=None, std=None):
+        super().__init__(mean=mean, std=std)
+        self.image_size = image_size
+
+        mean = torch.tensor(self.normalize.mean, dtype=torch.float32).view(3, 1, 1)
+        std = torch.tensor(self.normalize.std, dtype=torch.float32).view(3, 1, 1)
+        # (x / 255 - mean) / std == x * scale + offset
+        self.scale = 1.0 / (255.0 * std)
+        self.offset = -mean / std
+        self.buffer = None
+
+    def _get_buffer(self, count):
+        if self.buffer is None or self.buffer.shape[0] < count:
+            self.buffer = torch.empty((count, 3, self.image_size, self.image_size), dtype=torch.float32)
+        return self.buffer[:count]
+
+    def _to_pixels(self, item):
+        if isinstance(item, np.ndarray):
+            item = Image.fromarray(item)
+        if item.mode != "RGB":
+            item = item.convert("RGB")
+        if item.size != (self.image_size, self.image_size):
+            item = item.resize((self.image_size, self.image_size), Image.BICUBIC)
+        # HWC uint8 view of the resized image
+        return torch.from_numpy(np.array(item, dtype=np.uint8))
+
+    def process_batch(self, items, out=None):
+        """
+        Args:
+            items (list): PIL images or uint8 HWC numpy arrays.
+            out (Tensor): optional (N, 3, S, S) float tensor to write into instead of the shared buffer.
+        Returns:
+            Tensor: normalized batch with shape (N, 3, S, S).
+        """
+        batch = out if out is not None else self._get_buffer(len(items))
+        for i, item in enumerate(items):
+            pixels = self._to_pixels(item)
+            # uint8 -> float happens inside copy_, together with the HWC -> CHW layout change
+            batch[i].copy_(pixels.permute(2, 0, 1))
+            torch.addcmul(self.offset, batch[i], self.scale, out=batch[i])
+        return batch
+
+    def __call__(self, item):
+        out = torch.empty((1, 3, self.image_size, self.image_size), dtype=torch.float32)
+        return self.process_batch([item], out=out)[0]
+
+
 # if __name__ == "__main__":
 #     a = BlipImageTrainProcessor(image_size=1024)
 #     # img = np.random.randn(1024, 1024, 3)
@@ -502,3 +559,28 @@ class BlipImageEvalProcessor(BlipImageBaseProcessor):
 #     y = a(x)
 
 #     print(y.size())
+
+
+if __name__ == "__main__":
+    # Parity and speed check of the fast processor against the torchvision one.
+    # Run from the project root: python -m app.code.core.plug.blip_process
+    from app.code.utils.BenchTool import BenchTool
+
+    rng = np.random.default_rng(0)
+    image_list = [Image.fromarray(rng.integers(0, 256, (1754, 1240, 3), dtype=np.uint8)) for _ in range(4)]
+
+    slow = BlipImageEvalProcessor(image_size=1024)
+    fast = BlipImageFastEvalProcessor(image_size=1024)
+
+    expected = torch.stack([slow(image) for image in image_list])
+    actual = fast.process_batch(image_list)
+    max_diff = (expected - actual).abs().max().item()
+    print(f"max abs diff: {max_diff:.2e}")
+    assert torch.allclose(expected, actual, atol=1e-4), "fast processor output differs from BlipImageEvalProcessor"
+
+    slow_cost = BenchTool.timeIt(lambda: torch.stack([slow(image) for image in image_list]), repeat=5)
+    fast_cost = BenchTool.timeIt(lambda: fast.process_batch(image_list), repeat=5)
+    BenchTool.printTable("Preprocess 4 pages to (4, 3, 1024, 1024)", ("engine", "mean ms", "min ms"), [
+        ("torchvision", slow_cost["meanMs"], slow_cost["minMs"]),
+        ("fast", fast_cost["meanMs"], fast_cost["minMs"]),
+    ])
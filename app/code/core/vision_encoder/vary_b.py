@@ -82,6 +82,10 @@ class LayerNorm2d(nn.Module):
         x = self.weight[:, None, None] * x + self.bias[:, None, None]
         return x
 
+    def forward_channels_last(self, x: torch.Tensor) -> torch.Tensor:
+        """Same normalization on a (B, H, W, C) tensor, as one fused layer_norm over C."""
+        return F.layer_norm(x, (x.shape[-1],), self.weight, self.bias, self.eps)
+
 
 # This class and its supporting functions below lightly adapted from the ViTDet backbone available at: https://github.com/facebookresearch/detectron2/blob/main/detectron2/modeling/backbone/vit.py # noqa
 class ImageEncoderViT(nn.Module):
@@ -177,6 +181,25 @@ class ImageEncoderViT(nn.Module):
         self.net_2 = nn.Conv2d(256, 512, kernel_size=3, stride=2, padding=1, bias=False)
         self.net_3 = nn.Conv2d(512, 1024, kernel_size=3, stride=2, padding=1, bias=False)
 
+        # Set by optimize_for_inference
+        self.fused_neck = False
+
+    def optimize_for_inference(self) -> "ImageEncoderViT":
+        """
+        Freezes the tower for inference: eval mode, no gradients, rel-pos tables built
+        (build_rel_pos_cache), conv weights in channels-last layout and the fused neck path
+        (forward_neck_fused). Call it after the weights are loaded and moved to their device
+        and dtype. Run python -m app.code.core.vision_encoder.vary_b for parity and the CPU
+        latency of one 1024x1024 page with and without it.
+        """
+        self.eval()
+        self.requires_grad_(False)
+        build_rel_pos_cache(self)
+        for conv in (self.neck[2], self.net_2, self.net_3):
+            conv.to(memory_format=torch.channels_last)
+        self.fused_neck = True
+        return self
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         x = self.patch_embed(x)
         if self.pos_embed is not None:
@@ -185,6 +208,9 @@ class ImageEncoderViT(nn.Module):
         for blk in self.blocks:
             x = blk(x)
 
+        if self.fused_neck:
+            return self.forward_neck_fused(x)
+
         x = self.neck(x.permute(0, 3, 1, 2))
         x = self.net_2(x)
         x = self.net_3(x)
@@ -192,6 +218,27 @@ class ImageEncoderViT(nn.Module):
 
         return x
 
+    def forward_neck_fused(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        neck, net_2 and net_3 on the (B, H, W, C) block output without layout copies.
+
+        The 1x1 conv has no bias, so it is a matmul over the channels of the block output as it
+        is; each LayerNorm2d is one layer_norm over the last dim of the (B, H, W, C) view. The
+        NCHW tensors handed to the 3x3 convs are permuted views of channels-last memory, so the
+        convs run (and return) channels-last. The LayerNorm2d affine can not be folded into the
+        following convs exactly, their zero padding would see the shifted border.
+
+        Returns (B, 1024, H / 4, W / 4) in channels-last memory format.
+        """
+        conv_1, norm_1, conv_2, norm_2 = self.neck
+        x = F.linear(x, conv_1.weight.flatten(1))
+        x = norm_1.forward_channels_last(x)
+        x = conv_2(x.permute(0, 3, 1, 2))
+        x = norm_2.forward_channels_last(x.permute(0, 2, 3, 1)).permute(0, 3, 1, 2)
+        x = self.net_2(x)
+        x = self.net_3(x)
+        return x
+
 
 class Block(nn.Module):
     """Transformer blocks with support of window attention and residual propagation blocks"""
@@ -270,6 +317,7 @@ class Attention(nn.Module):
         use_rel_pos: bool = False,
         rel_pos_zero_init: bool = True,
         input_size: Optional[Tuple[int, int]] = None,
+        use_sdpa: bool = True,
     ) -> None:
         """
         Args:
@@ -280,9 +328,13 @@ class Attention(nn.Module):
             rel_pos_zero_init (bool): If True, zero initialize relative positional parameters.
             input_size (tuple(int, int) or None): Input resolution for calculating the relative
                 positional parameter size.
+            use_sdpa (bool): If True, run F.scaled_dot_product_attention with the relative
+                positional terms as an additive bias, otherwise the eager softmax path.
         """
         super().__init__()
         self.num_heads = num_heads
+        self.use_sdpa = use_sdpa and hasattr(F, "scaled_dot_product_attention")
+        self.input_size = input_size
         head_dim = dim // num_heads
         self.scale = head_dim**-0.5
 
@@ -298,7 +350,57 @@ class Attention(nn.Module):
             self.rel_pos_h = nn.Parameter(torch.zeros(2 * input_size[0] - 1, head_dim))
             self.rel_pos_w = nn.Parameter(torch.zeros(2 * input_size[1] - 1, head_dim))
 
+        # Gathered rel-pos tables, see get_rel_pos_tables
+        self.use_rel_pos_cache = True
+        self._rel_pos_cache = None
+
+    def get_rel_pos_tables(self, q_size: Tuple[int, int], k_size: Tuple[int, int]) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        The tables (Rh, Rw) of get_rel_pos for the given query and key sizes.
+
+        They only depend on the sizes and on rel_pos_h / rel_pos_w, so at inference time they
+        are computed once and reused. The cache is keyed by the sizes and by the storage,
+        version, dtype and device of both parameters: load_state_dict, .to() or any in-place
+        update of the parameters rebuilds it on the next call. When gradients flow into the
+        parameters, or while the tower is traced by torch.compile / torch.export (the compiler
+        folds them itself), the tables are always computed fresh.
+        """
+        if not self.use_rel_pos_cache or _is_compiling() or (torch.is_grad_enabled() and self.rel_pos_h.requires_grad):
+            return get_rel_pos(q_size[0], k_size[0], self.rel_pos_h), get_rel_pos(q_size[1], k_size[1], self.rel_pos_w)
+
+        key = (q_size, k_size, _get_tensor_key(self.rel_pos_h), _get_tensor_key(self.rel_pos_w))
+        if self._rel_pos_cache is None or self._rel_pos_cache[0] != key:
+            with torch.no_grad():
+                Rh = get_rel_pos(q_size[0], k_size[0], self.rel_pos_h).contiguous()
+                Rw = get_rel_pos(q_size[1], k_size[1], self.rel_pos_w).contiguous()
+            self._rel_pos_cache = (key, Rh, Rw)
+        return self._rel_pos_cache[1], self._rel_pos_cache[2]
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if self.use_sdpa:
+            return self.forward_sdpa(x)
+        return self.forward_eager(x)
+
+    def forward_sdpa(self, x: torch.Tensor) -> torch.Tensor:
+        B, H, W, _ = x.shape
+        # q, k, v with shape (B, nHead, H * W, C)
+        q, k, v = self.qkv(x).reshape(B, H * W, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4).unbind(0)
+
+        attn_bias = None
+        if self.use_rel_pos:
+            Rh, Rw = self.get_rel_pos_tables((H, W), (H, W))
+            attn_bias = get_decomposed_rel_pos_bias(
+                q.reshape(B * self.num_heads, H * W, -1), Rh, Rw, (H, W), (H, W)
+            ).view(B, self.num_heads, H * W, H * W)
+
+        # The default scale of scaled_dot_product_attention is head_dim ** -0.5, the same as self.scale
+        x = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_bias)
+        x = x.view(B, self.num_heads, H, W, -1).permute(0, 2, 3, 1, 4).reshape(B, H, W, -1)
+        x = self.proj(x)
+
+        return x
+
+    def forward_eager(self, x: torch.Tensor) -> torch.Tensor:
         B, H, W, _ = x.shape
         # qkv with shape (3, B, nHead, H * W, C)
         qkv = self.qkv(x).reshape(B, H * W, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4)
@@ -438,6 +540,79 @@ def add_decomposed_rel_pos(
     return attn
 
 
+def get_decomposed_rel_pos_bias(
+    q: torch.Tensor,
+    Rh: torch.Tensor,
+    Rw: torch.Tensor,
+    q_size: Tuple[int, int],
+    k_size: Tuple[int, int],
+) -> torch.Tensor:
+    """
+    The decomposed relative positional terms of add_decomposed_rel_pos as an additive
+    attention bias, for F.scaled_dot_product_attention.
+    Args:
+        q (Tensor): query q in the attention layer with shape (B, q_h * q_w, C).
+        Rh (Tensor): gathered height table (q_h, k_h, C), get_rel_pos of rel_pos_h.
+        Rw (Tensor): gathered width table (q_w, k_w, C), get_rel_pos of rel_pos_w.
+        q_size (Tuple): spatial sequence size of query q with (q_h, q_w).
+        k_size (Tuple): spatial sequence size of key k with (k_h, k_w).
+
+    Returns:
+        attn_bias (Tensor): bias with shape (B, q_h * q_w, k_h * k_w).
+    """
+    q_h, q_w = q_size
+    k_h, k_w = k_size
+
+    B, _, dim = q.shape
+    r_q = q.reshape(B, q_h, q_w, dim)
+    rel_h = torch.einsum("bhwc,hkc->bhwk", r_q, Rh)
+    rel_w = torch.einsum("bhwc,wkc->bhwk", r_q, Rw)
+
+    return (rel_h[:, :, :, :, None] + rel_w[:, :, :, None, :]).reshape(B, q_h * q_w, k_h * k_w)
+
+
+def _is_compiling() -> bool:
+    is_compiling = getattr(getattr(torch, "compiler", None), "is_compiling", None)
+    return bool(is_compiling and is_compiling())
+
+
+def _get_tensor_key(tensor: torch.Tensor) -> Tuple:
+    return (tensor.data_ptr(), tensor._version, tensor.dtype, tensor.device)
+
+
+def build_rel_pos_cache(module: nn.Module) -> None:
+    """
+    Builds the rel-pos tables of every Attention block under module for its input size
+    (64x64 tokens for global blocks, 14x14 for window blocks). Call it after the weights
+    are loaded and moved, so the first forward does not pay for it.
+    """
+    for child in module.modules():
+        if isinstance(child, Attention) and child.use_rel_pos and child.input_size is not None:
+            child.use_rel_pos_cache = True
+            with torch.no_grad():
+                child.get_rel_pos_tables(child.input_size, child.input_size)
+
+
+def clear_rel_pos_cache(module: nn.Module, use_cache: bool = True) -> None:
+    """
+    Drops the cached rel-pos tables under module; with use_cache False they are also
+    computed on every forward from then on.
+    """
+    for child in module.modules():
+        if isinstance(child, Attention):
+            child._rel_pos_cache = None
+            child.use_rel_pos_cache = use_cache
+
+
+def set_attention_backend(module: nn.Module, use_sdpa: bool) -> None:
+    """
+    Switches every Attention block under module between the SDPA and the eager path.
+    """
+    for child in module.modules():
+        if isinstance(child, Attention):
+            child.use_sdpa = use_sdpa and hasattr(F, "scaled_dot_product_attention")
+
+
 class PatchEmbed(nn.Module):
     """
     Image to Patch Embedding.
@@ -527,21 +702,77 @@ def _build_vary(
 
 
 if __name__ == '__main__':
-
-    x = torch.zeros(2, 3, 1024, 1024)
-
-    # x.permute(0, 3, 1, 2)
-
-    net = build_vary_vit_b(checkpoint ='/mnt/shared-storage/tenant/hypertext/xpkong/jycode/checkpoint/pytorch_model.bin')
-    
-    # mlp = Projector(width=256, n_queries = 256, output_dim = 768)
-    y = net(x)
-    y = y.flatten(2).permute(0, 2, 1)
-    print(y.shape)
-    # y = mlp(y)
-    
-    # y = net_2(y)
-    # y = net_3(y)
-    # 
-
-    # print(y.shape)
\ No newline at end of file
+    # Parity and CPU timing: SDPA attention against the eager softmax path per block, the
+    # whole tower with and without the rel-pos table cache and with and without the fused neck.
+    # Random weights (rel-pos tables included) are enough, both paths share them.
+    # Run from the project root: python -m app.code.core.vision_encoder.vary_b [threads]
+    import sys
+    from app.code.utils.BenchTool import BenchTool
+
+    if len(sys.argv) > 1:
+        torch.set_num_threads(int(sys.argv[1]))
+    torch.manual_seed(0)
+    net = build_vary_vit_b().eval()
+    with torch.no_grad():
+        for blk in net.blocks:
+            blk.attn.rel_pos_h.normal_(std=0.02)
+            blk.attn.rel_pos_w.normal_(std=0.02)
+    x = torch.randn(1, 3, 1024, 1024)
+
+    with torch.inference_mode():
+        set_attention_backend(net, False)
+        y_eager = net(x)
+        set_attention_backend(net, True)
+        y_sdpa = net(x)
+    max_diff = (y_eager - y_sdpa).abs().max().item()
+    print(f"Tower output {tuple(y_sdpa.shape)}, max abs diff eager vs sdpa: {max_diff:.2e}")
+    assert torch.allclose(y_eager, y_sdpa, atol=1e-3, rtol=1e-3), "SDPA attention does not match the eager path"
+
+    # Vision tower latency: rel-pos tables computed on every forward against the prebuilt cache
+    towerRows = []
+    for label, use_cache in (("per forward", False), ("cached", True)):
+        clear_rel_pos_cache(net, use_cache)
+        if use_cache:
+            build_rel_pos_cache(net)
+        with torch.inference_mode():
+            towerRows.append((label, BenchTool.timeIt(lambda: net(x), repeat=3)["p50Ms"]))
+    BenchTool.printTable("vary_b tower latency, 1 page, rel-pos tables", ("rel-pos tables", "p50 ms"), towerRows)
+
+    # Inference freeze: the tower as loaded (NCHW neck, contiguous conv weights) against a copy
+    # after optimize_for_inference (channels-last fused neck). Timed interleaved, the neck alone
+    # on the block output and the whole tower; both have the rel-pos tables cached
+    frozen = build_vary_vit_b().eval()
+    frozen.load_state_dict(net.state_dict())
+    frozen.optimize_for_inference()
+    with torch.inference_mode():
+        block_output = net.patch_embed(x) + net.pos_embed
+        for blk in net.blocks:
+            block_output = blk(block_output)
+        y_plain = net(x)
+        y_fused = frozen(x)
+        neck_stats = BenchTool.timeInterleaved([lambda: net.net_3(net.net_2(net.neck(block_output.permute(0, 3, 1, 2)))),
+                                                lambda: frozen.forward_neck_fused(block_output)], repeat=30)
+        tower_stats = BenchTool.timeInterleaved([lambda: net(x), lambda: frozen(x)], repeat=3)
+    del frozen
+    max_diff = (y_plain - y_fused).abs().max().item()
+    print(f"Max abs diff plain vs fused neck: {max_diff:.2e}")
+    assert torch.allclose(y_plain, y_fused, atol=1e-3, rtol=1e-3), "Fused neck does not match the plain neck"
+    BenchTool.printTable(f"vary_b 1024x1024 page, CPU, {torch.get_num_threads()} threads, optimize_for_inference",
+                         ("part", "before p50 ms", "after p50 ms", "speedup", "before min ms", "after min ms"), [
+        (label, before["p50Ms"], after["p50Ms"], before["p50Ms"] / after["p50Ms"], before["minMs"], after["minMs"])
+        for label, (before, after) in (("neck + net_2 + net_3", neck_stats), ("whole tower", tower_stats))
+    ])
+
+    # Block input: patch embedding plus absolute position, as in ImageEncoderViT.forward
+    with torch.inference_mode():
+        block_input = net.patch_embed(x) + net.pos_embed
+    rowList = []
+    for index, blk in enumerate(net.blocks):
+        kind = "global" if blk.window_size == 0 else f"window {blk.window_size}"
+        costDict = {}
+        for use_sdpa in (False, True):
+            blk.attn.use_sdpa = use_sdpa
+            with torch.inference_mode():
+                costDict[use_sdpa] = BenchTool.timeIt(lambda: blk(block_input), repeat=3)["p50Ms"]
+        rowList.append((index, kind, costDict[False], costDict[True], costDict[False] / costDict[True]))
+    BenchTool.printTable(f"vary_b block latency, CPU, {torch.get_num_threads()} threads", ("block", "attention", "eager ms", "sdpa ms", "speedup"), rowList)
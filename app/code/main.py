@@ -23,7 +23,9 @@ if project_root_dir not in sys.path:
 from app.code.utils.LogTool import LogTool
 from app.code.utils.ConfigTool import ConfigTool
 from app.code.utils.FileTool import FileTool
-from app.code.core.OcrService import OcrService
+# OcrService and OcrPipeline (and so torch) are imported inside main(): spawned worker processes
+# re-import this module, and torch must not be loaded there before the worker sets its thread limits
+from app.code.core.OcrWorkerPool import OcrWorkerPool
 
 
 def _write_output_to_file(output_dir_path, data, input_filename="output", mode='a'): # Added input_filename
@@ -55,6 +57,29 @@ def main():
                              "Results will be named as 'input_filename.json' to prevent overwrites.")
     parser.add_argument("--ocrtype", default="plain",
                         help="Specify the OCR processing type (default: 'plain'). Refer to OcrService.py for available types.")
+    parser.add_argument("--batch_size", type=int, default=1,
+                        help="Max number of pages sent to the model in one generate call (default: 1).")
+    parser.add_argument("--pages", default=None,
+                        help="PDF pages to process, 1-based, e.g. '1-3,7' (default: all pages).")
+    parser.add_argument("--render_workers", type=int, default=0,
+                        help="Number of processes rendering PDF pages ahead of the model (default: 0, render in the load thread).")
+    parser.add_argument("--load_workers", type=int, default=2,
+                        help="Number of threads decoding images and rendering PDFs (default: 2).")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of model processes on CPU, each pinned to its own cores (default: 1, single in-process pipeline).")
+    parser.add_argument("--threads_per_worker", "--threads-per-worker", type=int, default=0,
+                        help="Torch threads (and cores) per worker process (default: available cores / workers).")
+    parser.add_argument("--sweep_workers", action="store_true",
+                        help="Benchmark every workers x threads split on the input files, report the fastest one and exit.")
+    parser.add_argument("--vocab_scripts", default=None,
+                        help="Restrict decoding to the tokens of these scripts, e.g. 'latin' or 'latin,cjk' (default: full vocabulary).")
+    parser.add_argument("--shared_weights", action="store_true",
+                        help="Worker processes memory-map one dtype-final copy of the weights instead of loading their own.")
+    parser.add_argument("--quant", default=None, choices=["int8", "int4"],
+                        help="Weight-only quantization of the decoder Linear layers (default: none). Saved once next to the model. "
+                             "Saves memory only: on the CPU it decodes slower than fp32.")
+    parser.add_argument("--quant_lm_head", action="store_true",
+                        help="With --quant, quantize lm_head too.")
     
     args = parser.parse_args()
 
@@ -81,12 +106,7 @@ def main():
         LogTool.error("模型下载或验证失败，无法启动OCR服务。", None)
         sys.exit(1)
 
-    # 3. 初始化 OCR 服务
-    LogTool.info(f"Initializing OCR Service with model directory: {modelDirPath}")
-    ocrService = OcrService(modelDirPath) # 传递模型目录路径
-    LogTool.info("OCR Service initialized successfully.")
-
-    # 4. 准备文件列表
+    # 3. 准备文件列表
     files_to_process = []
     input_path = args.input
     image_extensions = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp')
@@ -122,42 +142,71 @@ def main():
         os.makedirs(args.output_dir)
         LogTool.info(f"Created output directory: {args.output_dir}")
 
-    # 5. 执行 OCR 逻辑
-    for file_path in files_to_process:
-        try:
-            if file_path.lower().endswith(image_extensions):
-                LogTool.info(f"Performing OCR on image: {file_path} with ocrtype: {args.ocrtype}")
-                result = ocrService.performOcr(file_path, ocrType=args.ocrtype)
-                output_data = {"input_path": file_path, "type": "image", "ocr_result": result}
-                _write_output_to_file(args.output_dir, output_data, input_filename=file_path)
-            
-            elif file_path.lower().endswith(pdf_extensions):
-                LogTool.info(f"Performing OCR on PDF: {file_path}")
-                images = FileTool.pdfToImage(file_path)
-                if not images:
-                    LogTool.error(f"Could not convert PDF {file_path} to images.")
-                    continue # Skip to next file
-                
-                # Prepare output file path for PDF, clear if exists
-                output_base_name = os.path.basename(file_path)
-                output_filename = f"{output_base_name}.json"
-                output_file_path = os.path.join(args.output_dir, output_filename)
-                if os.path.exists(output_file_path):
-                    with open(output_file_path, 'w', encoding='utf-8') as f:
-                        pass # Clear the file for new PDF results
-
-                LogTool.info(f"--- OCR Result (PDF: {len(images)} pages) ---")
-                all_pages_results = []
-                for i, img in enumerate(images):
-                    LogTool.info(f"Processing page {i+1} of PDF {output_base_name}... with ocrtype: {args.ocrtype}")
-                    page_result = ocrService.performOcr(img, ocrType=args.ocrtype) # Pass PIL Image directly
-                    all_pages_results.append({"page": i + 1, "ocr_result": page_result})
-                
-                output_data = {"input_path": file_path, "type": "pdf", "pages": all_pages_results}
-                _write_output_to_file(args.output_dir, output_data, input_filename=file_path)
-            
-        except Exception as e:
-            LogTool.error(f"Error processing {file_path}: {e}")
+    def write_result(output_data):
+        if output_data["type"] == "pdf":
+            # Clear the file for new PDF results
+            output_file_path = os.path.join(args.output_dir, f"{os.path.basename(output_data['input_path'])}.json")
+            if os.path.exists(output_file_path):
+                with open(output_file_path, 'w', encoding='utf-8') as f:
+                    pass
+        _write_output_to_file(args.output_dir, output_data, input_filename=output_data["input_path"])
+
+    vocabScripts = args.vocab_scripts.split(",") if args.vocab_scripts else None
+    # Vision tower backend from models.yaml (OcrService.setVisionBackend), the same in every worker
+    visionOptions = {
+        "backend": ConfigTool.get("ocr.visionBackend", "eager"),
+        "batchSizeList": ConfigTool.get("ocr.visionBatchSizes", [1, 2, 4, 8]),
+        "cacheDir": ConfigTool.get("ocr.visionCacheDir"),
+        "onnxPath": ConfigTool.get("ocr.visionOnnxPath"),
+        "onnxThreads": ConfigTool.get("ocr.visionOnnxThreads", 0),
+    }
+
+    # 4. 多进程模式: 每个 worker 进程绑定独立的 CPU 核并各自加载一次模型
+    if args.sweep_workers:
+        OcrWorkerPool.sweep(modelDirPath, files_to_process, ocrType=args.ocrtype, batchSize=args.batch_size, pageRange=args.pages,
+                            sharedWeights=args.shared_weights, vocabScripts=vocabScripts, visionOptions=visionOptions,
+                            quantMode=args.quant, quantLmHead=args.quant_lm_head)
+        LogTool.info("=== OCRBrain CLI Finished ===")
+        return
+
+    if args.workers > 1:
+        threadsPerWorker = args.threads_per_worker or max(1, len(OcrWorkerPool.getCoreList()) // args.workers)
+        pool = OcrWorkerPool(modelDirPath, args.workers, threadsPerWorker, ocrType=args.ocrtype,
+                             batchSize=args.batch_size, pageRange=args.pages, sharedWeights=args.shared_weights,
+                             vocabScripts=vocabScripts, visionOptions=visionOptions, quantMode=args.quant,
+                             quantLmHead=args.quant_lm_head)
+        pageCount, elapsed = pool.run(files_to_process, write_result)
+        if elapsed > 0:
+            LogTool.info(f"Worker pool throughput: {pageCount / elapsed:.3f} pages/s ({pageCount} pages in {elapsed:.2f}s)")
+        LogTool.info("=== OCRBrain CLI Finished ===")
+        return
+
+    # 5. 初始化 OCR 服务
+    from app.code.core.OcrService import OcrService
+    from app.code.core.OcrPipeline import OcrPipeline
+    LogTool.info(f"Initializing OCR Service with model directory: {modelDirPath}")
+    ocrService = OcrService(modelDirPath, quantMode=args.quant, quantLmHead=args.quant_lm_head) # 传递模型目录路径
+    LogTool.info("OCR Service initialized successfully.")
+    # Compiled packages or the ONNX model are built or loaded here, before the first request
+    ocrService.setVisionBackend(**visionOptions)
+    if vocabScripts:
+        ocrService.setVocabScripts(vocabScripts)
+        LogTool.info(f"Decoding restricted to scripts {args.vocab_scripts}")
+    if args.threads_per_worker > 0:
+        import torch
+        torch.set_num_threads(args.threads_per_worker)
+
+    # 6. 执行 OCR 逻辑 (加载 -> 预处理 -> 模型 -> 写出，各阶段并行流水)
+    pipeline = OcrPipeline(
+        ocrService,
+        write_result,
+        ocrType=args.ocrtype,
+        batchSize=args.batch_size,
+        loadWorkers=args.load_workers,
+        pageRange=args.pages,
+        renderWorkers=args.render_workers
+    )
+    pipeline.run(files_to_process)
 
     LogTool.info("=== OCRBrain CLI Finished ===")
 
@@ -0,0 +1,239 @@
+import os
+import sys
+import ast
+import time
+import asyncio
+import argparse
+import tempfile
+import threading
+from io import BytesIO
+
+# Get the directory of the current script (server.py)
+script_dir = os.path.dirname(os.path.abspath(__file__))
+# Get the project root directory (parent of 'app')
+project_root_dir = os.path.dirname(os.path.dirname(script_dir))
+
+# Add the project root to sys.path
+if project_root_dir not in sys.path:
+    sys.path.insert(0, project_root_dir)
+
+from PIL import Image
+from fastapi import FastAPI, Request, HTTPException
+
+from app.code.utils.LogTool import LogTool
+from app.code.utils.ConfigTool import ConfigTool
+from app.code.utils.FileTool import FileTool
+from app.code.utils.BenchTool import BenchTool
+from app.code.core.OcrBatcher import OcrBatcher
+
+
+OCR_TYPES = ("plain", "format")
+
+
+def _parseBox(box):
+    """
+    Checks the box parameter: '[x1,y1,x2,y2]' or '[x,y]' in pixels. Returns it as a clean string.
+    """
+    if not box:
+        return None
+    try:
+        bbox = ast.literal_eval(box)
+    except (ValueError, SyntaxError):
+        raise HTTPException(status_code=400, detail=f"Invalid box: {box}")
+    if not isinstance(bbox, (list, tuple)) or len(bbox) not in (2, 4) or not all(isinstance(v, (int, float)) for v in bbox):
+        raise HTTPException(status_code=400, detail="box must be a list of 2 or 4 numbers")
+    return str(list(bbox))
+
+
+def createApp(ocrService, maxBatchSize=4, maxWaitMs=20, preprocessWorkers=2):
+    """
+    Builds the HTTP app around one loaded OcrService (only IMAGE_SIZE, prepareInput and
+    generateBatch are used).
+
+    POST /ocr?ocrType=plain&box=[x1,y1,x2,y2]&color=red with the raw image or PDF file as body.
+    Returns the same JSON shapes as the CLI output files.
+    """
+    app = FastAPI(title="OCRBrain")
+    batcher = OcrBatcher(ocrService, maxBatchSize=maxBatchSize, maxWaitMs=maxWaitMs, preprocessWorkers=preprocessWorkers)
+    app.state.batcher = batcher
+
+    @app.on_event("startup")
+    async def startBatcher():
+        await batcher.start()
+
+    @app.on_event("shutdown")
+    async def stopBatcher():
+        await batcher.stop()
+
+    @app.get("/health")
+    async def health():
+        return {"status": "ok", **batcher.getStats()}
+
+    @app.post("/ocr")
+    async def ocr(request: Request, ocrType: str = "plain", box: str = None, color: str = None):
+        if ocrType not in OCR_TYPES:
+            raise HTTPException(status_code=400, detail=f"ocrType must be one of {OCR_TYPES}")
+        box = _parseBox(box)
+        body = await request.body()
+        if not body:
+            raise HTTPException(status_code=400, detail="Empty request body, send the image or PDF file as body")
+
+        try:
+            if body[:5] == b"%PDF-" or request.headers.get("content-type", "").startswith("application/pdf"):
+                pageList = await asyncio.to_thread(_renderPdf, body, ocrService.IMAGE_SIZE)
+                # Pages go into the batcher together, so they share batches with other requests
+                resultList = await asyncio.gather(*[batcher.submit(image, ocrType, box, color) for _, image in pageList])
+                return {"type": "pdf", "pages": [{"page": pageNumber + 1, "ocr_result": result}
+                                                 for (pageNumber, _), result in zip(pageList, resultList)]}
+            try:
+                # Header only; the bytes are decoded in prepareInput at the reduced scale (OcrService._loadImage)
+                Image.open(BytesIO(body))
+            except Exception:
+                raise HTTPException(status_code=400, detail="Body is neither an image nor a PDF")
+            return {"type": "image", "ocr_result": await batcher.submit(body, ocrType, box, color)}
+        except HTTPException:
+            raise
+        except Exception as e:
+            LogTool.error(f"OCR request failed: {e}")
+            raise HTTPException(status_code=500, detail=str(e))
+
+    return app
+
+
+def _renderPdf(body, targetSize):
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f:
+        f.write(body)
+        pdfPath = f.name
+    try:
+        pageList = list(FileTool.iterPdfImages(pdfPath, targetSize=targetSize))
+    finally:
+        os.remove(pdfPath)
+    if not pageList:
+        raise HTTPException(status_code=400, detail="PDF has no renderable pages")
+    return pageList
+
+
+def _makeSyntheticImage(index, size=1024):
+    """
+    White page with a few lines of printed text, different for every index.
+    """
+    from PIL import ImageDraw
+    image = Image.new("RGB", (size, size), "white")
+    draw = ImageDraw.Draw(image)
+    for line in range(8 + index % 5):
+        draw.text((40, 40 + line * 40), f"Invoice {index}-{line}: total {index * 17 + line} USD", fill="black")
+    buffer = BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+async def _runLoad(baseUrl, requestCount, concurrency):
+    import httpx
+    bodyList = [_makeSyntheticImage(index) for index in range(requestCount)]
+    latencyList = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def sendOne(client, body):
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.post(f"{baseUrl}/ocr", content=body, headers={"content-type": "image/png"})
+            response.raise_for_status()
+            latencyList.append((time.perf_counter() - start) * 1000)
+
+    async with httpx.AsyncClient(timeout=None) as client:
+        # Warm-up request, not counted
+        await sendOne(client, bodyList[0])
+        latencyList.clear()
+        start = time.perf_counter()
+        await asyncio.gather(*[sendOne(client, body) for body in bodyList])
+        elapsed = time.perf_counter() - start
+        stats = (await client.get(f"{baseUrl}/health")).json()
+    return latencyList, elapsed, stats
+
+
+def runBench(app, host, port, requestCount, concurrency):
+    """
+    Starts the server in this process and sends requestCount synthetic pages with the given
+    concurrency. Prints p50/p99 latency, requests/s and the average batch size.
+    """
+    import uvicorn
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.1)
+    try:
+        latencyList, elapsed, stats = asyncio.run(_runLoad(f"http://{host}:{port}", requestCount, concurrency))
+    finally:
+        server.should_exit = True
+        thread.join()
+
+    BenchTool.printTable(
+        f"OCR server load ({requestCount} requests, concurrency {concurrency})",
+        ["p50 ms", "p99 ms", "requests/s", "avg batch"],
+        [[f"{BenchTool.percentile(latencyList, 50):.0f}", f"{BenchTool.percentile(latencyList, 99):.0f}",
+          f"{requestCount / elapsed:.2f}", f"{stats['avgBatchSize']:.2f}"]]
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OCRBrain HTTP server - keeps the model loaded and batches concurrent requests")
+    parser.add_argument("--host", default=None, help="Listen address (default: server.host or 127.0.0.1).")
+    parser.add_argument("--port", type=int, default=None, help="Listen port (default: server.port from appDev.yaml).")
+    parser.add_argument("--max_batch_size", type=int, default=None, help="Max requests per model call (default: server.maxBatchSize).")
+    parser.add_argument("--max_wait_ms", type=int, default=None, help="How long the first request of a batch waits for others (default: server.maxWaitMs).")
+    parser.add_argument("--vocab_scripts", default=None,
+                        help="Restrict decoding to the tokens of these scripts, e.g. 'latin' or 'latin,cjk' (default: full vocabulary).")
+    parser.add_argument("--quant", default=None, choices=["int8", "int4"],
+                        help="Weight-only quantization of the decoder Linear layers (default: none). Saved once next to the model. "
+                             "Saves memory only: on the CPU it decodes slower than fp32.")
+    parser.add_argument("--quant_lm_head", action="store_true",
+                        help="With --quant, quantize lm_head too.")
+    parser.add_argument("--bench", action="store_true", help="Run a local load test with synthetic images instead of serving.")
+    parser.add_argument("--bench_requests", type=int, default=32, help="Requests sent by --bench (default: 32).")
+    parser.add_argument("--bench_concurrency", type=int, default=8, help="Requests in flight during --bench (default: 8).")
+    args = parser.parse_args()
+
+    LogTool.info("=== OCRBrain Server Start ===")
+    ConfigTool.load("appDev.yaml")
+    ConfigTool.load("models.yaml")
+
+    modelDirPath = ConfigTool.get("ocr.modelPath")
+    downloadUrl = ConfigTool.get("ocr.downloadUrl")
+    if not modelDirPath or not downloadUrl:
+        LogTool.error("OCR 模型路径或下载URL未在 config/models.yaml 中配置。")
+        sys.exit(1)
+    modelFilePath = os.path.join(modelDirPath, os.path.basename(downloadUrl.split('?')[0]))
+    if not FileTool.downloadFile(downloadUrl, modelFilePath):
+        LogTool.error("模型下载或验证失败，无法启动OCR服务。", None)
+        sys.exit(1)
+
+    host = args.host or ConfigTool.get("server.host", "127.0.0.1")
+    port = args.port or ConfigTool.get("server.port", 8000)
+    maxBatchSize = args.max_batch_size or ConfigTool.get("server.maxBatchSize", 4)
+    maxWaitMs = args.max_wait_ms if args.max_wait_ms is not None else ConfigTool.get("server.maxWaitMs", 20)
+
+    # Imported here, so createApp can be used (and tested) with any object that has the OcrService batch API
+    from app.code.core.OcrService import OcrService
+    LogTool.info(f"Initializing OCR Service with model directory: {modelDirPath}")
+    ocrService = OcrService(modelDirPath, quantMode=args.quant, quantLmHead=args.quant_lm_head)
+    # Vision tower backend from models.yaml; compiled packages are built or loaded here, before the first request
+    ocrService.setVisionBackend(ConfigTool.get("ocr.visionBackend", "eager"), ConfigTool.get("ocr.visionBatchSizes", [1, 2, 4, 8]),
+                                ConfigTool.get("ocr.visionCacheDir"), ConfigTool.get("ocr.visionOnnxPath"),
+                                ConfigTool.get("ocr.visionOnnxThreads", 0))
+    if args.vocab_scripts:
+        ocrService.setVocabScripts(args.vocab_scripts.split(","))
+        LogTool.info(f"Decoding restricted to scripts {args.vocab_scripts}")
+    app = createApp(ocrService, maxBatchSize=maxBatchSize, maxWaitMs=maxWaitMs)
+    LogTool.info(f"Batching: maxBatchSize={maxBatchSize} maxWaitMs={maxWaitMs}")
+
+    if args.bench:
+        runBench(app, host, port, args.bench_requests, args.bench_concurrency)
+    else:
+        import uvicorn
+        uvicorn.run(app, host=host, port=port)
+    LogTool.info("=== OCRBrain Server Finished ===")
+
+
+if __name__ == "__main__":
+    main()
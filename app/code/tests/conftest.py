@@ -0,0 +1,96 @@
+import os
+import sys
+
+import pytest
+
+# Tests import the code as app.code.*, like main.py; a few utils still import utils.* (ConfigTool,
+# FileTool), which works when app/code is on the path as well, as it is for main.py and server.py
+codeDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+projectRootDir = os.path.dirname(os.path.dirname(codeDir))
+for path in (projectRootDir, codeDir):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+@pytest.fixture
+def smallVisionTower():
+    """
+    Random-weight vary_b tower for 128x128 inputs: 8x8 tokens, one window block (window 3, so
+    padded) and one global block, with the real neck; output (B, 1024, 2, 2).
+    """
+    torch = pytest.importorskip("torch")
+    from functools import partial
+    from app.code.core.vision_encoder.vary_b import ImageEncoderViT
+
+    torch.manual_seed(0)
+    tower = ImageEncoderViT(img_size=128, patch_size=16, embed_dim=64, depth=2, num_heads=4, mlp_ratio=2,
+                            norm_layer=partial(torch.nn.LayerNorm, eps=1e-6), use_rel_pos=True, window_size=3,
+                            global_attn_indexes=(1,), out_chans=256).eval()
+    with torch.no_grad():
+        # Zero-initialized position parameters would hide indexing mistakes
+        for name, param in tower.named_parameters():
+            if "rel_pos" in name or "pos_embed" in name:
+                param.normal_(std=0.02)
+    return tower
+
+
+# Token ids of the tiny GOT model below, the same as in the real vocabulary
+STOP_STR = "<|im_end|>"
+STOP_TOKEN_ID = 151645
+PAD_TOKEN_ID = 151643
+IM_START_ID, IM_END_ID, IM_PATCH_ID = 151857, 151858, 151859
+
+
+class StubTokenizer:
+    """The two tokenizer calls of the decode loops; decode names the ids, nothing is detokenized."""
+
+    def convert_tokens_to_ids(self, token):
+        assert token == STOP_STR
+        return STOP_TOKEN_ID
+
+    def decode(self, tokenIds):
+        return " ".join(str(tokenId) for tokenId in tokenIds)
+
+
+@pytest.fixture(scope="module")
+def tinyOcrService():
+    """
+    Stand-in for OcrService with a random-weight GOT model with a tiny decoder; the vision side
+    is replaced by fixed features. Has what GreedyDecoder and DecodeScheduler read.
+    """
+    torch = pytest.importorskip("torch")
+    pytest.importorskip("transformers")
+    pytest.importorskip("PIL")
+    from contextlib import nullcontext
+    from types import SimpleNamespace
+    from app.code.core.ocr_model import GOTConfig, GOTQwenForCausalLM
+    from app.code.core.VocabHead import VocabHead
+    from app.code.core.OcrService import OcrService
+
+    torch.manual_seed(0)
+    config = GOTConfig(vocab_size=IM_PATCH_ID + 1, hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+                       num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=1024,
+                       tie_word_embeddings=True, eos_token_id=PAD_TOKEN_ID, pad_token_id=PAD_TOKEN_ID)
+    config.im_patch_token = IM_PATCH_ID
+    model = GOTQwenForCausalLM(config).eval()
+    # The 1024x1024 vision tower is not under test, feature_runner stands in for tower + projector
+    features = torch.randn(1, 256, config.hidden_size)
+    model.model.feature_runner = lambda patches: features.expand(patches.shape[0], -1, -1)
+    return SimpleNamespace(model=model, device="cpu", promptCompiler=SimpleNamespace(stopStr=STOP_STR),
+                           tokenizer=StubTokenizer(), outputHead=VocabHead(model.lm_head), _getContextManager=nullcontext,
+                           _cleanOutput=lambda outputs, stopStr: OcrService._cleanOutput(None, outputs, stopStr))
+
+
+@pytest.fixture
+def makeOcrInput():
+    """Returns makeOcrInput(textIds): an OcrInput with a 256 token image and textIds after it."""
+    torch = pytest.importorskip("torch")
+    from app.code.core.PromptCompiler import PromptTemplate
+    from app.code.core.OcrService import OcrInput
+
+    def make(textIds):
+        inputIds = torch.as_tensor([11, 12, 13, IM_START_ID] + [IM_PATCH_ID] * 256 + [IM_END_ID] + list(textIds), dtype=torch.long)
+        template = PromptTemplate(inputIds=inputIds, imageStart=3, imageEnd=260, stopStr=STOP_STR)
+        return OcrInput(template=template, imageTensor=torch.zeros(1, 3, 16, 16))
+
+    return make
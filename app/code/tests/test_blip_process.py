@@ -0,0 +1,52 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchvision")
+pytest.importorskip("cv2")
+from PIL import Image
+
+from app.code.core.plug.blip_process import BlipImageEvalProcessor, BlipImageFastEvalProcessor
+
+
+def _makePages(count, size=(620, 877), mode="RGB"):
+    rng = np.random.default_rng(0)
+    pageList = []
+    for _ in range(count):
+        pixels = rng.integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+        pageList.append(Image.fromarray(pixels).convert(mode))
+    return pageList
+
+
+def test_fastProcessorMatchesTorchvision():
+    slow = BlipImageEvalProcessor(image_size=256)
+    fast = BlipImageFastEvalProcessor(image_size=256)
+    pageList = _makePages(3)
+
+    expected = torch.stack([slow(page) for page in pageList])
+    actual = fast.process_batch(pageList)
+
+    assert actual.shape == (3, 3, 256, 256)
+    assert actual.dtype == torch.float32
+    assert torch.allclose(expected, actual, atol=1e-4)
+
+
+def test_singleCallMatchesBatchAndOwnsItsTensor():
+    fast = BlipImageFastEvalProcessor(image_size=128)
+    pageList = _makePages(2, size=(300, 200))
+
+    single = fast(pageList[0])
+    batch = fast.process_batch(pageList)
+    # __call__ returns its own tensor, process_batch reuses the shared buffer
+    assert single.data_ptr() != batch.data_ptr()
+    assert torch.equal(single, batch[0])
+
+
+def test_fastProcessorConvertsGrayAndArrays():
+    slow = BlipImageEvalProcessor(image_size=128)
+    fast = BlipImageFastEvalProcessor(image_size=128)
+    grayPage = _makePages(1, mode="L")[0]
+    arrayPage = np.array(_makePages(1)[0])
+
+    assert torch.allclose(slow(grayPage.convert("RGB")), fast(grayPage), atol=1e-4)
+    assert torch.allclose(slow(Image.fromarray(arrayPage)), fast(arrayPage), atol=1e-4)
@@ -0,0 +1,95 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+pytest.importorskip("PIL")
+
+from app.code.core.DecodeScheduler import DecodeScheduler, NgramBlocker
+from app.code.core.GreedyDecoder import GreedyDecoder
+from app.code.core.KvCache import PagedKvCache
+
+# (text ids after the image, max new tokens): prompts of 263, 266 and 262 tokens with outputs of different lengths
+WORKLOAD = [([21, 22], 40), ([31, 32, 33, 34, 35], 24), ([41], 8)]
+
+
+def _getKvCacheMb(model, blockCount, blockSize=16):
+    # Inverse of PagedKvCache.getBlockCount, for a pool of exactly blockCount blocks
+    config = model.config
+    headDim = config.hidden_size // config.num_attention_heads
+    blockBytes = config.num_hidden_layers * 2 * blockSize * config.num_key_value_heads * headDim * model.dtype.itemsize
+    return blockCount * blockBytes / 1024 / 1024
+
+
+def _greedyIds(ocrService, ocrInput, maxNewTokens):
+    return GreedyDecoder(ocrService, maxNewTokens=maxNewTokens, maxPromptLen=512).generate(ocrInput)
+
+
+def test_ngramBlockerMatchesFullScan():
+    tokenList = [1, 2, 3, 1, 2, 4, 1, 2]
+    blocker = NgramBlocker(3, tokenList)
+
+    # After (1, 2) came 3 and 4; the next token may not repeat either trigram
+    assert sorted(blocker.getBanned()) == [3, 4]
+    assert NgramBlocker(3, [1, 2]).getBanned() == []
+    assert NgramBlocker(0, tokenList).getBanned() == []
+
+
+@pytest.mark.parametrize("maxBatchSize", [1, 3])
+def test_schedulerMatchesGreedyDecoder(tinyOcrService, makeOcrInput, maxBatchSize):
+    scheduler = DecodeScheduler(tinyOcrService, maxBatchSize=maxBatchSize, kvCacheMb=_getKvCacheMb(tinyOcrService.model, 128))
+    requestList = [scheduler.add(makeOcrInput(textIds), maxNewTokens) for textIds, maxNewTokens in WORKLOAD]
+    while scheduler.hasWork():
+        scheduler.step()
+
+    for request, (textIds, maxNewTokens) in zip(requestList, WORKLOAD):
+        assert request.outputIds == _greedyIds(tinyOcrService, makeOcrInput(textIds), maxNewTokens)
+    assert scheduler.preemptCount == 0
+    assert scheduler.blockManager.getFreeCount() == scheduler.blockManager.blockCount
+
+
+def test_schedulerAdmitsAndPreempts(tinyOcrService, makeOcrInput):
+    # 36 blocks of 16 tokens: two prompts fit, but not both rows grown to their 19th block
+    scheduler = DecodeScheduler(tinyOcrService, maxBatchSize=2, kvCacheMb=_getKvCacheMb(tinyOcrService.model, 36))
+    assert scheduler.blockManager.blockCount == 36
+    requestList = [scheduler.add(makeOcrInput(textIds), maxNewTokens) for textIds, maxNewTokens in WORKLOAD]
+
+    admitStepList = [None] * len(requestList)
+    while scheduler.hasWork():
+        scheduler.step()
+        assert len(scheduler.runningList) <= 2
+        for index, request in enumerate(requestList):
+            if admitStepList[index] is None and request in scheduler.runningList:
+                admitStepList[index] = scheduler.stepCount
+
+    # The third request waits for a free row and joins a running batch
+    assert admitStepList[2] > 1
+    assert scheduler.preemptCount > 0
+    # A preempted row decodes again from the start and ends with the same tokens
+    for request, (textIds, maxNewTokens) in zip(requestList, WORKLOAD):
+        assert request.outputIds == _greedyIds(tinyOcrService, makeOcrInput(textIds), maxNewTokens)
+    assert scheduler.blockManager.getFreeCount() == 36
+
+
+def test_schedulerRunIsReusable(tinyOcrService, makeOcrInput):
+    scheduler = DecodeScheduler(tinyOcrService, maxBatchSize=2, kvCacheMb=_getKvCacheMb(tinyOcrService.model, 64), maxNewTokens=6)
+    ocrInputList = [makeOcrInput(textIds) for textIds, _ in WORKLOAD]
+
+    first = scheduler.run(ocrInputList)
+    # A run left unfinished is dropped by the next one
+    scheduler.add(ocrInputList[0])
+    scheduler.step()
+    assert scheduler.run(ocrInputList) == first
+    assert first == [tinyOcrService._cleanOutput(tinyOcrService.tokenizer.decode(_greedyIds(tinyOcrService, ocrInput, 6)),
+                                                 scheduler.stopStr) for ocrInput in ocrInputList]
+
+
+def test_schedulerRejectsPromptLargerThanPool(tinyOcrService, makeOcrInput):
+    scheduler = DecodeScheduler(tinyOcrService, kvCacheMb=_getKvCacheMb(tinyOcrService.model, 8))
+    scheduler.add(makeOcrInput([1]))
+
+    with pytest.raises(MemoryError):
+        scheduler.step()
+
+
+def test_pagedKvCacheBlockCount():
+    assert PagedKvCache.getBlockCount(1, 2, 2, 16, torch.float32) == 128
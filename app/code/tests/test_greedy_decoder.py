@@ -0,0 +1,49 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+pytest.importorskip("PIL")
+
+from app.code.core.GreedyDecoder import GreedyDecoder
+from conftest import PAD_TOKEN_ID
+
+MAX_NEW_TOKENS = 24
+
+
+def _generateIds(ocrService, decoder, ocrInput):
+    # Same arguments as performOcr's generate call, without the streamer
+    template = ocrInput.template
+    inputIds = template.inputIds.unsqueeze(0)
+    with torch.inference_mode():
+        outputIds = ocrService.model.generate(
+            inputIds,
+            images=[(None, ocrInput.imageTensor)],
+            image_start_positions=torch.as_tensor([template.imageStart]),
+            do_sample=False,
+            num_beams=1,
+            no_repeat_ngram_size=20,
+            max_new_tokens=MAX_NEW_TOKENS,
+            eos_token_id=list(decoder.stopIdSet),
+            pad_token_id=PAD_TOKEN_ID
+        )
+    return outputIds[0, inputIds.shape[1]:].tolist()
+
+
+@pytest.mark.parametrize("textIds", [[21, 22], [31, 32, 33, 34, 35]])
+def test_greedyDecoderMatchesGenerate(tinyOcrService, makeOcrInput, textIds):
+    decoder = GreedyDecoder(tinyOcrService, maxNewTokens=MAX_NEW_TOKENS, maxPromptLen=512)
+    ocrInput = makeOcrInput(textIds)
+
+    expected = _generateIds(tinyOcrService, decoder, ocrInput)
+    actual = decoder.generate(ocrInput)
+
+    assert actual == expected
+    # The decoder is reused: a second run starts from an empty cache
+    assert decoder.generate(ocrInput) == expected
+
+
+def test_greedyDecoderRejectsLongPrompt(tinyOcrService, makeOcrInput):
+    decoder = GreedyDecoder(tinyOcrService, maxNewTokens=4, maxPromptLen=128)
+
+    with pytest.raises(ValueError):
+        decoder.generate(makeOcrInput([1, 2]))
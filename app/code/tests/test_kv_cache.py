@@ -0,0 +1,151 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+from transformers.cache_utils import DynamicCache
+
+from app.code.core.KvCache import BlockManager, PagedKvCache, StaticKvCache
+
+LAYER_COUNT, HEAD_COUNT, HEAD_DIM, BLOCK_SIZE = 2, 2, 4, 4
+
+
+def test_blockManagerAllocateAndFree():
+    manager = BlockManager(blockCount=6, blockSize=BLOCK_SIZE)
+
+    assert manager.allocate(0, 5) == [0, 1]
+    # Growing inside the last block takes nothing, past it one more block
+    assert manager.getExtraBlocks(0, 8) == 0
+    assert manager.allocate(0, 9) == [0, 1, 2]
+    assert manager.allocate(1, 1) == [3]
+    assert manager.getFreeCount() == 2
+
+    manager.free(0)
+    assert manager.getFreeCount() == 5
+    assert manager.getExtraBlocks(0, 1) == 1
+    # Freed blocks are taken again, lowest first
+    assert manager.allocate(2, 12) == [0, 1, 2]
+    manager.free(7)  # unknown sequence, nothing to give back
+    assert manager.getFreeCount() == 2
+
+
+def test_blockManagerOutOfBlocks():
+    manager = BlockManager(blockCount=3, blockSize=BLOCK_SIZE)
+    manager.allocate(0, 8)
+
+    with pytest.raises(MemoryError):
+        manager.allocate(1, 5)
+    # A failed allocation takes no blocks
+    assert manager.getFreeCount() == 1
+    assert 1 not in manager.tableDict
+
+
+def test_blockManagerReset():
+    manager = BlockManager(blockCount=4, blockSize=BLOCK_SIZE)
+    manager.allocate(0, 10)
+    manager.allocate(1, 3)
+
+    manager.reset()
+
+    assert manager.getFreeCount() == 4
+    assert manager.tableDict == {}
+    assert manager.allocate(2, 16) == [0, 1, 2, 3]
+
+
+class PagedCacheChecker:
+    """Feeds the same random keys/values to a PagedKvCache and one DynamicCache per sequence and compares them."""
+
+    def __init__(self, blockCount=32):
+        torch.manual_seed(0)
+        self.cache = PagedKvCache(LAYER_COUNT, HEAD_COUNT, HEAD_DIM, "cpu", torch.float32, blockCount, BLOCK_SIZE)
+        self.referenceDict = {}
+
+    def forward(self, seqList, newLen):
+        cache = self.cache
+        cache.bind(seqList, newLen)
+        lengthList = [cache.getLength(seqId) for seqId in seqList]
+        total = max(lengthList) + newLen
+
+        # Mask and positions of the bound rows
+        expectedMask = torch.tensor([[1 if pos < length + newLen else 0 for pos in range(total)] for length in lengthList])
+        assert torch.equal(cache.getAttentionMask(), expectedMask)
+        assert cache.getPositionIds().tolist() == [list(range(length, length + newLen)) for length in lengthList]
+        assert cache.get_seq_length() == max(lengthList)
+
+        for layer in range(LAYER_COUNT):
+            keys = torch.randn(len(seqList), HEAD_COUNT, newLen, HEAD_DIM)
+            values = torch.randn(len(seqList), HEAD_COUNT, newLen, HEAD_DIM)
+            outKeys, outValues = cache.update(keys, values, layer)
+            assert outKeys.shape == outValues.shape == (len(seqList), HEAD_COUNT, total, HEAD_DIM)
+            for row, (seqId, length) in enumerate(zip(seqList, lengthList)):
+                reference = self.referenceDict.setdefault(seqId, DynamicCache())
+                refKeys, refValues = reference.update(keys[row:row + 1], values[row:row + 1], layer)
+                # Positions past the row's end are masked, only the filled part has to match
+                torch.testing.assert_close(outKeys[row:row + 1, :, :length + newLen], refKeys)
+                torch.testing.assert_close(outValues[row:row + 1, :, :length + newLen], refValues)
+        cache.commit()
+        assert [cache.getLength(seqId) for seqId in seqList] == [length + newLen for length in lengthList]
+
+
+def test_pagedKvCacheMatchesDynamicCache():
+    checker = PagedCacheChecker()
+    checker.forward([0], 5)
+    checker.forward([1], 3)
+    # Steady decode of the same batch, across block boundaries and batch buffer growth
+    for _ in range(9):
+        checker.forward([0, 1], 1)
+
+    # Eviction and admission change the batch: the buffer is filled from the blocks again
+    checker.cache.free(1)
+    checker.forward([2], 6)
+    for _ in range(3):
+        checker.forward([2, 0], 1)
+    checker.forward([0], 1)
+    assert checker.cache.getLength(0) == 5 + 9 + 3 + 1
+
+
+def test_pagedKvCacheSteadyDecodeWritesOnlyNewTokens():
+    checker = PagedCacheChecker()
+    checker.forward([0], 5)
+    checker.forward([1], 7)
+    checker.forward([0, 1], 1)
+    viewKey = checker.cache.viewKeyList[0]
+
+    checker.forward([0, 1], 1)
+
+    # Same batch: no refill and no new buffer
+    assert not checker.cache._refillView
+    assert checker.cache.viewKeyList[0] is viewKey
+
+
+def test_pagedKvCacheReset():
+    checker = PagedCacheChecker(blockCount=8)
+    checker.forward([0], 9)
+    checker.cache.reset()
+
+    assert checker.cache.getLength(0) == 0
+    assert checker.cache.blockManager.getFreeCount() == 8
+    checker.referenceDict = {}
+    checker.forward([0], 9)
+
+
+def test_pagedKvCacheBindOutOfBlocks():
+    cache = PagedKvCache(LAYER_COUNT, HEAD_COUNT, HEAD_DIM, "cpu", torch.float32, blockCount=2, blockSize=BLOCK_SIZE)
+
+    with pytest.raises(MemoryError):
+        cache.bind([0], 9)
+
+
+def test_staticKvCache():
+    cache = StaticKvCache(LAYER_COUNT, 1, HEAD_COUNT, HEAD_DIM, maxLen=6, device="cpu", dtype=torch.float32)
+    keys = torch.randn(1, HEAD_COUNT, 4, HEAD_DIM)
+
+    outKeys, _ = cache.update(keys, keys, 0)
+    torch.testing.assert_close(outKeys, keys)
+    cache.advance(4)
+    outKeys, _ = cache.update(keys[:, :, :2], keys[:, :, :2], 0)
+    torch.testing.assert_close(outKeys, torch.cat([keys, keys[:, :, :2]], dim=2))
+    cache.advance(2)
+    with pytest.raises(ValueError):
+        cache.update(keys[:, :, :1], keys[:, :, :1], 0)
+    cache.reset()
+    assert cache.get_seq_length() == 0
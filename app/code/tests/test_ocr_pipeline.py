@@ -0,0 +1,71 @@
+import pytest
+
+pytest.importorskip("fitz")
+pytest.importorskip("PIL")
+from PIL import Image
+
+from app.code.core.OcrPipeline import OcrPipeline
+from app.code.utils.FileTool import FileTool
+
+
+class StubOcrService:
+    """The parts of OcrService the pipeline uses, without a model: the result names the page size."""
+
+    IMAGE_SIZE = 256
+
+    def _loadImage(self, imageInput):
+        image = Image.open(imageInput)
+        return image, image.size
+
+    def prepareInput(self, image, ocrType="plain"):
+        return f"{image.size[0]}x{image.size[1]}"
+
+    def generateBatch(self, ocrInputList):
+        return [f"text of {ocrInput}" for ocrInput in ocrInputList]
+
+
+def _writePdf(filePath, pageCount):
+    import fitz
+    document = fitz.open()
+    for _ in range(pageCount):
+        document.new_page(width=200, height=300)
+    document.save(str(filePath))
+    document.close()
+    return str(filePath)
+
+
+def _runPipeline(fileList, **kwargs):
+    outputList = []
+    OcrPipeline(StubOcrService(), outputList.append, batchSize=2, **kwargs).run(fileList)
+    return {outputData["input_path"]: outputData for outputData in outputList}
+
+
+def test_pdfPagesAreWrittenInOrder(tmp_path):
+    pdfPath = _writePdf(tmp_path / "doc.pdf", 3)
+    imagePath = str(tmp_path / "page.png")
+    Image.new("RGB", (40, 30), "white").save(imagePath)
+
+    outputDict = _runPipeline([pdfPath, imagePath], pageRange="1,3")
+
+    assert [page["page"] for page in outputDict[pdfPath]["pages"]] == [1, 3]
+    assert outputDict[imagePath] == {"input_path": imagePath, "type": "image", "ocr_result": "text of 40x30"}
+
+
+def test_pdfWithUnrenderedPageFails(tmp_path, monkeypatch):
+    iterPdfImages = FileTool.iterPdfImages
+
+    def iterFirstPage(pdfPath, pageNumbers=None, targetSize=1024):
+        # iterPdfImages logs a page that fails to render and stops
+        for pageNumber, image in iterPdfImages(pdfPath, pageNumbers, targetSize):
+            yield pageNumber, image
+            return
+
+    monkeypatch.setattr(FileTool, "iterPdfImages", staticmethod(iterFirstPage))
+    pdfPath = _writePdf(tmp_path / "doc.pdf", 3)
+    goodPath = _writePdf(tmp_path / "single.pdf", 1)
+
+    outputDict = _runPipeline([pdfPath, goodPath])
+
+    # Not written with one of its three pages
+    assert pdfPath not in outputDict
+    assert [page["page"] for page in outputDict[goodPath]["pages"]] == [1]
@@ -0,0 +1,51 @@
+from types import SimpleNamespace
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+
+from app.code.core.OnnxVisionEncoder import OnnxVisionEncoder, VisionFeatureModule
+
+
+@pytest.fixture
+def gotModel(smallVisionTower):
+    """The two modules of GOTQwenModel the export reads, with a random projector."""
+    torch.manual_seed(1)
+    return SimpleNamespace(vision_tower_high=smallVisionTower, mm_projector_vary=torch.nn.Linear(1024, 1024).eval())
+
+
+def test_onnxMatchesEager(gotModel, tmp_path):
+    onnxPath = str(tmp_path / "vision_encoder.onnx")
+    OnnxVisionEncoder.export(gotModel, onnxPath, imageSize=128)
+    encoder = OnnxVisionEncoder(onnxPath, intraOpThreads=1)
+    eagerModule = VisionFeatureModule(gotModel.vision_tower_high, gotModel.mm_projector_vary)
+
+    # The batch axis is dynamic, the export ran with batch 1
+    for batchSize in (1, 3):
+        images = torch.randn(batchSize, 3, 128, 128)
+        with torch.inference_mode():
+            expected = eagerModule(images)
+        actual = encoder(images)
+
+        assert actual.shape == (batchSize, 4, 1024)
+        assert torch.allclose(expected, actual, atol=1e-4, rtol=1e-3)
+
+
+def test_fromModelExportsAgainForOtherWeights(gotModel, tmp_path):
+    onnxPath = str(tmp_path / "vision_encoder.onnx")
+    encoder = OnnxVisionEncoder.fromModel(gotModel, onnxPath, intraOpThreads=1, imageSize=128)
+    assert encoder.getStoredKey() == OnnxVisionEncoder.getModelKey(gotModel)
+
+    with torch.no_grad():
+        gotModel.mm_projector_vary.bias.add_(1.0)
+    newKey = OnnxVisionEncoder.getModelKey(gotModel)
+    assert newKey != encoder.getStoredKey()
+
+    encoder = OnnxVisionEncoder.fromModel(gotModel, onnxPath, intraOpThreads=1, imageSize=128)
+    assert encoder.getStoredKey() == newKey
+    images = torch.randn(1, 3, 128, 128)
+    with torch.inference_mode():
+        expected = VisionFeatureModule(gotModel.vision_tower_high, gotModel.mm_projector_vary)(images)
+    assert torch.allclose(expected, encoder(images), atol=1e-4, rtol=1e-3)
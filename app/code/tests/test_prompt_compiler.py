@@ -0,0 +1,75 @@
+import os
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("tiktoken")
+transformers = pytest.importorskip("transformers")
+
+from app.code.core.PromptCompiler import PromptCompiler
+from app.code.utils.ocr_internal.conversation import conv_templates
+from app.code.utils.ocr_internal.constants import DEFAULT_IMAGE_PATCH_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+
+# (ocrType, box, color) as OcrService._buildQuery gets them, for a 1000 x 2000 image
+QUERY_ARGS = [
+    ("plain", None, None),
+    ("format", None, None),
+    ("plain", "[100, 200]", None),
+    ("format", "[10, 20, 300, 400]", None),
+    ("plain", None, "red"),
+    ("format", "[10, 20, 300, 400]", "green"),
+    ("plain", "[0, 0, 1000, 2000]", "blue"),
+]
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    if not os.path.exists(os.path.join(DATA_DIR, "qwen.tiktoken")):
+        pytest.skip("Tokenizer files are not in app/code/data")
+    return transformers.AutoTokenizer.from_pretrained(DATA_DIR, trust_remote_code=True)
+
+
+def _buildQuery(ocrType, box, color, w=1000, h=2000):
+    pytest.importorskip("PIL")
+    pytest.importorskip("cv2")
+    from app.code.core.OcrService import OcrService
+    # _buildQuery does not use the service state
+    return OcrService._buildQuery(None, ocrType, box, color, w, h)
+
+
+def _tokenizeWholePrompt(tokenizer, qs):
+    # The prompt as it was built before PromptCompiler: the whole conversation text, tokenized at once
+    conv = conv_templates["mpt"].copy()
+    conv.append_message(conv.roles[0], DEFAULT_IM_START_TOKEN + DEFAULT_IMAGE_PATCH_TOKEN * 256 + DEFAULT_IM_END_TOKEN + "\n" + qs)
+    conv.append_message(conv.roles[1], None)
+    return tokenizer([conv.get_prompt()]).input_ids[0]
+
+
+@pytest.mark.parametrize("ocrType, box, color", QUERY_ARGS)
+def test_compiledIdsMatchWholePrompt(tokenizer, ocrType, box, color):
+    compiler = PromptCompiler(tokenizer)
+    qs = _buildQuery(ocrType, box, color)
+
+    template = compiler.compile(qs)
+
+    assert template.inputIds.tolist() == _tokenizeWholePrompt(tokenizer, qs)
+    assert template.stopStr == "<|im_end|>"
+
+
+def test_imagePositions(tokenizer):
+    template = PromptCompiler(tokenizer).compile("OCR: ")
+    inputIds = template.inputIds.tolist()
+
+    assert inputIds[template.imageStart] == tokenizer.convert_tokens_to_ids(DEFAULT_IM_START_TOKEN)
+    assert inputIds[template.imageEnd] == tokenizer.convert_tokens_to_ids(DEFAULT_IM_END_TOKEN)
+    patchId = tokenizer.convert_tokens_to_ids(DEFAULT_IMAGE_PATCH_TOKEN)
+    assert inputIds[template.imageStart + 1:template.imageEnd] == [patchId] * 256
+
+
+def test_compileIsCached(tokenizer):
+    compiler = PromptCompiler(tokenizer)
+
+    assert compiler.compile("OCR: ") is compiler.compile("OCR: ")
+    assert compiler.compile("[red] OCR: ").inputIds.tolist() != compiler.compile("OCR: ").inputIds.tolist()
@@ -0,0 +1,115 @@
+import os
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from app.code.core.QuantLinear import QuantLinear, DecoderQuantizer
+
+
+def _makeLinear(inFeatures=64, outFeatures=24, bias=True):
+    torch.manual_seed(0)
+    return torch.nn.Linear(inFeatures, outFeatures, bias=bias)
+
+
+@pytest.mark.parametrize("mode, groupSize", [("int8", 128), ("int4", 16)])
+def test_dequantizeErrorBound(mode, groupSize):
+    linear = _makeLinear()
+    module = QuantLinear.fromLinear(linear, mode, groupSize)
+    weight = linear.weight.detach()
+
+    # Round to nearest: every weight is off by at most half a step of its row (int8) or group (int4)
+    step = module.scale[:, None] if mode == "int8" else module.scale.repeat_interleave(groupSize, dim=1)
+    assert ((module.dequantize() - weight).abs() <= step / 2 + 1e-6).all()
+    # The largest weight of a row or group is exact
+    assert torch.allclose(module.dequantize().abs().amax(dim=1), weight.abs().amax(dim=1))
+
+
+def test_int4NibblePacking():
+    # Weights on the int4 grid of their group are stored exactly
+    levels = torch.arange(-7, 8, dtype=torch.float32)
+    weight = torch.stack([levels[torch.randperm(15)[:8]] for _ in range(3)]) * 0.5
+    weight[:, 0] = 3.5  # amax of every group is 7 * 0.5, so the scale is 0.5
+    linear = torch.nn.Linear(8, 3, bias=False)
+    with torch.no_grad():
+        linear.weight.copy_(weight)
+
+    module = QuantLinear.fromLinear(linear, "int4", groupSize=8)
+
+    assert module.qweight.shape == (3, 4) and module.qweight.dtype == torch.uint8
+    # Even inputs in the low nibble, odd inputs in the high nibble, both offset by 8
+    values = (weight / 0.5).to(torch.int64) + 8
+    assert torch.equal(module.qweight.to(torch.int64), values[:, 0::2] | (values[:, 1::2] << 4))
+    assert torch.equal(module.dequantize(), weight)
+    # Row ranges unpack the same as the whole matrix
+    assert torch.equal(module.dequantize(1, 3), weight[1:3])
+
+
+@pytest.mark.parametrize("mode, groupSize, tolerance", [("int8", 128, 0.02), ("int4", 16, 0.2)])
+def test_forwardMatchesLinear(mode, groupSize, tolerance):
+    linear = _makeLinear()
+    module = QuantLinear.fromLinear(linear, mode, groupSize)
+    x = torch.randn(2, 5, 64)
+
+    with torch.no_grad():
+        expected = linear(x)
+        output = module(x)
+        # Exactly the float matmul with the dequantized weight, also when split in row chunks
+        reference = torch.nn.functional.linear(x, module.dequantize(), linear.bias)
+        module.chunkRows = 5
+        chunked = module(x)
+
+    assert output.shape == expected.shape
+    torch.testing.assert_close(output, reference, atol=1e-4, rtol=1e-4)
+    torch.testing.assert_close(chunked, reference, atol=1e-4, rtol=1e-4)
+    # Quantization error relative to the output scale
+    assert (output - expected).abs().max() <= tolerance * expected.abs().max()
+
+
+@pytest.mark.parametrize("mode, groupSize", [("int8", 128), ("int4", 16)])
+def test_selectRows(mode, groupSize):
+    module = QuantLinear.fromLinear(_makeLinear(), mode, groupSize)
+    rowIndex = torch.tensor([3, 0, 17, 23])
+    x = torch.randn(4, 64)
+
+    selected = module.selectRows(rowIndex)
+
+    assert selected.out_features == 4 and selected.mode == mode
+    assert torch.equal(selected.qweight, module.qweight[rowIndex])
+    assert torch.equal(selected.dequantize(), module.dequantize()[rowIndex])
+    with torch.no_grad():
+        torch.testing.assert_close(selected(x), module(x)[:, rowIndex], atol=1e-4, rtol=1e-4)
+
+
+def test_invalidArguments():
+    with pytest.raises(ValueError):
+        QuantLinear(64, 8, mode="int2")
+    with pytest.raises(ValueError):
+        QuantLinear(64, 8, mode="int4", groupSize=48)
+
+
+@pytest.mark.parametrize("mode, quantLmHead", [("int8", False), ("int4", True)])
+def test_quantizedModelSaveAndMmapReload(tmp_path, mode, quantLmHead):
+    transformers = pytest.importorskip("transformers")
+    pytest.importorskip("safetensors")
+    pytest.importorskip("accelerate")
+    torch.manual_seed(0)
+    config = transformers.Qwen2Config(vocab_size=128, hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+                                      num_attention_heads=4, num_key_value_heads=2, tie_word_embeddings=True)
+    transformers.Qwen2ForCausalLM(config).save_pretrained(str(tmp_path), safe_serialization=True)
+    modelDirPath = str(tmp_path)
+
+    filePath = DecoderQuantizer.ensureQuantized(transformers.Qwen2ForCausalLM, modelDirPath, mode, groupSize=16, quantLmHead=quantLmHead)
+    assert filePath == DecoderQuantizer.getQuantPath(modelDirPath, mode, 16, quantLmHead)
+    model = DecoderQuantizer.loadQuantized(transformers.Qwen2ForCausalLM, modelDirPath, filePath, mode, groupSize=16,
+                                           quantLmHead=quantLmHead)
+
+    # Same model as quantizing the float checkpoint in memory
+    reference = DecoderQuantizer.quantizeModel(transformers.Qwen2ForCausalLM.from_pretrained(modelDirPath).eval(), mode, 16, quantLmHead)
+    assert isinstance(model.model.layers[0].mlp.down_proj, QuantLinear)
+    assert isinstance(model.lm_head, QuantLinear) == quantLmHead
+    assert all(tensor.device.type == "cpu" for tensor in list(model.parameters()) + list(model.buffers()))
+    inputIds = torch.tensor([[1, 5, 9, 42]])
+    with torch.inference_mode():
+        torch.testing.assert_close(model(inputIds).logits, reference(inputIds).logits)
+    assert [name for name in os.listdir(modelDirPath) if name.startswith("model.int")] == [os.path.basename(filePath)]
@@ -0,0 +1,90 @@
+from io import BytesIO
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("httpx")
+pytest.importorskip("fitz")
+pytest.importorskip("PIL")
+from PIL import Image
+from fastapi.testclient import TestClient
+
+from app.code.server import createApp, _makeSyntheticImage
+
+
+class StubOcrService:
+    """Batch API of OcrService without a model: the result names the input it was given."""
+
+    IMAGE_SIZE = 256
+
+    def __init__(self):
+        self.batchSizeList = []
+
+    def prepareInput(self, imageInput, ocrType="plain", box=None, color=None):
+        if isinstance(imageInput, bytes):
+            imageInput = Image.open(BytesIO(imageInput))
+        return f"{ocrType} {imageInput.size[0]}x{imageInput.size[1]} box={box} color={color}"
+
+    def generateBatch(self, ocrInputList):
+        self.batchSizeList.append(len(ocrInputList))
+        return [f"text of {ocrInput}" for ocrInput in ocrInputList]
+
+
+@pytest.fixture
+def service():
+    return StubOcrService()
+
+
+@pytest.fixture
+def client(service):
+    with TestClient(createApp(service, maxBatchSize=4, maxWaitMs=5, preprocessWorkers=1)) as testClient:
+        yield testClient
+
+
+def test_imageRequest(client, service):
+    response = client.post("/ocr?ocrType=format&box=[10,20,30,40]&color=red", content=_makeSyntheticImage(0, size=320),
+                           headers={"content-type": "image/png"})
+
+    assert response.status_code == 200
+    assert response.json() == {"type": "image", "ocr_result": "text of format 320x320 box=[10, 20, 30, 40] color=red"}
+    assert service.batchSizeList == [1]
+
+
+def test_pdfRequest(client):
+    import fitz
+    document = fitz.open()
+    for _ in range(2):
+        document.new_page(width=200, height=300)
+    body = document.tobytes()
+
+    response = client.post("/ocr", content=body, headers={"content-type": "application/pdf"})
+
+    assert response.status_code == 200
+    data = response.json()
+    assert data["type"] == "pdf"
+    assert [page["page"] for page in data["pages"]] == [1, 2]
+    assert all(page["ocr_result"].startswith("text of plain") for page in data["pages"])
+
+
+@pytest.mark.parametrize("query, body", [
+    ("ocrType=fancy", b"x"),
+    ("box=[1,2,3]", b"x"),
+    ("box=oops", b"x"),
+    ("", b""),
+    ("", b"not an image"),
+])
+def test_badRequest(client, service, query, body):
+    response = client.post(f"/ocr?{query}", content=body)
+
+    assert response.status_code == 400
+    assert service.batchSizeList == []
+
+
+def test_healthCountsBatches(client):
+    client.post("/ocr", content=_makeSyntheticImage(1, size=64))
+    client.post("/ocr", content=_makeSyntheticImage(2, size=64))
+
+    stats = client.get("/health").json()
+    assert stats["status"] == "ok"
+    assert stats["itemCount"] == 2
+    assert 1 <= stats["batchCount"] <= 2
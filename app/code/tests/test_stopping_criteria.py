@@ -0,0 +1,92 @@
+from types import SimpleNamespace
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from app.code.utils.ocr_internal import utils
+from app.code.utils.ocr_internal.utils import KeywordsStoppingCriteria
+
+PROMPT_LEN = 3
+
+
+class ByteTokenizer:
+    """Byte-level tokenizer over a fixed vocabulary; text is tokenized by the ids given for it."""
+
+    def __init__(self, tokenList, textIds):
+        self.tokenList = tokenList
+        self.textIds = textIds
+
+    def __call__(self, text):
+        return SimpleNamespace(input_ids=self.textIds[text])
+
+    def convert_ids_to_tokens(self, tokenId):
+        return self.tokenList[tokenId]
+
+
+# "<|im_end|>" is split over the ids 3, 4 and 5
+SPLIT_TOKENIZER = ByteTokenizer([b"a", b"b", b" ", b"<|im", b"_e", b"nd|>", b"<|"], {"<|im_end|>": [3, 4, 5]})
+# "<|im_end|>" is the single id 3
+SPECIAL_TOKENIZER = ByteTokenizer([b"a", b"b", b" ", b"<|im_end|>", b"<|im", b"_end|>"], {"<|im_end|>": [3]})
+
+
+def _runSteps(criteria, rowList):
+    """Calls the criteria once per generated column, like generate does, and returns the masks."""
+    outputIds = torch.cat([torch.zeros((len(rowList), PROMPT_LEN), dtype=torch.long), torch.tensor(rowList)], dim=1)
+    return [criteria(outputIds[:, :PROMPT_LEN + step], None).tolist() for step in range(1, len(rowList[0]) + 1)]
+
+
+def _makeCriteria(tokenizer, batchSize):
+    return KeywordsStoppingCriteria(["<|im_end|>"], tokenizer, torch.zeros((batchSize, PROMPT_LEN), dtype=torch.long))
+
+
+def test_keywordSplitAcrossTokens():
+    criteria = _makeCriteria(SPLIT_TOKENIZER, 1)
+
+    # Done on the token that completes the keyword, not on the ones before it
+    assert _runSteps(criteria, [[0, 3, 4, 5, 1]]) == [[False], [False], [False], [True], [True]]
+    # Parts of the keyword that never complete it
+    assert _runSteps(_makeCriteria(SPLIT_TOKENIZER, 1), [[6, 3, 2, 4, 5]]) == [[False]] * 5
+
+
+def test_keywordSplitAfterManyTokens():
+    # The rolling tail keeps enough bytes for a keyword that starts far into the output
+    criteria = _makeCriteria(SPLIT_TOKENIZER, 1)
+    rowIds = [0, 1, 2] * 20 + [3, 4, 5]
+
+    assert [mask[0] for mask in _runSteps(criteria, [rowIds])] == [False] * (len(rowIds) - 1) + [True]
+
+
+def test_singleTokenKeyword():
+    criteria = _makeCriteria(SPECIAL_TOKENIZER, 1)
+
+    assert _runSteps(criteria, [[0, 1, 3, 2]]) == [[False], [False], [True], [True]]
+    # Decoded pieces of the keyword match as well
+    assert _runSteps(_makeCriteria(SPECIAL_TOKENIZER, 1), [[0, 4, 5]])[-1] == [True]
+
+
+def test_perRowDoneMask():
+    criteria = _makeCriteria(SPLIT_TOKENIZER, 3)
+    rowList = [[0, 0, 0, 3, 4, 5],
+               [3, 4, 5, 0, 0, 0],
+               [0, 1, 2, 0, 1, 2]]
+
+    maskList = _runSteps(criteria, rowList)
+
+    # Each row is done from its own keyword on and stays done
+    assert maskList[2] == [False, True, False]
+    assert maskList[5] == [True, True, False]
+    assert [mask[1] for mask in maskList] == [False, False, True, True, True, True]
+
+
+def test_singleBoolBeforePerRowStopping(monkeypatch):
+    monkeypatch.setattr(utils, "PER_ROW_STOPPING", False)
+    criteria = _makeCriteria(SPLIT_TOKENIZER, 2)
+    outputIds = torch.cat([torch.zeros((2, PROMPT_LEN), dtype=torch.long), torch.tensor([[3, 4, 5, 0], [0, 0, 3, 4]])], dim=1)
+
+    # One bool for the whole batch, True once every row is done
+    assert criteria(outputIds[:, :PROMPT_LEN + 3], None) is False
+    assert criteria(outputIds, None) is False
+    outputIds = torch.cat([outputIds, torch.tensor([[1], [5]])], dim=1)
+    assert criteria(outputIds, None) is True
@@ -0,0 +1,44 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from app.code.core.vision_encoder.vary_b import set_attention_backend
+
+
+@pytest.mark.parametrize("batchSize", [1, 2])
+def test_sdpaMatchesEager(smallVisionTower, batchSize):
+    images = torch.randn(batchSize, 3, 128, 128)
+
+    with torch.inference_mode():
+        set_attention_backend(smallVisionTower, False)
+        eager = smallVisionTower(images)
+        set_attention_backend(smallVisionTower, True)
+        sdpa = smallVisionTower(images)
+
+    assert sdpa.shape == (batchSize, 1024, 2, 2)
+    assert torch.allclose(eager, sdpa, atol=1e-5, rtol=1e-4)
+
+
+def test_sdpaMatchesEagerPerBlock(smallVisionTower):
+    blockInput = torch.randn(1, 8, 8, 64)
+
+    for block in smallVisionTower.blocks:
+        with torch.inference_mode():
+            block.attn.use_sdpa = False
+            eager = block(blockInput)
+            block.attn.use_sdpa = True
+            sdpa = block(blockInput)
+        assert torch.allclose(eager, sdpa, atol=1e-5, rtol=1e-4)
+
+
+def test_fusedNeckMatchesPlainNeck(smallVisionTower):
+    images = torch.randn(2, 3, 128, 128)
+    with torch.inference_mode():
+        plain = smallVisionTower(images)
+        smallVisionTower.optimize_for_inference()
+        assert smallVisionTower.fused_neck
+        fused = smallVisionTower(images)
+
+    assert fused.shape == plain.shape
+    assert fused.is_contiguous(memory_format=torch.channels_last)
+    assert torch.allclose(plain, fused, atol=1e-5, rtol=1e-4)
@@ -0,0 +1,108 @@
+from types import SimpleNamespace
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from app.code.core.VocabHead import VocabHead
+
+# "中" is e4 b8 ad, "文" is e6 96 87, "é" is c3 a9
+TOKEN_LIST = [
+    b"hello", b" world", b"123", b", ",          # 0-3: latin words, common digits and punctuation
+    "中".encode(), "中文".encode(),                # 4-5: whole CJK characters
+    b"\xe4\xb8",                                   # 6: 2-byte prefix of 中
+    b"\x96\x87",                                   # 7: last two bytes of 文
+    b"a\xe4\xb8",                                  # 8: latin letter, then the start of 中
+    b"\xad\xe6\x96",                               # 9: end of 中, then the start of 文
+    b"\xa9a",                                      # 10: end of é, then a latin letter
+    "é".encode(), b"\xc3",                         # 11-12: é and its lead byte
+    "ж".encode(),                                  # 13: cyrillic
+    b"\xff", b"\xe4\xb8\x41",                      # 14-15: never valid UTF-8
+]
+SPECIAL_TOKENS = {"<|endoftext|>": 151643, "<|im_end|>": 151645, "<img>": 151857}
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return SimpleNamespace(mergeable_ranks={tokenBytes: tokenId for tokenId, tokenBytes in enumerate(TOKEN_LIST)},
+                           special_tokens=SPECIAL_TOKENS)
+
+
+def _getKept(tokenizer, scriptList):
+    return {tokenId for tokenId in VocabHead.buildWhitelist(tokenizer, scriptList) if tokenId < len(TOKEN_LIST)}
+
+
+def test_wholeCjkCharacters(tokenizer):
+    assert {4, 5} <= _getKept(tokenizer, ["cjk"])
+    assert not {4, 5} & _getKept(tokenizer, ["latin"])
+
+
+def test_partialCjkCharacter(tokenizer):
+    # A cut-off start or end of a CJK character is kept for cjk only
+    assert {6, 7} <= _getKept(tokenizer, ["cjk"])
+    assert not {6, 7} & _getKept(tokenizer, ["latin"])
+
+
+def test_tokensSpanningTwoCharacters(tokenizer):
+    # Both characters must be allowed
+    assert 8 in _getKept(tokenizer, ["latin", "cjk"])
+    assert 8 not in _getKept(tokenizer, ["latin"])
+    assert 8 not in _getKept(tokenizer, ["cjk"])
+    assert 9 in _getKept(tokenizer, ["cjk"])
+    assert 10 in _getKept(tokenizer, ["latin"])
+    assert 10 not in _getKept(tokenizer, ["cjk"])
+
+
+def test_scriptsAndCommonCharacters(tokenizer):
+    assert _getKept(tokenizer, ["latin"]) == {0, 1, 2, 3, 10, 11, 12}
+    # The lead byte of é also starts × and ÷, which are common
+    assert _getKept(tokenizer, ["cjk"]) == {2, 3, 4, 5, 6, 7, 9, 12}
+    assert _getKept(tokenizer, ["cyrillic"]) == {2, 3, 12, 13}
+
+
+def test_specialTokensAlwaysKept(tokenizer):
+    for scriptList in (["latin"], ["cjk"], ["greek"]):
+        assert set(SPECIAL_TOKENS.values()) <= set(VocabHead.buildWhitelist(tokenizer, scriptList))
+
+
+def test_invalidBytesAndUnknownScript(tokenizer):
+    assert not {14, 15} & _getKept(tokenizer, ["latin", "greek", "cyrillic", "cjk"])
+    with pytest.raises(ValueError):
+        VocabHead.buildWhitelist(tokenizer, ["klingon"])
+
+
+@pytest.mark.parametrize("quantized", [False, True])
+def test_restrictedLogitsAreFullColumns(quantized):
+    torch.manual_seed(0)
+    lmHead = torch.nn.Linear(32, 100, bias=False)
+    if quantized:
+        from app.code.core.QuantLinear import QuantLinear
+        lmHead = QuantLinear.fromLinear(lmHead, "int8")
+    tokenIds = [90, 3, 41, 7, 3]
+    head = VocabHead(lmHead, tokenIds)
+    hiddenStates = torch.randn(2, 32)
+
+    with torch.no_grad():
+        logits = head.getLogits(hiddenStates)
+        fullLogits = VocabHead(lmHead).getLogits(hiddenStates)
+
+    # Sorted and deduplicated; a quantized head stays quantized
+    assert head.tokenIds.tolist() == [3, 7, 41, 90]
+    assert (head.quantHead is not None) == quantized
+    torch.testing.assert_close(logits, fullLogits[:, head.tokenIds], atol=1e-5, rtol=1e-5)
+    assert head.toIndexList([41, 5, 90]) == [2, 3]
+    assert head.toTokenIds(torch.tensor([0, 3])).tolist() == [3, 90]
+
+
+@pytest.mark.parametrize("textIds", [[21, 22], [31, 32, 33, 34, 35]])
+def test_restrictedHeadDecodesLikeFullHead(tinyOcrService, makeOcrInput, textIds):
+    from app.code.core.GreedyDecoder import GreedyDecoder
+    ocrInput = makeOcrInput(textIds)
+    fullIds = GreedyDecoder(tinyOcrService, maxNewTokens=24).generate(ocrInput)
+
+    # A whitelist holding every token of the full decode, and many that never win
+    tokenIds = set(fullIds) | set(range(1000, 60000, 7))
+    restrictedService = SimpleNamespace(**vars(tinyOcrService))
+    restrictedService.outputHead = VocabHead(tinyOcrService.model.lm_head, sorted(tokenIds))
+
+    assert GreedyDecoder(restrictedService, maxNewTokens=24).generate(ocrInput) == fullIds
@@ -0,0 +1,71 @@
+import json
+import os
+import struct
+
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+pytest.importorskip("safetensors")
+pytest.importorskip("accelerate")
+
+from app.code.utils.WeightTool import WeightTool
+
+
+@pytest.fixture
+def modelDir(tmp_path):
+    """Checkpoint directory of a tiny random Qwen2 with a tied lm_head, as save_pretrained writes it."""
+    torch.manual_seed(0)
+    config = transformers.Qwen2Config(vocab_size=128, hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+                                      num_attention_heads=4, num_key_value_heads=2, tie_word_embeddings=True)
+    model = transformers.Qwen2ForCausalLM(config).eval()
+    model.save_pretrained(str(tmp_path), safe_serialization=True)
+    return str(tmp_path), model
+
+
+def _readHeader(filePath):
+    with open(filePath, "rb") as f:
+        headerLen = struct.unpack("<Q", f.read(8))[0]
+        return json.loads(f.read(headerLen))
+
+
+def test_dtypeFinalRoundTrip(modelDir):
+    modelDirPath, reference = modelDir
+    filePath = WeightTool.ensureDtypeFinal(transformers.Qwen2ForCausalLM, modelDirPath, torch.float32)
+
+    assert os.path.basename(filePath) == f"model.float32.{WeightTool.getCheckpointFingerprint(modelDirPath)}.safetensors"
+    # Tied lm_head and embed_tokens are stored once
+    header = _readHeader(filePath)
+    assert "model.embed_tokens.weight" in header
+    assert "lm_head.weight" not in header
+
+    deviceList = []
+    model = WeightTool.loadMmapModel(transformers.Qwen2ForCausalLM, modelDirPath, filePath,
+                                     prepareModel=lambda emptyModel: deviceList.append(emptyModel.lm_head.weight.device.type))
+    # Built on the meta device, then every weight assigned from the mapping
+    assert deviceList == ["meta"]
+    assert all(param.device.type == "cpu" for param in model.parameters())
+    assert model.lm_head.weight.data_ptr() == model.model.embed_tokens.weight.data_ptr()
+    # The mapping is read-only (see the WeightTool docstring)
+    with pytest.raises(TypeError):
+        model._weightMapping[0:1] = b"\0"
+
+    inputIds = torch.tensor([[1, 5, 9, 42]])
+    with torch.inference_mode():
+        torch.testing.assert_close(model(inputIds).logits, reference(inputIds).logits)
+
+
+def test_dtypeFinalFollowsCheckpoint(modelDir):
+    modelDirPath, _ = modelDir
+    firstPath = WeightTool.ensureDtypeFinal(transformers.Qwen2ForCausalLM, modelDirPath, torch.float32)
+    assert WeightTool.ensureDtypeFinal(transformers.Qwen2ForCausalLM, modelDirPath, torch.float32) == firstPath
+
+    # A replaced checkpoint gets a new file and the old one is removed
+    checkpointPath = os.path.join(modelDirPath, "model.safetensors")
+    stat = os.stat(checkpointPath)
+    os.utime(checkpointPath, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    secondPath = WeightTool.ensureDtypeFinal(transformers.Qwen2ForCausalLM, modelDirPath, torch.float32)
+
+    assert secondPath != firstPath
+    assert os.path.exists(secondPath)
+    assert not os.path.exists(firstPath)
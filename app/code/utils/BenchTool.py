@@ -0,0 +1,164 @@
+import math
+import os
+import sys
+import time
+
+
+class BenchTool:
+    """
+    Small helpers for the benchmark blocks (timing, percentiles, memory, printing).
+    """
+
+    @staticmethod
+    def timeIt(func, repeat=5, warmup=1):
+        """
+        Runs func several times and returns timing stats in milliseconds.
+        """
+        for _ in range(warmup):
+            func()
+        costList = []
+        for _ in range(repeat):
+            startTime = time.perf_counter()
+            func()
+            costList.append((time.perf_counter() - startTime) * 1000)
+        return BenchTool._getStats(costList)
+
+    @staticmethod
+    def timeInterleaved(funcList, repeat=5, warmup=1):
+        """
+        Times several funcs round by round, in alternating order, so a change of machine speed
+        during the run (other load, clock boost) hits all of them alike. timeIt stats per func.
+        """
+        for func in funcList:
+            for _ in range(warmup):
+                func()
+        costLists = [[] for _ in funcList]
+        for roundIndex in range(repeat):
+            order = list(range(len(funcList)))
+            if roundIndex % 2:
+                order.reverse()
+            for index in order:
+                startTime = time.perf_counter()
+                funcList[index]()
+                costLists[index].append((time.perf_counter() - startTime) * 1000)
+        return [BenchTool._getStats(costList) for costList in costLists]
+
+    @staticmethod
+    def _getStats(costList):
+        return {
+            "meanMs": sum(costList) / len(costList),
+            "minMs": min(costList),
+            "p50Ms": BenchTool.percentile(costList, 50),
+            "p99Ms": BenchTool.percentile(costList, 99),
+        }
+
+    @staticmethod
+    def percentile(valueList, percent):
+        """
+        Nearest-rank percentile, percent in [0, 100].
+        """
+        if not valueList:
+            return 0.0
+        sortedList = sorted(valueList)
+        index = min(len(sortedList) - 1, max(0, math.ceil(percent / 100 * len(sortedList)) - 1))
+        return sortedList[index]
+
+    @staticmethod
+    def getRssMb():
+        """
+        Current resident memory of this process in MB (psutil, or /proc/self/statm on Linux).
+        Where neither is available (e.g. macOS without psutil) it returns the peak, see getPeakRssMb.
+        """
+        try:
+            import psutil
+            return psutil.Process(os.getpid()).memory_info().rss / 1024 / 1024
+        except ImportError:
+            pass
+        try:
+            # Second field is the resident size in pages
+            with open("/proc/self/statm") as f:
+                residentPages = int(f.read().split()[1])
+            return residentPages * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+        except (OSError, ValueError, IndexError, AttributeError):
+            return BenchTool.getPeakRssMb()
+
+    @staticmethod
+    def resetPeakRss():
+        """
+        Starts a new peak for getPeakRssMb at the current resident size (Linux only, /proc/self/clear_refs).
+        Returns False where the peak can not be reset.
+        """
+        try:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+            return True
+        except OSError:
+            return False
+
+    @staticmethod
+    def getPeakRssMb():
+        """
+        Peak resident memory of this process in MB: since the last resetPeakRss on Linux (VmHWM),
+        since it started elsewhere (ru_maxrss).
+        """
+        try:
+            with open("/proc/self/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1]) / 1024
+        except (OSError, ValueError, IndexError):
+            pass
+        import resource
+        # ru_maxrss is in KB on Linux and in bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+    @staticmethod
+    def printTable(title, headerList, rowList):
+        """
+        Prints rows as a plain aligned table.
+        """
+        textRows = [[str(h) for h in headerList]]
+        for row in rowList:
+            textRows.append([f"{v:.3f}" if isinstance(v, float) else str(v) for v in row])
+        widthList = [max(len(r[i]) for r in textRows) for i in range(len(headerList))]
+        print(f"=== {title} ===")
+        for r in textRows:
+            print("  ".join(v.rjust(widthList[i]) for i, v in enumerate(r)))
+
+    @staticmethod
+    def makeTextPage(lineCount, seed=0, size=1024):
+        """
+        Synthetic white page with lineCount lines of printed text, for OCR benchmarks.
+        More lines give a longer OCR output, so mixed line counts make a mixed workload.
+        """
+        from PIL import Image, ImageDraw
+        page = Image.new("RGB", (size, size), "white")
+        draw = ImageDraw.Draw(page)
+        lineHeight = max(12, (size - 40) // max(lineCount, 1))
+        for line, text in enumerate(BenchTool.getTextPageLines(lineCount, seed)):
+            draw.text((20, 20 + line * lineHeight), text, fill="black")
+        return page
+
+    @staticmethod
+    def getTextPageLines(lineCount, seed=0):
+        """
+        Text lines printed by makeTextPage, the ground truth of the page.
+        """
+        return [f"Item {seed}-{line}: {(seed * 31 + line * 7) % 1000} units at {line + 1}.50 USD" for line in range(lineCount)]
+
+    @staticmethod
+    def getCer(text, reference):
+        """
+        Character error rate: edit distance between text and reference over the reference length.
+        Whitespace runs count as one space on both sides.
+        """
+        text = " ".join(text.split())
+        reference = " ".join(reference.split())
+        previousRow = list(range(len(text) + 1))
+        for i, refChar in enumerate(reference, 1):
+            currentRow = [i]
+            for j, char in enumerate(text, 1):
+                currentRow.append(min(previousRow[j] + 1, currentRow[j - 1] + 1, previousRow[j - 1] + (char != refChar)))
+            previousRow = currentRow
+        return previousRow[-1] / max(1, len(reference))
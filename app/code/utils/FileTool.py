@@ -1,5 +1,9 @@
 import os
 import json
+import math
+import queue
+import multiprocessing
+from multiprocessing import shared_memory
 import fitz # PyMuPDF
 from PIL import Image
 import requests # 导入 requests 库
@@ -63,6 +67,211 @@ class FileTool:
             LogTool.error(f"Failed to convert PDF to image for {pdfPath}: {e}")
         return images
 
+    @staticmethod
+    def parsePageRange(pageRange, pageCount):
+        """
+        将从 1 开始的页码范围 (例如 '1-3,7') 转为从 0 开始的有序页码列表。
+        pageRange 为空时返回全部页面。
+        """
+        if not pageRange:
+            return list(range(pageCount))
+        pageSet = set()
+        for part in pageRange.split(','):
+            part = part.strip()
+            if not part:
+                continue
+            if '-' in part:
+                startText, endText = part.split('-', 1)
+                start = int(startText) if startText.strip() else 1
+                end = int(endText) if endText.strip() else pageCount
+            else:
+                start = end = int(part)
+            for page in range(max(start, 1), min(end, pageCount) + 1):
+                pageSet.add(page - 1)
+        return sorted(pageSet)
+
+    @staticmethod
+    def getPdfPageCount(pdfPath):
+        """
+        返回 PDF 的页数，打开失败时返回 0。
+        """
+        try:
+            with fitz.open(pdfPath) as document:
+                return document.page_count
+        except Exception as e:
+            LogTool.error(f"Failed to open PDF {pdfPath}: {e}")
+            return 0
+
+    @staticmethod
+    def getRenderZoom(pageRect, targetSize):
+        """
+        计算渲染比例，使页面渲染后的宽和高都刚好不小于 targetSize 像素。
+        模型输入固定为 targetSize x targetSize，更高的分辨率在缩放时会被丢弃。
+        """
+        shortSide = min(pageRect.width, pageRect.height)
+        if shortSide <= 0:
+            return 1.0
+        # +1 像素的余量，避免取整后比 targetSize 小一个像素
+        return (targetSize + 1) / shortSide
+
+    @staticmethod
+    def iterPdfImages(pdfPath, pageNumbers=None, targetSize=1024):
+        """
+        逐页渲染 PDF，每次只生成一页，内存占用与页数无关。
+        Args:
+            pdfPath (str): PDF文件的路径。
+            pageNumbers (iterable): 要渲染的页码 (从 0 开始)，None 表示全部页面。
+            targetSize (int): 模型输入边长，渲染比例按页面尺寸计算 (见 getRenderZoom)。
+        Yields:
+            tuple: (pageNumber, PIL Image)
+        """
+        document = None
+        try:
+            document = fitz.open(pdfPath)
+            if pageNumbers is None:
+                pageNumbers = range(document.page_count)
+            for pageNumber in pageNumbers:
+                page = document.load_page(pageNumber)
+                zoom = FileTool.getRenderZoom(page.rect, targetSize)
+                pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+                img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+                yield pageNumber, img
+        except Exception as e:
+            LogTool.error(f"Failed to convert PDF to image for {pdfPath}: {e}")
+        finally:
+            if document is not None:
+                document.close()
+
+    @staticmethod
+    def iterPdfImagesParallel(pdfPath, pageNumbers=None, targetSize=1024, workerCount=2, aheadCount=4):
+        """
+        与 iterPdfImages 相同，但由多个进程并行渲染，渲染与模型推理互相重叠。
+        每个工作进程只打开一次文档，负责页码列表中的一部分页面 (轮流分配)。
+        像素通过共享内存槽位传回主进程，而不是通过 pickle 传输字节：
+        共 aheadCount 个槽位，第 i 页写入槽位 i % aheadCount，
+        工作进程只有在 i < 已取走页数 + aheadCount 时才渲染第 i 页，
+        因此渲染最多领先消费 aheadCount 页，且不会覆盖未取走的槽位。
+        Args:
+            pdfPath (str): PDF文件的路径。
+            pageNumbers (iterable): 要渲染的页码 (从 0 开始)，None 表示全部页面。
+            targetSize (int): 模型输入边长 (见 getRenderZoom)。
+            workerCount (int): 渲染进程数。
+            aheadCount (int): 最多提前渲染的页数 (共享内存槽位数)。
+        Yields:
+            tuple: (pageNumber, PIL Image)，按页码列表的顺序。
+        """
+        slotList = []
+        workerList = []
+        resultQueue = None
+        try:
+            # 先计算每页渲染尺寸的上限，用来确定槽位大小
+            with fitz.open(pdfPath) as document:
+                if pageNumbers is None:
+                    pageNumbers = range(document.page_count)
+                pageNumbers = list(pageNumbers)
+                slotBytes = 3
+                for pageNumber in pageNumbers:
+                    rect = document.load_page(pageNumber).rect
+                    zoom = FileTool.getRenderZoom(rect, targetSize)
+                    slotBytes = max(slotBytes, (math.ceil(rect.width * zoom) + 1) * (math.ceil(rect.height * zoom) + 1) * 3)
+            if not pageNumbers:
+                return
+
+            aheadCount = max(1, min(aheadCount, len(pageNumbers)))
+            workerCount = max(1, min(workerCount, len(pageNumbers)))
+            slotList = [shared_memory.SharedMemory(create=True, size=slotBytes) for _ in range(aheadCount)]
+
+            context = multiprocessing.get_context()
+            consumedCount = context.Value('i', 0)
+            condition = context.Condition()
+            resultQueue = context.Queue()
+            for workerIndex in range(workerCount):
+                jobList = [(index, pageNumbers[index]) for index in range(workerIndex, len(pageNumbers), workerCount)]
+                worker = context.Process(
+                    target=FileTool._renderPdfWorker,
+                    args=(pdfPath, jobList, targetSize, [slot.name for slot in slotList], aheadCount, consumedCount, condition, resultQueue),
+                    daemon=True
+                )
+                worker.start()
+                workerList.append(worker)
+
+            readyDict = {}
+            for index, pageNumber in enumerate(pageNumbers):
+                while index not in readyDict:
+                    try:
+                        resultIndex, width, height, errorText = resultQueue.get(timeout=1)
+                        readyDict[resultIndex] = (width, height, errorText)
+                    except queue.Empty:
+                        if any(worker.exitcode not in (None, 0) for worker in workerList):
+                            raise RuntimeError("PDF render worker exited unexpectedly")
+                width, height, errorText = readyDict.pop(index)
+
+                img = None
+                if errorText:
+                    LogTool.error(f"Failed to render page {pageNumber + 1} of {pdfPath}: {errorText}")
+                else:
+                    view = slotList[index % aheadCount].buf[:width * height * 3]
+                    try:
+                        img = Image.frombytes("RGB", (width, height), view)
+                    finally:
+                        view.release()
+
+                # 槽位已经复制出来，允许工作进程继续渲染后面的页
+                with condition:
+                    consumedCount.value += 1
+                    condition.notify_all()
+
+                if img is not None:
+                    yield pageNumber, img
+        except Exception as e:
+            LogTool.error(f"Failed to convert PDF to image for {pdfPath}: {e}")
+        finally:
+            for worker in workerList:
+                if worker.is_alive():
+                    worker.terminate()
+                worker.join()
+            if resultQueue is not None:
+                resultQueue.close()
+            for slot in slotList:
+                slot.close()
+                slot.unlink()
+
+    @staticmethod
+    def _renderPdfWorker(pdfPath, jobList, targetSize, slotNameList, aheadCount, consumedCount, condition, resultQueue):
+        """
+        渲染进程入口：打开一次文档，按顺序渲染分配到的页面并写入共享内存槽位。
+        """
+        slotList = [FileTool._attachSharedMemory(name) for name in slotNameList]
+        document = fitz.open(pdfPath)
+        try:
+            for index, pageNumber in jobList:
+                with condition:
+                    condition.wait_for(lambda: index < consumedCount.value + aheadCount)
+                try:
+                    page = document.load_page(pageNumber)
+                    zoom = FileTool.getRenderZoom(page.rect, targetSize)
+                    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+                    samples = pix.samples_mv if hasattr(pix, "samples_mv") else pix.samples
+                    slotList[index % aheadCount].buf[:len(samples)] = samples
+                    resultQueue.put((index, pix.width, pix.height, None))
+                except Exception as e:
+                    resultQueue.put((index, 0, 0, str(e)))
+        finally:
+            document.close()
+            for slot in slotList:
+                slot.close()
+
+    @staticmethod
+    def _attachSharedMemory(name):
+        """
+        打开已存在的共享内存。槽位的生命周期由主进程管理 (close + unlink)。
+        """
+        try:
+            return shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Python < 3.13 没有 track 参数；子进程与主进程共用同一个 resource tracker，重复登记不会提前删除槽位
+            return shared_memory.SharedMemory(name=name)
+
     @staticmethod
     def downloadFile(url, destinationPath):
         # Create directory if it doesn't exist
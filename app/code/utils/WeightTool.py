@@ -0,0 +1,177 @@
+import os
+import re
+import json
+import hashlib
+import mmap
+import struct
+import warnings
+
+import torch
+from app.code.utils.LogTool import LogTool
+
+
+class WeightTool:
+    """
+    Model weights stored once, in their final dtype, and memory-mapped by every process.
+
+    from_pretrained reads the checkpoint into private memory and model.to(dtype) makes
+    another copy, so each OcrService replica costs the full model size in RSS. Here the
+    state dict is written once as a dtype-final safetensors file; loading maps that file
+    read-only and wraps the mapped bytes with torch.frombuffer, without copying them.
+    All processes share the same page-cache pages and each one only adds its own
+    activations and KV cache.
+
+    The mapped weights must never be written in place: the pages are read-only, so an
+    in-place op on a loaded parameter crashes the process (SIGSEGV) instead of silently
+    giving it a private copy of the page. Changes of dtype, device or memory format go
+    through model.to() and friends, which allocate new tensors.
+    """
+
+    _DTYPE_MAP = {
+        "F64": torch.float64,
+        "F32": torch.float32,
+        "F16": torch.float16,
+        "BF16": torch.bfloat16,
+        "I64": torch.int64,
+        "I32": torch.int32,
+        "I16": torch.int16,
+        "I8": torch.int8,
+        "U8": torch.uint8,
+        "BOOL": torch.bool,
+    }
+
+    # Files from_pretrained reads: config and the (possibly sharded) safetensors checkpoint
+    _CHECKPOINT_PATTERN = re.compile(r"^(config\.json|model\.safetensors(\.index\.json)?|model-\d+-of-\d+\.safetensors)$")
+
+    @staticmethod
+    def getCheckpointFingerprint(modelDirPath):
+        """
+        Short hash of the name, size and mtime of every checkpoint file in modelDirPath. Files
+        derived from the checkpoint carry it, so a replaced checkpoint is never paired with them.
+        """
+        hasher = hashlib.sha256()
+        for name in sorted(os.listdir(modelDirPath)):
+            if WeightTool._CHECKPOINT_PATTERN.match(name):
+                stat = os.stat(os.path.join(modelDirPath, name))
+                hasher.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+        return hasher.hexdigest()[:12]
+
+    @staticmethod
+    def removeStaleFiles(modelDirPath, prefix, filePath):
+        """
+        Removes the files prefix<fingerprint>.safetensors in modelDirPath other than filePath:
+        weights derived from earlier checkpoints, which are never read again.
+        """
+        stalePattern = re.compile(re.escape(prefix) + r"[0-9a-f]+\.safetensors$")
+        for name in os.listdir(modelDirPath):
+            stalePath = os.path.join(modelDirPath, name)
+            if stalePattern.match(name) and os.path.abspath(stalePath) != os.path.abspath(filePath):
+                try:
+                    os.remove(stalePath)
+                    LogTool.info(f"Removed stale weights {stalePath}")
+                except OSError as e:
+                    LogTool.error(f"Could not remove stale weights {stalePath}: {e}")
+
+    @staticmethod
+    def getDtypeFinalPath(modelDirPath, dtype):
+        """
+        Path of the dtype-final weights file inside the model directory, e.g. model.float32.<fingerprint>.safetensors.
+        The fingerprint is the one of the checkpoint it is made from, so a new checkpoint gets a new file.
+        """
+        return os.path.join(modelDirPath, f"{WeightTool._getDtypeFinalPrefix(dtype)}{WeightTool.getCheckpointFingerprint(modelDirPath)}.safetensors")
+
+    @staticmethod
+    def _getDtypeFinalPrefix(dtype):
+        return f"model.{str(dtype).replace('torch.', '')}."
+
+    @staticmethod
+    def saveDtypeFinal(model, filePath):
+        """
+        Writes the model state dict as safetensors. Tied tensors (lm_head / embed_tokens) are stored once.
+        """
+        from safetensors.torch import save_file
+
+        tensorDict = {}
+        seenSet = set()
+        for name, tensor in model.state_dict().items():
+            key = (tensor.data_ptr(), tensor.dtype, tuple(tensor.shape))
+            if key in seenSet:
+                continue
+            seenSet.add(key)
+            tensorDict[name] = tensor.detach().to("cpu").contiguous()
+
+        tempPath = filePath + ".tmp"
+        save_file(tensorDict, tempPath, metadata={"format": "pt"})
+        # Rename at the end, so a process never maps a half written file
+        os.replace(tempPath, filePath)
+        LogTool.info(f"Saved dtype-final weights to {filePath}")
+
+    @staticmethod
+    def mmapStateDict(filePath):
+        """
+        Maps a safetensors file and returns (stateDict, mapping). The tensors point into the
+        mapping, so it must stay open as long as they are used.
+        """
+        with open(filePath, "rb") as f:
+            # Read-only shared mapping: a write can never turn a shared page into a private copy
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        headerLen = struct.unpack("<Q", mapping[:8])[0]
+        header = json.loads(mapping[8:8 + headerLen])
+        dataStart = 8 + headerLen
+
+        stateDict = {}
+        with warnings.catch_warnings():
+            # torch warns once that the buffer is not writable; that is the point here (see the class docstring)
+            warnings.filterwarnings("ignore", message="The given buffer is not writable")
+            for name, info in header.items():
+                if name == "__metadata__":
+                    continue
+                dtype = WeightTool._DTYPE_MAP[info["dtype"]]
+                begin, end = info["data_offsets"]
+                count = (end - begin) // torch.tensor([], dtype=dtype).element_size()
+                tensor = torch.frombuffer(mapping, dtype=dtype, count=count, offset=dataStart + begin)
+                stateDict[name] = tensor.view(info["shape"])
+        return stateDict, mapping
+
+    @staticmethod
+    def loadMmapModel(modelClass, modelDirPath, filePath, prepareModel=None, **configKwargs):
+        """
+        Builds modelClass without allocating weights and assigns the mapped tensors to it.
+        prepareModel(model) may change the empty model before the weights are assigned,
+        e.g. swap in quantized layers (see DecoderQuantizer).
+        """
+        from accelerate import init_empty_weights
+
+        config = modelClass.config_class.from_pretrained(modelDirPath, **configKwargs)
+        # Parameters are created on the meta device; buffers (rotary inv_freq) stay real
+        with init_empty_weights(include_buffers=False):
+            model = modelClass(config)
+        if prepareModel is not None:
+            prepareModel(model)
+
+        stateDict, mapping = WeightTool.mmapStateDict(filePath)
+        model.load_state_dict(stateDict, strict=False, assign=True)
+        model.tie_weights()
+
+        missingList = [name for name, tensor in list(model.named_parameters()) + list(model.named_buffers()) if tensor.device.type == "meta"]
+        if missingList:
+            raise ValueError(f"Weights missing in {filePath}: {missingList[:5]}")
+        model._weightMapping = mapping
+        return model.eval()
+
+    @staticmethod
+    def ensureDtypeFinal(modelClass, modelDirPath, dtype, **loadKwargs):
+        """
+        Returns the dtype-final weights path, creating the file from the checkpoint if it does not exist yet.
+        """
+        filePath = WeightTool.getDtypeFinalPath(modelDirPath, dtype)
+        if os.path.exists(filePath):
+            return filePath
+        LogTool.info(f"Creating dtype-final weights {filePath}")
+        model = modelClass.from_pretrained(modelDirPath, low_cpu_mem_usage=True, use_safetensors=True, **loadKwargs)
+        model.to(dtype=dtype)
+        WeightTool.saveDtypeFinal(model, filePath)
+        del model
+        WeightTool.removeStaleFiles(modelDirPath, WeightTool._getDtypeFinalPrefix(dtype), filePath)
+        return filePath
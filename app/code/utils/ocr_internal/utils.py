@@ -6,6 +6,8 @@ import sys
 import torch
 import requests
 
+import transformers
+from packaging import version
 from transformers import StoppingCriteria
 from .constants import LOGDIR
 
@@ -14,6 +16,9 @@ moderation_msg = "YOUR INPUT VIOLATES OUR CONTENT MODERATION GUIDELINES. PLEASE
 
 handler = None
 
+# Before 4.39 StoppingCriteriaList reduces the criteria with any(), which needs one bool per call
+PER_ROW_STOPPING = version.parse(transformers.__version__) >= version.parse("4.39.0")
+
 
 def build_logger(logger_name, logger_filename):
     global handler
@@ -128,26 +133,63 @@ def pretty_print_semaphore(semaphore):
 
 
 class KeywordsStoppingCriteria(StoppingCriteria):
+    """
+    Stops generation when a keyword appears in the generated text.
+
+    Only the newest tokens are decoded at each step. Every row keeps a short rolling tail of
+    its decoded bytes (just long enough to hold a keyword that spans several tokens), so the
+    cost per step stays flat as the output grows. Returns a per-row done mask, which lets
+    batched generation finish each row on its own; transformers before 4.39 only takes a single
+    bool, so there it is True once every row is done.
+    """
     def __init__(self, keywords, tokenizer, input_ids):
         self.keywords = keywords
+        self.keyword_bytes = [keyword.encode("utf-8") for keyword in keywords]
         self.keyword_ids = [tokenizer(keyword).input_ids for keyword in keywords]
-        self.keyword_ids = [keyword_id[0] for keyword_id in self.keyword_ids if type(keyword_id) is list and len(keyword_id) == 1]
+        self.keyword_ids = set(keyword_id[0] for keyword_id in self.keyword_ids if type(keyword_id) is list and len(keyword_id) == 1)
+        self.tail_len = max(len(keyword) for keyword in self.keyword_bytes) - 1
         self.tokenizer = tokenizer
-        self.start_len = None
-        self.input_ids = input_ids
-
-    def __call__(self, output_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
-        if self.start_len is None:
-            self.start_len = self.input_ids.shape[1]
-        else:
-            for keyword_id in self.keyword_ids:
-                if output_ids[0, -1] == keyword_id:
-                    return True
-            outputs = self.tokenizer.batch_decode(output_ids[:, self.start_len:], skip_special_tokens=True)[0]
-            for keyword in self.keywords:
-                if keyword in outputs:
-                    return True
-        return False
+        self.start_len = input_ids.shape[1]
+        self.seen_len = self.start_len
+        self.token_bytes = {}
+        self.tails = None
+        self.done = None
+
+    def _get_token_bytes(self, token_id):
+        token = self.token_bytes.get(token_id)
+        if token is None:
+            token = self.tokenizer.convert_ids_to_tokens(token_id)
+            if not isinstance(token, bytes):
+                # Byte-level tokenizers return bytes, others need a real decode of the single id
+                token = self.tokenizer.decode([token_id]).encode("utf-8")
+            self.token_bytes[token_id] = token
+        return token
+
+    def __call__(self, output_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        batch_size, cur_len = output_ids.shape
+        if self.done is None or len(self.done) != batch_size:
+            self.tails = [b""] * batch_size
+            self.done = [False] * batch_size
+
+        if cur_len > self.seen_len:
+            new_ids = output_ids[:, self.seen_len:cur_len].tolist()
+            self.seen_len = cur_len
+            for row, row_ids in enumerate(new_ids):
+                if self.done[row]:
+                    continue
+                tail = self.tails[row]
+                for token_id in row_ids:
+                    if token_id in self.keyword_ids:
+                        self.done[row] = True
+                        break
+                    tail += self._get_token_bytes(token_id)
+                if not self.done[row] and any(keyword in tail for keyword in self.keyword_bytes):
+                    self.done[row] = True
+                self.tails[row] = tail[-self.tail_len:] if self.tail_len > 0 else b""
+
+        if not PER_ROW_STOPPING:
+            return all(self.done)
+        return torch.tensor(self.done, dtype=torch.bool, device=output_ids.device)
 
 
 def smart_tokenizer_and_embedding_resize(special_tokens_dict, tokenizer, model):
@@ -232,3 +274,42 @@ def find_all_linear_names(model):
 
     print(lora_module_names)
     return list(lora_module_names)
+
+
+if __name__ == "__main__":
+    # Micro-benchmark: per-step stop check cost as the output grows.
+    # Run from the project root: python -m app.code.utils.ocr_internal.utils
+    import random
+    from transformers import AutoTokenizer
+    from app.code.utils.BenchTool import BenchTool
+
+    tokenizer = AutoTokenizer.from_pretrained("app/code/data", trust_remote_code=True)
+    batch_size = 4
+    prompt_len = 290
+    random.seed(0)
+    prompt_ids = torch.zeros((batch_size, prompt_len), dtype=torch.long)
+    max_len = 4096
+    generated = torch.tensor([[random.randrange(0, 150000) for _ in range(max_len)] for _ in range(batch_size)])
+
+    def legacy_check(output_ids):
+        # Old behaviour: decode the whole generated part of row 0 at every step
+        outputs = tokenizer.batch_decode(output_ids[:, prompt_len:], skip_special_tokens=True)[0]
+        return "<|im_end|>" in outputs
+
+    rows = []
+    for length in (64, 256, 1024, 4096):
+        output_ids = torch.cat([prompt_ids, generated[:, :length]], dim=1)
+        criteria = KeywordsStoppingCriteria(["<|im_end|>"], tokenizer, prompt_ids)
+        criteria(output_ids[:, :-1], None)
+        step_ids = output_ids
+
+        def new_step():
+            # Rewind by one token so each call decodes exactly one new column
+            criteria.seen_len = step_ids.shape[1] - 1
+            criteria(step_ids, None)
+
+        legacy = BenchTool.timeIt(lambda: legacy_check(step_ids), repeat=20)
+        incremental = BenchTool.timeIt(new_step, repeat=200)
+        rows.append((length, legacy["meanMs"], incremental["meanMs"]))
+
+    BenchTool.printTable("Stop check cost per step (ms)", ("output tokens", "full decode", "incremental"), rows)